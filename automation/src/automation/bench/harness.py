@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from automation.bench.stub_api import StubBackend
+
+# Simulated CLI for each vendor the scheduler backs up.
+VENDOR_KINDS = {"cisco_ios": "ios", "fortigate": "fortios", "hp_comware": "comware"}
+
+_SRC_DIR = Path(__file__).resolve().parents[2]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+  """Nearest-rank percentile, ``q`` in 0..100."""
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = -(-len(ordered) * q // 100)
+  return ordered[min(len(ordered), max(1, int(rank))) - 1]
+
+
+def _env(**extra: str) -> Dict[str, str]:
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.pathsep.join(p for p in (str(_SRC_DIR), env.get("PYTHONPATH")) if p)
+  env.update(extra)
+  return env
+
+
+def _spawn(module: str, args: List[str], log_path: Path) -> Tuple[subprocess.Popen, int]:
+  """Start a simulator and wait for the port it reports listening on."""
+  with open(log_path, "ab") as log:
+    proc = subprocess.Popen(
+      [sys.executable, "-m", module, *args],
+      stdout=subprocess.PIPE,
+      stderr=log,
+      env=_env(),
+      text=True,
+    )
+  line = proc.stdout.readline() if proc.stdout else ""
+  if not line.startswith("listening "):
+    proc.kill()
+    raise RuntimeError(f"{module} did not start, see {log_path}")
+  return proc, int(line.split()[1])
+
+
+class Bench:
+  """Simulators and stub backend for one benchmark session.
+
+  Every case runs the service's ``run_once`` in a fresh process (see
+  ``automation.bench.target``) against the same simulators; the
+  environment is passed on, so service settings such as
+  SCHEDULER_CONCURRENCY or SNMP_POLLER_ENGINE apply to the cases.
+  """
+
+  def __init__(self, args: argparse.Namespace):
+    self.args = args
+    self.work_dir = Path(tempfile.mkdtemp(prefix="netcfg-bench-"))
+    self.backend = StubBackend()
+    self.ssh_ports: Dict[str, int] = {}
+    self.snmp_port = 0
+    self._procs: List[subprocess.Popen] = []
+
+  def start(self, targets: List[str], vendors: List[str]) -> None:
+    self.backend.start()
+    if "scheduler" in targets:
+      for vendor in vendors:
+        kind = VENDOR_KINDS[vendor]
+        proc, self.ssh_ports[vendor] = _spawn(
+          "automation.bench.ssh_device",
+          [
+            "--kind", kind,
+            "--config-kb", str(self.args.config_kb),
+            "--latency-ms", str(self.args.latency_ms),
+            "--page-lines", str(self.args.page_lines),
+          ],
+          self.work_dir / f"ssh-{kind}.log",
+        )
+        self._procs.append(proc)
+    if "snmp" in targets:
+      proc, self.snmp_port = _spawn(
+        "automation.bench.snmp_agent",
+        ["--latency-ms", str(self.args.snmp_latency_ms)],
+        self.work_dir / "snmp-agent.log",
+      )
+      self._procs.append(proc)
+
+  def stop(self) -> None:
+    for proc in self._procs:
+      proc.terminate()
+    for proc in self._procs:
+      try:
+        proc.wait(timeout=5)
+      except subprocess.TimeoutExpired:
+        proc.kill()
+    self.backend.stop()
+    if not self.args.keep:
+      shutil.rmtree(self.work_dir, ignore_errors=True)
+
+  def run_case(self, target: str, devices: int, vendors: List[str]) -> Dict[str, Any]:
+    env = _env(API_BASE_URL=self.backend.url, AUTOMATION_SERVICE_TOKEN="bench")
+    if target == "scheduler":
+      self.backend.load_jobs([
+        {
+          "executionId": f"bench-{devices}-{i}",
+          "deviceId": f"dev{i:05d}",
+          "tenantId": f"tenant{i % 4}",
+          "vendor": vendors[i % len(vendors)],
+          "mgmtIp": "127.0.0.1",
+          "sshPort": self.ssh_ports[vendors[i % len(vendors)]],
+          # The simulators name each device after its username.
+          "username": f"dev{i:05d}",
+          "password": "bench",
+        }
+        for i in range(devices)
+      ])
+      env["BACKUP_ROOT_DIR"] = str(self.work_dir / f"backups-{devices}")
+    else:
+      self.backend.load_devices([
+        {"id": f"dev{i:05d}", "tenant_id": f"tenant{i % 4}", "mgmt_ip": "127.0.0.1", "vendor": vendors[i % len(vendors)]}
+        for i in range(devices)
+      ])
+      env["SNMP_PORT"] = str(self.snmp_port)
+    proc = subprocess.run(
+      [sys.executable, "-m", "automation.bench.target", target],
+      env=env,
+      capture_output=True,
+      text=True,
+      timeout=self.args.timeout,
+    )
+    if proc.returncode != 0:
+      raise RuntimeError(f"{target} with {devices} devices failed:\n{proc.stderr[-2000:]}")
+    measured = json.loads(proc.stdout.strip().splitlines()[-1])
+    latencies, succeeded, _ = self.backend.results()
+    p50 = percentile(latencies, 50)
+    p99 = percentile(latencies, 99)
+    return {
+      "target": target,
+      "devices": devices,
+      "succeeded": succeeded,
+      # Devices never reported on count as failed too.
+      "failed": devices - succeeded,
+      "seconds": round(measured["seconds"], 3),
+      "devices_per_second": round(devices / measured["seconds"], 2) if measured["seconds"] > 0 else None,
+      "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+      "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+      "peak_rss_mb": round(measured["peak_rss_bytes"] / (1024 * 1024), 1),
+    }
+
+
+_HEADER = f"{'target':<10} {'devices':>7} {'ok':>6} {'failed':>6} {'seconds':>8} {'dev/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'peak RSS MB':>12}"
+
+
+def _format_row(r: Dict[str, Any]) -> str:
+  return (
+    f"{r['target']:<10} {r['devices']:>7} {r['succeeded']:>6} {r['failed']:>6} {r['seconds']:>8.2f}"
+    f" {r['devices_per_second'] or 0:>8.2f} {r['p50_ms'] or 0:>9.1f} {r['p99_ms'] or 0:>9.1f} {r['peak_rss_mb']:>12.1f}"
+  )
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(
+    description="Benchmark scheduler.run_once and snmp_poller.run_once against simulated devices.",
+  )
+  parser.add_argument("--devices", default="10,100,1000", help="comma-separated fleet sizes")
+  parser.add_argument("--targets", default="scheduler,snmp", help="scheduler and/or snmp")
+  parser.add_argument("--vendors", default=",".join(VENDOR_KINDS), help="vendors the devices cycle through")
+  parser.add_argument("--config-kb", type=int, default=1024, help="size of each simulated config")
+  parser.add_argument("--latency-ms", type=float, default=20.0, help="SSH latency per command")
+  parser.add_argument("--page-lines", type=int, default=0, help="page Comware output every N lines")
+  parser.add_argument("--snmp-latency-ms", type=float, default=2.0, help="SNMP latency per response")
+  parser.add_argument("--timeout", type=float, default=3600.0, help="seconds allowed per case")
+  parser.add_argument("--json", type=Path, help="also write the results to this file")
+  parser.add_argument("--keep", action="store_true", help="keep the work directory (backups, simulator logs)")
+  args = parser.parse_args()
+
+  sizes = [int(n) for n in args.devices.split(",") if n.strip()]
+  targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+  vendors = [v.strip() for v in args.vendors.split(",") if v.strip()]
+  unknown = [t for t in targets if t not in ("scheduler", "snmp")] + [v for v in vendors if v not in VENDOR_KINDS]
+  if unknown:
+    parser.error(f"unknown target or vendor: {', '.join(unknown)}")
+
+  bench = Bench(args)
+  rows: List[Dict[str, Any]] = []
+  try:
+    bench.start(targets, vendors)
+    print(f"work dir {bench.work_dir}", file=sys.stderr)
+    print(_HEADER, flush=True)
+    for target in targets:
+      for devices in sizes:
+        rows.append(bench.run_case(target, devices, vendors))
+        print(_format_row(rows[-1]), flush=True)
+  finally:
+    bench.stop()
+  if args.json:
+    args.json.write_text(json.dumps(rows, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+  main()
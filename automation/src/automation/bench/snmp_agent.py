@@ -0,0 +1,148 @@
+import argparse
+import bisect
+import heapq
+import select
+import socket
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from pyasn1.codec.ber import decoder, encoder
+from pyasn1.type import univ
+from pysnmp.proto import api
+from pysnmp.proto.rfc1902 import Integer, OctetString, TimeTicks
+
+from automation.snmp.vendor_oids import (
+  CPU_TABLE_OID,
+  FORTIGATE_FW_OID,
+  FORTIGATE_SERIAL_OID,
+  INVENTORY_MODEL_OID,
+  INVENTORY_SERIAL_OID,
+  MEM_AVAIL_OID,
+  MEM_TOTAL_OID,
+  UPTIME_OID,
+)
+
+
+def _key(oid: str) -> Tuple[int, ...]:
+  return tuple(int(part) for part in oid.split("."))
+
+
+def build_mib(cpus: int = 4, entities: int = 32) -> Dict[str, Any]:
+  """What every simulated device answers: the OIDs the poller reads, with an
+  ENTITY-MIB table of ``entities`` rows whose first row (the chassis
+  container on many devices) has no model or serial."""
+  mib: Dict[str, Any] = {
+    UPTIME_OID: TimeTicks(8640000),
+    MEM_TOTAL_OID: Integer(4194304),
+    MEM_AVAIL_OID: Integer(1048576),
+    FORTIGATE_FW_OID: OctetString("v7.2.5,build1517,230606 (GA.F)"),
+    FORTIGATE_SERIAL_OID: OctetString("FGT60ETK18000001"),
+  }
+  for i in range(1, cpus + 1):
+    mib[f"{CPU_TABLE_OID}.{i}"] = Integer(5 + 10 * i % 90)
+  for i in range(1, entities + 1):
+    mib[f"{INVENTORY_MODEL_OID}.{i}"] = OctetString("" if i == 1 else f"MODEL-{i}")
+    mib[f"{INVENTORY_SERIAL_OID}.{i}"] = OctetString("" if i == 1 else f"SN{i:08d}")
+  return mib
+
+
+class SimulatedAgent:
+  """SNMPv1/v2c GET, GETNEXT and GETBULK responder over a static MIB.
+
+  It answers any community. ``latency`` delays every response without
+  holding up the requests behind it, like a network round trip.
+  """
+
+  def __init__(self, mib: Dict[str, Any], latency: float = 0.0):
+    self.mib = mib
+    self.latency = latency
+    self._oids = sorted(mib, key=_key)
+    self._keys = [_key(oid) for oid in self._oids]
+
+  def _next(self, oid: Any) -> Optional[str]:
+    i = bisect.bisect_right(self._keys, tuple(oid))
+    return self._oids[i] if i < len(self._oids) else None
+
+  def respond(self, data: bytes) -> Optional[bytes]:
+    try:
+      proto = api.protoModules[api.decodeMessageVersion(data)]
+      msg, _ = decoder.decode(data, asn1Spec=proto.Message())
+    except Exception:
+      return None
+    req = proto.apiMessage.getPDU(msg)
+    rsp_msg = proto.apiMessage.getResponse(msg)
+    rsp = proto.apiMessage.getPDU(rsp_msg)
+    var_binds = proto.apiPDU.getVarBinds(req)
+    out: List[Tuple[Any, Any]] = []
+    if req.isSameTypeWith(proto.GetRequestPDU()):
+      for oid, _ in var_binds:
+        value = self.mib.get(str(oid))
+        if value is None:
+          if proto is api.protoModules[api.protoVersion1]:
+            proto.apiPDU.setErrorStatus(rsp, 2)
+            proto.apiPDU.setErrorIndex(rsp, len(out) + 1)
+            proto.apiPDU.setVarBinds(rsp, var_binds)
+            return encoder.encode(rsp_msg)
+          value = proto.NoSuchObject()
+        out.append((oid, value))
+    elif req.isSameTypeWith(proto.GetNextRequestPDU()):
+      for oid, _ in var_binds:
+        out.append(self._walk_step(proto, oid))
+    elif hasattr(proto, "GetBulkRequestPDU") and req.isSameTypeWith(proto.GetBulkRequestPDU()):
+      non_repeaters = int(proto.apiBulkPDU.getNonRepeaters(req))
+      repetitions = int(proto.apiBulkPDU.getMaxRepetitions(req))
+      for oid, _ in var_binds[:non_repeaters]:
+        out.append(self._walk_step(proto, oid))
+      columns = [oid for oid, _ in var_binds[non_repeaters:]]
+      for _ in range(repetitions):
+        row = [self._walk_step(proto, oid) for oid in columns]
+        out.extend(row)
+        columns = [oid for oid, _ in row]
+        if all(value.isSameTypeWith(proto.EndOfMibView()) for _, value in row):
+          break
+    else:
+      return None
+    proto.apiPDU.setVarBinds(rsp, out)
+    return encoder.encode(rsp_msg)
+
+  def _walk_step(self, proto: Any, oid: Any) -> Tuple[Any, Any]:
+    found = self._next(oid)
+    if found is None:
+      return oid, proto.EndOfMibView()
+    return univ.ObjectIdentifier(found), self.mib[found]
+
+  def serve(self, sock: socket.socket) -> None:
+    delayed: List[Tuple[float, int, bytes, Any]] = []
+    seq = 0
+    while True:
+      wait = max(0.0, delayed[0][0] - time.monotonic()) if delayed else None
+      readable, _, _ = select.select([sock], [], [], wait)
+      if readable:
+        data, addr = sock.recvfrom(65535)
+        response = self.respond(data)
+        if response is not None:
+          if self.latency > 0:
+            seq += 1
+            heapq.heappush(delayed, (time.monotonic() + self.latency, seq, response, addr))
+          else:
+            sock.sendto(response, addr)
+      now = time.monotonic()
+      while delayed and delayed[0][0] <= now:
+        _, _, response, addr = heapq.heappop(delayed)
+        sock.sendto(response, addr)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Simulated SNMP agent for the poller benchmarks.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=0)
+  parser.add_argument("--latency-ms", type=float, default=0.0)
+  parser.add_argument("--cpus", type=int, default=4)
+  parser.add_argument("--entities", type=int, default=32)
+  args = parser.parse_args()
+  agent = SimulatedAgent(build_mib(args.cpus, args.entities), args.latency_ms / 1000.0)
+  listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+  listener.bind((args.host, args.port))
+  print(f"listening {listener.getsockname()[1]}", flush=True)
+  agent.serve(listener)
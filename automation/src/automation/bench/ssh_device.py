@@ -0,0 +1,268 @@
+import argparse
+import logging
+import random
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import paramiko
+
+# How each simulated CLI looks. Commands in "show" print the config; those in
+# "replies" get canned output (what netmiko's session preparation asks for);
+# anything else is echoed and answered with the prompt, like a device
+# accepting a setup command. Only Comware pages its output (--page-lines),
+# whatever "screen-length disable" said, as some firmware does.
+PROFILES: Dict[str, Dict] = {
+  "ios": {
+    "prompt": "{host}#",
+    "banner": "",
+    "show": ("show running-config", "show run"),
+    "replies": {},
+  },
+  "fortios": {
+    "prompt": "{host} # ",
+    "banner": "",
+    "show": ("show full-configuration",),
+    "replies": {
+      "get system status | grep Virtual": "Virtual domain configuration: disable",
+      "get system status | grep Version": "Version: FortiGate-60E v7.2.5,build1517,230606 (GA.F)",
+      "get system console": "output              : standard",
+    },
+  },
+  "comware": {
+    "prompt": "<{host}>",
+    "banner": "******************************************************************************\r\n"
+              "* Copyright (c) 2004-2020 New H3C Technologies Co., Ltd. All rights reserved.*\r\n"
+              "* Without the owner's prior written consent,                                 *\r\n"
+              "* no decompiling or reverse-engineering shall be allowed.                    *\r\n"
+              "******************************************************************************\r\n",
+    "show": ("display current-configuration",),
+    "replies": {},
+    "pager": b"  ---- More ----",
+    "erase": b"\x1b[16D                \x1b[16D",
+  },
+}
+
+
+# Each config is a per-login head (hostname and the lines that change on
+# every export) over a body generated once per simulator.
+def _ios_head(host: str, body_bytes: int) -> str:
+  now = datetime.now(timezone.utc).strftime("%H:%M:%S UTC %a %b %d %Y")
+  return (
+    f"Building configuration...\n\nCurrent configuration : {body_bytes} bytes\n!\n"
+    f"! Last configuration change at {now} by admin\n!\nversion 15.2\n"
+    f"service timestamps log datetime msec\nhostname {host}\n!\nntp clock-period 17179{random.randint(100, 999)}\n!\n"
+  )
+
+
+def _ios_body(body_bytes: int) -> str:
+  blocks = []
+  size = 0
+  i = 0
+  while size < body_bytes:
+    block = (
+      f"interface GigabitEthernet{i // 48}/{i % 48}\n description access port {i}\n switchport access vlan {10 + i % 200}\n"
+      f" switchport mode access\n spanning-tree portfast\n no shutdown\n!\n"
+      f"ip access-list extended ACL-{i}\n permit tcp 10.{i % 250}.0.0 0.0.255.255 any eq 443\n deny ip any any log\n!\n"
+    )
+    blocks.append(block)
+    size += len(block)
+    i += 1
+  return "".join(blocks) + "end\n"
+
+
+def _fortios_head(host: str, body_bytes: int) -> str:
+  return (
+    f"#config-version=FGT60E-7.2.5-FW-build1517-230606:opmode=0:vdom=0:user=admin\n#conf_file_ver={random.getrandbits(48)}\n"
+    f"#buildno=1517\n#global_vdom=1\nconfig system global\n    set hostname \"{host}\"\n    set timezone 28\nend\n"
+  )
+
+
+def _fortios_body(body_bytes: int) -> str:
+  policies = ["config firewall policy\n"]
+  users = ["config user local\n"]
+  size = 0
+  i = 1
+  while size < body_bytes:
+    policy = (
+      f"    edit {i}\n        set name \"policy-{i}\"\n        set srcintf \"port{1 + i % 8}\"\n        set dstintf \"wan1\"\n"
+      f"        set srcaddr \"net-{i}\"\n        set dstaddr \"all\"\n        set action accept\n        set schedule \"always\"\n"
+      f"        set service \"HTTPS\"\n        set nat enable\n    next\n"
+    )
+    user = f"    edit \"user{i}\"\n        set passwd ENC {random.getrandbits(256):064x}\n    next\n"
+    policies.append(policy)
+    users.append(user)
+    size += len(policy) + len(user)
+    i += 1
+  return "".join(policies) + "end\n" + "".join(users) + "end\n"
+
+
+def _comware_head(host: str, body_bytes: int) -> str:
+  return f" version 7.1.070, Release 3506P06\n#\n sysname {host}\n#\n clock timezone UTC add 00:00:00\n#\n"
+
+
+def _comware_body(body_bytes: int) -> str:
+  blocks = []
+  size = 0
+  i = 0
+  while size < body_bytes:
+    block = (
+      f"interface GigabitEthernet1/0/{i}\n port link-mode bridge\n description access port {i}\n"
+      f" port access vlan {10 + i % 200}\n stp edged-port\n#\n"
+    )
+    blocks.append(block)
+    size += len(block)
+    i += 1
+  return "".join(blocks) + "return\n"
+
+
+CONFIGS = {
+  "ios": (_ios_head, _ios_body),
+  "fortios": (_fortios_head, _fortios_body),
+  "comware": (_comware_head, _comware_body),
+}
+
+
+class SimulatedDevice:
+  """Serves one vendor's CLI over SSH for any number of devices.
+
+  Every login is accepted; the username is taken as the device name, so
+  each device gets its own hostname in the prompt and config (and its own
+  pooled session on the client side). ``latency`` is slept before every
+  command's output, standing in for the round trip and CLI processing time.
+  """
+
+  def __init__(self, kind: str, config_bytes: int, latency: float = 0.0, page_lines: int = 0):
+    self.kind = kind
+    self.profile = PROFILES[kind]
+    self.config_bytes = config_bytes
+    self.latency = latency
+    self.page_lines = page_lines if "pager" in self.profile else 0
+    self.host_key = paramiko.RSAKey.generate(2048)
+    self._head, body = CONFIGS[kind]
+    self._body = _crlf(body(config_bytes))
+
+  def render_config(self, host: str) -> bytes:
+    return _crlf(self._head(host, self.config_bytes)) + self._body
+
+  def serve(self, sock: socket.socket) -> None:
+    while True:
+      conn, _ = sock.accept()
+      threading.Thread(target=self._connection, args=(conn,), daemon=True).start()
+
+  def _connection(self, conn: socket.socket) -> None:
+    transport = paramiko.Transport(conn)
+    transport.add_server_key(self.host_key)
+    server = _Server()
+    try:
+      transport.start_server(server=server)
+      while transport.is_active():
+        chan = transport.accept(60)
+        if chan is None:
+          break
+        threading.Thread(target=self._shell, args=(chan, server.username), daemon=True).start()
+    except Exception:
+      pass
+    finally:
+      transport.close()
+
+  def _shell(self, chan: paramiko.Channel, username: str) -> None:
+    host = re.sub(r"[^A-Za-z0-9-]", "-", username or "device")
+    prompt = self.profile["prompt"].format(host=host).encode()
+    try:
+      time.sleep(self.latency)
+      chan.sendall(self.profile["banner"].encode() + b"\r\n" + prompt)
+      pending = b""
+      while True:
+        data = chan.recv(4096)
+        if not data:
+          return
+        pending += data.replace(b"\x00", b"")
+        while True:
+          cut = min((i for i in (pending.find(b"\r"), pending.find(b"\n")) if i >= 0), default=-1)
+          if cut < 0:
+            break
+          line, pending = pending[:cut], pending[cut + 1:]
+          self._command(chan, line.decode(errors="replace").strip(), host, prompt)
+    except Exception:
+      pass
+    finally:
+      chan.close()
+
+  def _command(self, chan: paramiko.Channel, cmd: str, host: str, prompt: bytes) -> None:
+    if cmd:
+      time.sleep(self.latency)
+    out = cmd.encode() + b"\r\n"
+    if cmd in self.profile["show"]:
+      chan.sendall(out)
+      self._send_config(chan, self.render_config(host))
+      out = b""
+    elif cmd in self.profile["replies"]:
+      out += self.profile["replies"][cmd].encode() + b"\r\n"
+    chan.sendall(out + prompt)
+
+  def _send_config(self, chan: paramiko.Channel, config: bytes) -> None:
+    if not self.page_lines:
+      chan.sendall(config)
+      return
+    lines = config.split(b"\r\n")
+    for start in range(0, len(lines), self.page_lines):
+      page = lines[start:start + self.page_lines]
+      if start + self.page_lines >= len(lines):
+        chan.sendall(b"\r\n".join(page))
+        return
+      chan.sendall(b"\r\n".join(page) + b"\r\n" + self.profile["pager"])
+      # Any key shows the next page.
+      if not chan.recv(1):
+        return
+      chan.sendall(self.profile["erase"])
+
+
+def _crlf(text: str) -> bytes:
+  return text.replace("\n", "\r\n").encode()
+
+
+class _Server(paramiko.ServerInterface):
+  def __init__(self):
+    self.username: Optional[str] = None
+
+  def check_auth_password(self, username: str, password: str) -> int:
+    self.username = username
+    return paramiko.AUTH_SUCCESSFUL
+
+  def get_allowed_auths(self, username: str) -> str:
+    return "password"
+
+  def check_channel_request(self, kind: str, chanid: int) -> int:
+    if kind == "session":
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+  def check_channel_pty_request(self, *args) -> bool:
+    return True
+
+  def check_channel_shell_request(self, channel: paramiko.Channel) -> bool:
+    return True
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Simulated network device CLI over SSH.")
+  parser.add_argument("--kind", choices=sorted(PROFILES), required=True)
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=0)
+  parser.add_argument("--config-kb", type=int, default=1024)
+  parser.add_argument("--latency-ms", type=float, default=0.0)
+  parser.add_argument("--page-lines", type=int, default=0)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.ERROR)
+  device = SimulatedDevice(args.kind, args.config_kb * 1024, args.latency_ms / 1000.0, args.page_lines)
+  listener = socket.socket()
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.bind((args.host, args.port))
+  listener.listen(512)
+  # The harness waits for this line before sending work.
+  print(f"listening {listener.getsockname()[1]}", flush=True)
+  device.serve(listener)
@@ -0,0 +1,149 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+_JOB_STATUS = re.compile(r"^/internal/jobs/([^/]+)/status$")
+_SNMP_CONFIG = re.compile(r"^/internal/monitoring/devices/([^/]+)/snmp_config$")
+
+
+def _route(path: str) -> str:
+  path = _JOB_STATUS.sub("/internal/jobs/:id/status", path)
+  return _SNMP_CONFIG.sub("/internal/monitoring/devices/:id/snmp_config", path)
+
+
+class StubBackend:
+  """In-memory stand-in for the backend's internal API.
+
+  ``load_jobs`` queues jobs for the next ``/internal/jobs/pending`` fetch;
+  ``load_devices`` sets the fleet the SNMP poller pages through. Each
+  device's latency is measured here, from the first request about it (the
+  job marked running, its SNMP config fetched) to its result (the backup
+  report, the inventory report), so the services are timed unmodified.
+  """
+
+  def __init__(self, host: str = "127.0.0.1", port: int = 0):
+    self._lock = threading.Lock()
+    self._jobs: List[Dict[str, Any]] = []
+    self._devices: List[Dict[str, Any]] = []
+    self._started: Dict[str, float] = {}
+    self._finished: Dict[str, Tuple[float, bool]] = {}
+    self._last_sha: Dict[str, str] = {}
+    self.requests: Counter = Counter()
+    self.server = ThreadingHTTPServer((host, port), self._handler())
+    self.server.daemon_threads = True
+
+  @property
+  def url(self) -> str:
+    host, port = self.server.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def start(self) -> None:
+    threading.Thread(target=self.server.serve_forever, name="bench-backend", daemon=True).start()
+
+  def stop(self) -> None:
+    self.server.shutdown()
+    self.server.server_close()
+
+  def _reset(self) -> None:
+    self._started.clear()
+    self._finished.clear()
+    self.requests.clear()
+
+  def load_jobs(self, jobs: List[Dict[str, Any]]) -> None:
+    with self._lock:
+      self._reset()
+      self._jobs = list(jobs)
+
+  def load_devices(self, devices: List[Dict[str, Any]]) -> None:
+    with self._lock:
+      self._reset()
+      self._devices = list(devices)
+
+  def results(self) -> Tuple[List[float], int, int]:
+    """(latencies in seconds of the devices that finished, succeeded, failed)."""
+    with self._lock:
+      latencies = [done - self._started[key] for key, (done, _) in self._finished.items() if key in self._started]
+      succeeded = sum(1 for _, ok in self._finished.values() if ok)
+      return latencies, succeeded, len(self._finished) - succeeded
+
+  def _start(self, key: str) -> None:
+    with self._lock:
+      self._started.setdefault(key, time.monotonic())
+
+  def _finish(self, key: str, ok: bool) -> None:
+    with self._lock:
+      self._finished[key] = (time.monotonic(), ok)
+
+  def handle(self, method: str, path: str, query: Dict[str, List[str]], body: Dict[str, Any]) -> Tuple[int, Any]:
+    with self._lock:
+      self.requests[f"{method} {_route(path)}"] += 1
+    if method == "GET" and path == "/internal/jobs/pending":
+      with self._lock:
+        jobs, self._jobs = self._jobs, []
+      return 200, {"items": jobs}
+    m = _JOB_STATUS.match(path)
+    if m:
+      if body.get("status") == "running":
+        self._start(m.group(1))
+      return 200, {"ok": True}
+    if path == "/internal/backups/report":
+      self._finish(str(body.get("executionId")), bool(body.get("success")))
+      if body.get("success"):
+        with self._lock:
+          self._last_sha[str(body.get("deviceId"))] = str(body.get("configSha256"))
+      return 200, {"ok": True}
+    if path == "/internal/backups/unchanged":
+      with self._lock:
+        known = self._last_sha.get(str(body.get("deviceId")))
+      if known != body.get("configSha256"):
+        return 409, {"message": "Latest backup differs"}
+      self._finish(str(body.get("executionId")), True)
+      return 200, {"unchanged": True}
+    if method == "GET" and path == "/internal/monitoring/devices":
+      limit = int((query.get("limit") or ["50"])[0])
+      offset = int((query.get("offset") or ["0"])[0])
+      with self._lock:
+        return 200, {"items": self._devices[offset:offset + limit]}
+    m = _SNMP_CONFIG.match(path)
+    if m:
+      self._start(m.group(1))
+      return 200, {"community": "public"}
+    if path == "/internal/monitoring/inventory":
+      self._finish(str(body.get("deviceId")), True)
+    # Steps, metrics and anything else are accepted and only counted.
+    return 200, {"ok": True}
+
+  def _handler(self) -> type:
+    backend = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+
+      def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+      def _serve(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+          body = json.loads(raw) if raw else {}
+        except ValueError:
+          body = {}
+        url = urlparse(self.path)
+        status, payload = backend.handle(self.command, url.path, parse_qs(url.query), body if isinstance(body, dict) else {"items": body})
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      do_GET = do_POST = do_PATCH = do_PUT = _serve
+
+    return Handler
+
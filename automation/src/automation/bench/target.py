@@ -0,0 +1,35 @@
+import json
+import logging
+import resource
+import sys
+import time
+
+
+def _peak_rss_bytes() -> int:
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Kilobytes on Linux, bytes on macOS.
+  return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run(target: str) -> dict:
+  """One cycle of ``target`` in this process, configured from the environment."""
+  if target == "scheduler":
+    from automation.services import scheduler
+
+    started = time.perf_counter()
+    scheduler.run_once()
+  elif target == "snmp":
+    from automation.services import snmp_poller
+
+    started = time.perf_counter()
+    snmp_poller.run_once()
+  else:
+    raise ValueError(f"unknown target {target!r}")
+  return {"seconds": time.perf_counter() - started, "peak_rss_bytes": _peak_rss_bytes()}
+
+
+if __name__ == "__main__":
+  # Run by the harness in a fresh process per case, so the peak RSS it
+  # reports belongs to that case alone.
+  logging.basicConfig(level=logging.WARNING)
+  print(json.dumps(run(sys.argv[1])), flush=True)
@@ -1,15 +1,73 @@
+import os
+import threading
+from datetime import datetime, timezone
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from automation.clients.step_reporter import StepReporter, shared_step_reporter
 from automation.models import BackupResult
 
 
+_session_lock = threading.Lock()
+_shared_session: requests.Session | None = None
+
+
+def build_session(pool_maxsize: int = 32, retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+  # Connection errors are retried for every method (nothing reached the
+  # backend); 5xx responses only for idempotent GETs, so reports and steps
+  # are never posted twice.
+  retry = Retry(
+    total=retries,
+    connect=retries,
+    read=0,
+    status=retries,
+    backoff_factor=backoff_factor,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset(["GET", "HEAD"]),
+    raise_on_status=False,
+  )
+  adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry)
+  session = requests.Session()
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+
+def shared_session() -> requests.Session:
+  """Process-wide keep-alive session; urllib3's pool makes it safe across threads."""
+  global _shared_session
+  if _shared_session is None:
+    with _session_lock:
+      if _shared_session is None:
+        _shared_session = build_session(
+          pool_maxsize=int(os.environ.get("API_POOL_MAXSIZE", "32")),
+          retries=int(os.environ.get("API_RETRIES", "3")),
+          backoff_factor=float(os.environ.get("API_RETRY_BACKOFF_SECONDS", "0.5")),
+        )
+  return _shared_session
+
+
 class ApiClient:
-  def __init__(self, base_url: str, token: str, timeout_seconds: int = 10):
+  def __init__(
+    self,
+    base_url: str,
+    token: str,
+    timeout_seconds: int = 10,
+    session: requests.Session | None = None,
+    step_reporter: StepReporter | None = None,
+  ):
     self.base_url = base_url.rstrip("/")
     self.token = token
     self.timeout_seconds = timeout_seconds
+    self.session = session or shared_session()
+    # Steps are telemetry: by default they are queued and posted in batches
+    # off the backup's critical path. API_STEP_BATCHING=0 posts them inline.
+    if step_reporter is None and os.environ.get("API_STEP_BATCHING", "1") != "0":
+      step_reporter = shared_step_reporter(self.base_url, token, self.session, timeout_seconds)
+    self.step_reporter = step_reporter
 
   def _headers(self) -> dict:
     return {
@@ -17,12 +75,30 @@ class ApiClient:
       "Content-Type": "application/json",
     }
 
-  def report_backup_result(self, result: BackupResult) -> None:
-    url = f"{self.base_url}/internal/backups/report"
-    ts = result.backup_timestamp.replace(microsecond=0)
-    ts_str = ts.isoformat()
+  # Scheduler endpoints
+  def fetch_pending_jobs(self) -> list[dict]:
+    url = f"{self.base_url}/internal/jobs/pending"
+    response = self.session.get(url, headers=self._headers(), timeout=self.timeout_seconds)
+    response.raise_for_status()
+    return response.json().get("items", [])
+
+  def mark_job_status(self, execution_id: str, status: str) -> None:
+    url = f"{self.base_url}/internal/jobs/{execution_id}/status"
+    response = self.session.patch(url, json={"status": status}, headers=self._headers(), timeout=self.timeout_seconds)
+    response.raise_for_status()
+
+  @staticmethod
+  def _timestamp(result: BackupResult) -> str:
+    ts_str = result.backup_timestamp.replace(microsecond=0).isoformat()
     if ts_str.endswith("+00:00"):
       ts_str = ts_str[:-6] + "Z"
+    return ts_str
+
+  def report_backup_result(self, result: BackupResult) -> None:
+    if result.unchanged and result.success and self.report_backup_unchanged(result):
+      return
+    url = f"{self.base_url}/internal/backups/report"
+    ts_str = self._timestamp(result)
     payload = {
       "deviceId": result.device_id,
       "tenantId": result.tenant_id,
@@ -36,9 +112,33 @@ class ApiClient:
       "jobId": result.job_id,
       "executionId": result.execution_id,
     }
-    response = requests.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
+    response = self.session.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
     response.raise_for_status()
 
+  def report_backup_unchanged(self, result: BackupResult) -> bool:
+    """Record a run whose config matched the last stored version.
+
+    The backend links the execution to its latest backup instead of
+    inserting a new one. Returns False (409) when that backup does not have
+    this hash, e.g. after the backend lost it; the caller then sends the
+    full report, which is safe because the referenced file exists.
+    """
+    url = f"{self.base_url}/internal/backups/unchanged"
+    payload = {
+      "deviceId": result.device_id,
+      "tenantId": result.tenant_id,
+      "vendor": result.vendor,
+      "backupTimestamp": self._timestamp(result),
+      "configSha256": result.config_sha256,
+      "jobId": result.job_id,
+      "executionId": result.execution_id,
+    }
+    response = self.session.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
+    if response.status_code == 409:
+      return False
+    response.raise_for_status()
+    return True
+
   def report_step(self, device_id: str, execution_id: str | None, step_key: str, status: str, detail: str | None = None, meta: dict | None = None) -> None:
     url = f"{self.base_url}/internal/backups/step"
     payload = {
@@ -48,27 +148,45 @@ class ApiClient:
       "status": status,
       "detail": detail,
       "meta": meta or {},
+      "ts": datetime.now(timezone.utc).isoformat(),
     }
+    if self.step_reporter is not None:
+      self.step_reporter.submit(payload)
+      return
     try:
-      requests.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
+      self.session.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
     except Exception:
       pass
 
+  def flush_steps(self, timeout: float | None = None) -> None:
+    if self.step_reporter is not None:
+      self.step_reporter.flush(timeout)
+
   # Monitoring endpoints
   def list_active_devices(self, limit: int = 50, offset: int = 0) -> list[dict]:
     url = f"{self.base_url}/internal/monitoring/devices?limit={limit}&offset={offset}"
-    response = requests.get(url, headers=self._headers(), timeout=self.timeout_seconds)
+    response = self.session.get(url, headers=self._headers(), timeout=self.timeout_seconds)
     response.raise_for_status()
     data = response.json()
     return data.get("items", [])
 
   def get_snmp_config(self, device_id: str) -> dict:
     url = f"{self.base_url}/internal/monitoring/devices/{device_id}/snmp_config"
-    response = requests.get(url, headers=self._headers(), timeout=self.timeout_seconds)
+    response = self.session.get(url, headers=self._headers(), timeout=self.timeout_seconds)
     response.raise_for_status()
     return response.json()
 
-  def report_metrics(self, tenant_id: str, device_id: str, uptime_ticks: int | None, cpu_percent: int | None, mem_used_percent: int | None) -> None:
+  def report_metrics(
+    self,
+    tenant_id: str,
+    device_id: str,
+    uptime_ticks: int | None,
+    cpu_percent: int | None,
+    mem_used_percent: int | None,
+    status: str | None = None,
+    detail: str | None = None,
+  ) -> None:
+    """``status`` is "unreachable" or "circuit_open" (not polled) for a sample without values."""
     url = f"{self.base_url}/internal/monitoring/metrics"
     payload = {
       "tenantId": tenant_id,
@@ -77,7 +195,10 @@ class ApiClient:
       "cpuPercent": cpu_percent,
       "memUsedPercent": mem_used_percent,
     }
-    response = requests.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
+    if status is not None:
+      payload["status"] = status
+      payload["detail"] = detail
+    response = self.session.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
     response.raise_for_status()
 
   def report_inventory(self, tenant_id: str, device_id: str, model: str | None, firmware: str | None, serial: str | None) -> None:
@@ -89,5 +210,5 @@ class ApiClient:
       "firmware": firmware,
       "serial": serial,
     }
-    response = requests.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
+    response = self.session.post(url, json=payload, headers=self._headers(), timeout=self.timeout_seconds)
     response.raise_for_status()
@@ -0,0 +1,178 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List
+
+import requests
+
+
+class StepReporter:
+  """Background queue that posts backup steps to the backend in batches.
+
+  ``submit`` never blocks on the network. Steps are flushed every
+  ``flush_interval`` seconds or as soon as ``batch_size`` are queued. At most
+  ``max_queue`` steps are held in memory; beyond that they are appended to
+  ``spill_path`` (JSON lines) and replayed once the backend catches up, or
+  dropped when no spill path is configured.
+  """
+
+  def __init__(
+    self,
+    base_url: str,
+    headers: Callable[[], dict],
+    session: requests.Session,
+    timeout_seconds: int = 10,
+    batch_size: int = 200,
+    flush_interval: float = 1.0,
+    max_queue: int = 10000,
+    spill_path: Path | None = None,
+  ):
+    self.batch_url = f"{base_url}/internal/backups/steps"
+    self.single_url = f"{base_url}/internal/backups/step"
+    self.headers = headers
+    self.session = session
+    self.timeout_seconds = timeout_seconds
+    self.batch_size = max(1, batch_size)
+    self.flush_interval = flush_interval
+    self.max_queue = max(1, max_queue)
+    self.spill_path = spill_path
+    self.dropped = 0
+    self.spilled = 0
+    self._queue: Deque[Dict[str, Any]] = deque()
+    self._cond = threading.Condition()
+    self._in_flight = 0
+    self._closing = False
+    self._batch_supported = True
+    self._spill_lock = threading.Lock()
+    self._thread = threading.Thread(target=self._run, name="step-reporter", daemon=True)
+    self._thread.start()
+
+  def submit(self, payload: Dict[str, Any]) -> None:
+    with self._cond:
+      if self._closing:
+        return
+      if len(self._queue) >= self.max_queue:
+        self._overflow([payload])
+        return
+      self._queue.append(payload)
+      if len(self._queue) >= self.batch_size:
+        self._cond.notify_all()
+
+  def flush(self, timeout: float | None = None) -> bool:
+    """Block until everything queued so far has been sent (or given up on)."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._cond:
+      self._cond.notify_all()
+      while self._queue or self._in_flight:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          return False
+        self._cond.wait(remaining if remaining is not None else 0.5)
+    return True
+
+  def close(self, timeout: float = 5.0) -> None:
+    self.flush(timeout)
+    with self._cond:
+      self._closing = True
+      self._cond.notify_all()
+    self._thread.join(timeout)
+
+  def _overflow(self, items: List[Dict[str, Any]]) -> None:
+    if self.spill_path is None:
+      self.dropped += len(items)
+      return
+    try:
+      with self._spill_lock:
+        self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.spill_path.open("a", encoding="utf-8") as fh:
+          for item in items:
+            fh.write(json.dumps(item) + "\n")
+      self.spilled += len(items)
+    except Exception:
+      self.dropped += len(items)
+
+  def _run(self) -> None:
+    while True:
+      with self._cond:
+        if not self._queue and not self._closing:
+          self._cond.wait(self.flush_interval)
+        elif len(self._queue) < self.batch_size and not self._closing:
+          self._cond.wait(self.flush_interval)
+        if self._closing and not self._queue:
+          return
+        batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        self._in_flight = len(batch)
+      try:
+        if batch and not self._send(batch):
+          self._overflow(batch)
+        elif not batch:
+          self._replay_spill()
+      finally:
+        with self._cond:
+          self._in_flight = 0
+          self._cond.notify_all()
+
+  def _send(self, batch: List[Dict[str, Any]]) -> bool:
+    try:
+      if self._batch_supported:
+        response = self.session.post(self.batch_url, json={"items": batch}, headers=self.headers(), timeout=self.timeout_seconds)
+        if response.status_code in (404, 405):
+          # Older backend without the batch endpoint.
+          self._batch_supported = False
+        else:
+          # A 4xx means the payload itself is bad; retrying it cannot help.
+          return response.status_code < 500
+      for item in batch:
+        self.session.post(self.single_url, json=item, headers=self.headers(), timeout=self.timeout_seconds)
+      return True
+    except Exception:
+      return False
+
+  def _replay_spill(self) -> None:
+    if self.spill_path is None or not self.spill_path.exists():
+      return
+    # Several processes may share one spill file; each replays its own copy.
+    replay = self.spill_path.with_name(f"{self.spill_path.name}.replay-{os.getpid()}")
+    try:
+      with self._spill_lock:
+        os.replace(self.spill_path, replay)
+      with replay.open("r", encoding="utf-8") as fh:
+        items = [json.loads(line) for line in fh if line.strip()]
+      replay.unlink()
+    except Exception:
+      return
+    self.spilled -= min(self.spilled, len(items))
+    for start in range(0, len(items), self.batch_size):
+      batch = items[start:start + self.batch_size]
+      if not self._send(batch):
+        self._overflow(items[start:])
+        return
+
+
+_reporters_lock = threading.Lock()
+_reporters: Dict[tuple, StepReporter] = {}
+
+
+def shared_step_reporter(base_url: str, token: str, session: requests.Session, timeout_seconds: int = 10) -> StepReporter:
+  key = (base_url, token)
+  with _reporters_lock:
+    reporter = _reporters.get(key)
+    if reporter is None:
+      spill_dir = os.environ.get("STEP_REPORTER_SPILL_DIR")
+      reporter = StepReporter(
+        base_url,
+        lambda: {"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        session,
+        timeout_seconds=timeout_seconds,
+        batch_size=int(os.environ.get("STEP_REPORTER_BATCH_SIZE", "200")),
+        flush_interval=float(os.environ.get("STEP_REPORTER_FLUSH_SECONDS", "1.0")),
+        max_queue=int(os.environ.get("STEP_REPORTER_MAX_QUEUE", "10000")),
+        spill_path=Path(spill_dir) / "steps.jsonl" if spill_dir else None,
+      )
+      _reporters[key] = reporter
+      atexit.register(reporter.close)
+    return reporter
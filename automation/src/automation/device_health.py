@@ -0,0 +1,160 @@
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from automation.state_file import StateFile
+
+HEALTHY = "healthy"
+DEGRADED = "degraded"
+OPEN = "open"
+
+# What gate() tells the caller to do with a device.
+RUN = "run"
+SKIP = "skip"
+PROBE = "probe"
+
+
+class DeviceHealth:
+  """
+  Reachability circuit breaker per device, for one service ("backup", "snmp").
+
+  A device that cannot be reached turns degraded and, after
+  ``open_after`` consecutive failures, open: it is skipped without being
+  contacted until ``retry_at``. Then one cheap liveness probe decides. No
+  answer opens the circuit again for twice as long as before (up to
+  ``max_backoff_seconds``). An answer lets one attempt through, and that
+  attempt either closes the circuit or reopens it straight away. Any
+  success makes the device healthy again.
+
+  Callers only report a failure after their own liveness probe found the
+  device dead, so a device that answers but fails otherwise (bad
+  credentials, a broken config) never has its circuit opened.
+
+  Records live in a StateFile under "<service>:<device id>"; healthy
+  devices are not written at all.
+  """
+
+  def __init__(self, store: StateFile, service: str, open_after: int = 3, backoff_seconds: float = 300.0, max_backoff_seconds: float = 6 * 3600.0):
+    self.store = store
+    self.service = service
+    self.open_after = max(1, open_after)
+    self.backoff_seconds = backoff_seconds
+    self.max_backoff_seconds = max(backoff_seconds, max_backoff_seconds)
+
+  def _key(self, device_id: str) -> str:
+    return f"{self.service}:{device_id}"
+
+  def state(self, device_id: str) -> Dict[str, Any]:
+    return self.store.get(self._key(device_id)) or {"state": HEALTHY}
+
+  def gate(self, device_id: str) -> Tuple[str, Dict[str, Any]]:
+    """RUN, SKIP (the circuit is open) or PROBE (its backoff is over), with the device's state."""
+    record = self.state(device_id)
+    if record.get("state") != OPEN:
+      return RUN, record
+    if time.time() < float(record.get("retry_at", 0)):
+      return SKIP, record
+    return PROBE, record
+
+  def probed(self, device_id: str, alive: bool) -> Dict[str, Any]:
+    """Record the liveness probe's answer; returns the new state."""
+    record = self.state(device_id)
+    if not alive:
+      return self._open(device_id, record, "no answer to liveness probe")
+    # Half open: the next failure reopens the circuit at once.
+    record.update(state=DEGRADED, failures=self.open_after - 1)
+    self.store.put(self._key(device_id), record)
+    return record
+
+  def admit(self, device_id: str, probe: Callable[[], bool]) -> Optional[Dict[str, Any]]:
+    """None if the device may be contacted, else its open-circuit state (skip it)."""
+    verdict, record = self.gate(device_id)
+    if verdict == PROBE:
+      record = self.probed(device_id, probe())
+      verdict = SKIP if record["state"] == OPEN else RUN
+    return record if verdict == SKIP else None
+
+  def mark_up(self, device_id: str) -> None:
+    if self.state(device_id).get("state") != HEALTHY:
+      self.store.put(self._key(device_id), {"state": HEALTHY})
+
+  def mark_down(self, device_id: str, reason: str) -> Dict[str, Any]:
+    record = self.state(device_id)
+    failures = int(record.get("failures", 0)) + 1
+    if failures >= self.open_after:
+      return self._open(device_id, record, reason)
+    record.update(state=DEGRADED, failures=failures, reason=reason, since=record.get("since") or time.time())
+    self.store.put(self._key(device_id), record)
+    return record
+
+  def _open(self, device_id: str, record: Dict[str, Any], reason: str) -> Dict[str, Any]:
+    opens = int(record.get("opens", 0)) + 1
+    backoff = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (opens - 1))
+    record.update(
+      state=OPEN,
+      failures=max(int(record.get("failures", 0)), self.open_after),
+      opens=opens,
+      reason=reason,
+      since=record.get("since") or time.time(),
+      retry_at=time.time() + backoff,
+    )
+    self.store.put(self._key(device_id), record)
+    return record
+
+  def refresh(self) -> None:
+    self.store.refresh()
+
+  def flush(self) -> None:
+    self.store.flush()
+
+
+def tcp_alive(hosts: Iterable[str], port: int, timeout: float) -> bool:
+  """True if any of ``hosts`` accepts a TCP connection on ``port``."""
+  for host in hosts:
+    try:
+      socket.create_connection((host, port), timeout=timeout).close()
+      return True
+    except OSError:
+      continue
+  return False
+
+
+def probe_timeout() -> float:
+  return float(os.environ.get("CIRCUIT_PROBE_TIMEOUT_SECONDS", "3"))
+
+
+_health_lock = threading.Lock()
+_store: Optional[StateFile] = None
+_health: Dict[str, DeviceHealth] = {}
+
+
+def device_health(service: str) -> DeviceHealth:
+  """
+  Process-wide breaker for ``service``. DEVICE_HEALTH_PATH defaults to
+  $BACKUP_ROOT_DIR/.device-health.json and is shared by the services;
+  DEVICE_HEALTH_TTL_SECONDS=0 disables the breaker. A circuit opens after
+  CIRCUIT_OPEN_AFTER_FAILURES unreachable attempts for
+  CIRCUIT_BACKOFF_SECONDS, doubling up to CIRCUIT_MAX_BACKOFF_SECONDS.
+  """
+  global _store
+  health = _health.get(service)
+  if health is None:
+    with _health_lock:
+      if _store is None:
+        path = os.environ.get("DEVICE_HEALTH_PATH") or os.path.join(
+          os.environ.get("BACKUP_ROOT_DIR", "/data/backups"), ".device-health.json"
+        )
+        _store = StateFile(Path(path), float(os.environ.get("DEVICE_HEALTH_TTL_SECONDS", str(7 * 24 * 3600))))
+      health = _health.get(service)
+      if health is None:
+        health = _health[service] = DeviceHealth(
+          _store,
+          service,
+          int(os.environ.get("CIRCUIT_OPEN_AFTER_FAILURES", "3")),
+          float(os.environ.get("CIRCUIT_BACKOFF_SECONDS", "300")),
+          float(os.environ.get("CIRCUIT_MAX_BACKOFF_SECONDS", str(6 * 3600))),
+        )
+  return health
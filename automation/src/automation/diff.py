@@ -0,0 +1,260 @@
+import hashlib
+import json
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from automation.normalize import normalizer
+
+# "indent": IOS and Comware, where a line's children are the following lines
+# indented deeper; "!" and "#" lines only separate blocks.
+# "fortigate": "config ... end" and "edit ... next" blocks.
+DIALECTS = {
+  "cisco_ios": "indent",
+  "hp_comware": "indent",
+  "fortigate": "fortigate",
+}
+
+_SEPARATORS = ("!", "#")
+
+
+# Section boundaries in FortiGate output; everything between them is setting
+# lines. Led by the newline so the engine can skip ahead on that literal.
+_FORTIGATE_STRUCTURE = re.compile(r"\n[ \t]*(config [^\n]*|edit [^\n]*|end|next)[ \t\r]*(?=\n)")
+
+
+class Node:
+  """A section: its header line, its own setting lines and its subsections.
+
+  ``leaves`` holds the setting lines as raw text, one or more lines per
+  item; they are only split and keyed (``settings``) when a section differs
+  between two versions, so unchanged sections cost one digest comparison.
+  """
+
+  __slots__ = ("text", "leaves", "children", "digest")
+
+  def __init__(self, text: str):
+    self.text = text
+    self.leaves: List[str] = []
+    self.children: List["Node"] = []
+    self.digest = b""
+
+  def settings(self) -> List[str]:
+    out: List[str] = []
+    pending: Optional[str] = None
+    for raw in "\n".join(self.leaves).split("\n"):
+      if pending is not None:
+        # Continuation of a quoted multi-line value (certificates, scripts).
+        pending += "\n" + raw.rstrip("\r")
+        if not _open_quotes(pending):
+          out.append(pending)
+          pending = None
+        continue
+      text = raw.strip()
+      if not text:
+        continue
+      if '"' in text and _open_quotes(text):
+        pending = text
+      else:
+        out.append(text)
+    if pending is not None:
+      out.append(pending)
+    return out
+
+  def lines(self, depth: int = 0) -> List[str]:
+    out = ["  " * depth + leaf for leaf in self.settings()]
+    for child in self.children:
+      out.append("  " * depth + child.text)
+      out.extend(child.lines(depth + 1))
+    return out
+
+
+def _open_quotes(text: str) -> bool:
+  return (text.count('"') - text.count('\\"')) % 2 == 1
+
+
+def _seal(node: Node) -> bytes:
+  """Fill in subtree digests bottom-up: equal digests mean equal subtrees."""
+  h = hashlib.blake2b(node.text.encode("utf-8"), digest_size=16)
+  h.update(b"\0" + "\n".join(node.leaves).encode("utf-8"))
+  for child in node.children:
+    h.update(_seal(child))
+  node.digest = h.digest()
+  return node.digest
+
+
+def _parse_indent(text: str) -> Node:
+  root = Node("")
+  # (indent, section) for the open sections; the last line read becomes a
+  # section when the next line is indented deeper.
+  stack = [(-1, root)]
+  last_indent = -1
+  for raw in text.split("\n"):
+    line = raw.rstrip()
+    stripped = line.lstrip()
+    if not stripped or stripped in _SEPARATORS:
+      continue
+    indent = len(line) - len(stripped)
+    if indent > last_indent >= 0 and stack[-1][1].leaves:
+      parent = stack[-1][1]
+      node = Node(parent.leaves.pop())
+      parent.children.append(node)
+      stack.append((last_indent, node))
+    else:
+      while stack[-1][0] >= indent:
+        stack.pop()
+    stack[-1][1].leaves.append(stripped)
+    last_indent = indent
+  return root
+
+
+def _parse_fortigate(text: str) -> Node:
+  root = Node("")
+  stack = [root]
+  text = "\n" + text + "\n"
+  pos = 0
+  for m in _FORTIGATE_STRUCTURE.finditer(text):
+    segment = text[pos:m.start()]
+    if '"' in segment and _open_quotes(segment):
+      continue  # a line inside a quoted multi-line value
+    if segment:
+      stack[-1].leaves.append(segment)
+    word = m.group(1)
+    if word == "end" or word == "next":
+      if len(stack) > 1:
+        stack.pop()
+    else:
+      node = Node(word.rstrip() if word[-1] in " \t\r" else word)
+      stack[-1].children.append(node)
+      stack.append(node)
+    pos = m.end()
+  if pos < len(text):
+    stack[-1].leaves.append(text[pos:])
+  return root
+
+
+def _leaf_key(dialect: str, text: str) -> str:
+  # FortiGate settings are "set <name> <value>": keyed by name, a changed
+  # value is reported as a modification rather than remove + add.
+  if dialect == "fortigate" and (text.startswith("set ") or text.startswith("unset ")):
+    parts = text.split(" ", 2)
+    if len(parts) >= 2:
+      return "set " + parts[1]
+  return text
+
+
+def parse(text: str, vendor: str) -> Node:
+  """Parse a config into a tree whose sections carry subtree digests."""
+  root = _parse_fortigate(text) if DIALECTS.get(vendor) == "fortigate" else _parse_indent(text)
+  _seal(root)
+  return root
+
+
+def _block(node: Node) -> Dict[str, Any]:
+  change: Dict[str, Any] = {"line": node.text}
+  if node.leaves or node.children:
+    change["block"] = node.lines()
+  return change
+
+
+def _match(old: List[Any], new: List[Any], key) -> tuple:
+  """Pair items of ``old`` and ``new`` by key, in order for repeated keys.
+
+  Returns (pairs, removed, added, reordered).
+  """
+  buckets: Dict[str, List[int]] = {}
+  for i, item in enumerate(new):
+    buckets.setdefault(key(item), []).append(i)
+  taken: Dict[str, int] = {}
+  pairs = []
+  removed = []
+  used = set()
+  last = -1
+  reordered = False
+  for item in old:
+    k = key(item)
+    bucket = buckets.get(k)
+    n = taken.get(k, 0)
+    if bucket is not None and n < len(bucket):
+      taken[k] = n + 1
+      i = bucket[n]
+      used.add(i)
+      reordered = reordered or i < last
+      last = i
+      pairs.append((item, new[i]))
+    else:
+      removed.append(item)
+  added = [item for i, item in enumerate(new) if i not in used]
+  return pairs, removed, added, reordered
+
+
+def _diff(old: Node, new: Node, dialect: str, path: List[str], out: List[Dict[str, Any]]) -> None:
+  reordered = False
+  old_settings = old.settings()
+  new_settings = new.settings()
+  if old_settings != new_settings:
+    pairs, removed, added, reordered = _match(old_settings, new_settings, lambda t: _leaf_key(dialect, t))
+    for text in removed:
+      out.append({"op": "remove", "path": path, "line": text})
+    for text in added:
+      out.append({"op": "add", "path": path, "line": text})
+    for o, n in pairs:
+      if o != n:
+        out.append({"op": "modify", "path": path, "old": o, "new": n})
+  pairs, removed, added, children_reordered = _match(old.children, new.children, lambda node: node.text)
+  for node in removed:
+    out.append(dict(op="remove", path=path, **_block(node)))
+  for node in added:
+    out.append(dict(op="add", path=path, **_block(node)))
+  for o, n in pairs:
+    if o.digest != n.digest:
+      _diff(o, n, dialect, path + [n.text], out)
+  if reordered or children_reordered:
+    # Order matters in ACLs, route-maps and policies.
+    out.append({"op": "reorder", "path": path})
+
+
+def diff_trees(old: Node, new: Node, vendor: str) -> List[Dict[str, Any]]:
+  out: List[Dict[str, Any]] = []
+  if old.digest != new.digest:
+    _diff(old, new, DIALECTS.get(vendor, "indent"), [], out)
+  return out
+
+
+def diff_configs(old_text: str, new_text: str, vendor: str, normalize: bool = True) -> Dict[str, Any]:
+  """Structured change set between two versions of a device config.
+
+  ``changes`` holds add/remove (with the removed or added ``block`` for
+  sections), modify (a setting whose value changed) and reorder entries,
+  each with the ``path`` of section headers leading to it. With
+  ``normalize``, volatile lines are masked first (see automation.normalize),
+  so only meaningful changes show up.
+  """
+  if normalize:
+    norm = normalizer(vendor)
+    old_text = norm.mask(norm.strip(old_text.encode("utf-8"))).decode("utf-8", errors="replace")
+    new_text = norm.mask(norm.strip(new_text.encode("utf-8"))).decode("utf-8", errors="replace")
+  changes = [] if old_text == new_text else diff_trees(parse(old_text, vendor), parse(new_text, vendor), vendor)
+  stats = {op: 0 for op in ("add", "remove", "modify", "reorder")}
+  for change in changes:
+    stats[change["op"]] += 1
+  return {"vendor": vendor, "changes": changes, "stats": stats}
+
+
+def diff_files(old_path: Path, new_path: Path, vendor: str, normalize: bool = True) -> Dict[str, Any]:
+  """``diff_configs`` on two stored backups, whatever their storage layout."""
+  from automation.storage.filesystem import read_config_text
+  return diff_configs(read_config_text(old_path), read_config_text(new_path), vendor, normalize)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 4:
+    print("usage: python -m automation.diff VENDOR OLD NEW", file=sys.stderr)
+    sys.exit(2)
+  started = time.perf_counter()
+  result = diff_files(Path(sys.argv[2]), Path(sys.argv[3]), sys.argv[1])
+  result["seconds"] = round(time.perf_counter() - started, 3)
+  json.dump(result, sys.stdout, separators=(",", ":"))
+  sys.stdout.write("\n")
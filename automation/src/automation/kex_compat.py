@@ -4,19 +4,26 @@ Minimal SSH KEX compatibility layer for Paramiko/Netmiko.
 Scope: ONLY key-exchange (KEX) negotiation handling.
 Security note: Enabling legacy KEX (SHA-1 based DH groups) weakens security.
 This module enables legacy KEX per-connection and only as a fallback,
-never modifying Paramiko globals permanently.
+never modifying Paramiko or Netmiko globals.
 """
 
 from __future__ import annotations
 
-import contextlib
+import functools
+import json
+import os
 import re
 import socket
+import tempfile
 import threading
-from typing import Any, Optional
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
 
 import paramiko
 
+from automation import metrics
+
 # Legacy KEX algorithms required by some old devices.
 # Order matters: prefer group14 over group1 (group1 is weaker).
 LEGACY_KEX = [
@@ -24,7 +31,111 @@ LEGACY_KEX = [
     "diffie-hellman-group1-sha1",
 ]
 
-_patch_lock = threading.RLock()
+
+class KexCapabilityCache:
+    """
+    File-backed record of what worked per device endpoint ("host:port").
+
+    Fields are free-form; this module stores ``kex`` ("default" or "legacy"),
+    and vendor code adds e.g. the working host candidate or the CLI flavour.
+    Entries expire ``ttl_seconds`` after their last update so a firmware
+    upgrade is eventually picked up even if nothing fails.
+
+    The file is rewritten atomically and merged with what is on disk, so
+    several processes can share it; a lost concurrent update only costs one
+    extra fallback attempt.
+    """
+
+    def __init__(self, path: Optional[Path], ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._loaded = False
+
+    @staticmethod
+    def key(host: str, port: int) -> str:
+        return f"{host}:{port}"
+
+    def _read_file(self) -> Dict[str, Dict[str, Any]]:
+        if self.path is None:
+            return {}
+        try:
+            with self.path.open("r", encoding="utf-8") as fh:
+                data = json.load(fh)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - float(entry.get("updated_at", 0)) <= self.ttl_seconds
+
+    def get(self, host: str, port: int) -> Dict[str, Any]:
+        if self.ttl_seconds <= 0:
+            return {}
+        with self._lock:
+            if not self._loaded:
+                self._entries = self._read_file()
+                self._loaded = True
+            entry = self._entries.get(self.key(host, port))
+        if not entry or not self._fresh(entry):
+            return {}
+        return dict(entry)
+
+    def update(self, host: str, port: int, **fields: Any) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        key = self.key(host, port)
+        with self._lock:
+            current = self._entries.get(key, {})
+            if all(current.get(k) == v for k, v in fields.items()) and self._fresh(current):
+                return
+            on_disk = self._read_file()
+            merged = {k: v for k, v in on_disk.items() if self._fresh(v)}
+            merged.update({k: v for k, v in self._entries.items() if k not in merged and self._fresh(v)})
+            entry = dict(merged.get(key, {}))
+            entry.update(fields)
+            entry["updated_at"] = time.time()
+            merged[key] = entry
+            self._entries = merged
+            self._loaded = True
+            self._write(merged)
+
+    def _write(self, data: Dict[str, Dict[str, Any]]) -> None:
+        if self.path is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=".tmp-kex-")
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(data, fh)
+            os.replace(tmp, self.path)
+        except OSError:
+            # The cache is an optimisation; an unwritable path only loses it.
+            pass
+
+
+_cache_lock = threading.Lock()
+_cache: Optional[KexCapabilityCache] = None
+
+
+def kex_cache() -> KexCapabilityCache:
+    """
+    Process-wide cache. KEX_CACHE_PATH defaults to
+    $BACKUP_ROOT_DIR/.kex-cache.json; KEX_CACHE_TTL_SECONDS=0 disables it.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                path = os.environ.get("KEX_CACHE_PATH") or os.path.join(
+                    os.environ.get("BACKUP_ROOT_DIR", "/data/backups"), ".kex-cache.json"
+                )
+                _cache = KexCapabilityCache(
+                    Path(path),
+                    float(os.environ.get("KEX_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+                )
+    return _cache
 
 
 def _is_kex_failure(exc: BaseException) -> bool:
@@ -43,39 +154,88 @@ def _is_kex_failure(exc: BaseException) -> bool:
     return any(re.search(p, msg) for p in patterns)
 
 
-@contextlib.contextmanager
-def _temporary_transport_kex_patch(legacy_kex: list[str]):
+def _extend_kex(transport: paramiko.Transport, legacy_kex: list[str]) -> None:
+    """Append legacy KEX to one transport's proposal (secure defaults stay first)."""
+    try:
+        opts = transport.get_security_options()
+        kex = list(opts.kex)
+        for alg in legacy_kex:
+            if alg not in kex:
+                kex.append(alg)
+        opts.kex = kex
+    except Exception:
+        # If Paramiko internals change, fail safe by leaving defaults intact.
+        pass
+
+
+class _InstrumentedTransport(paramiko.Transport):
     """
-    Temporarily patch paramiko.Transport to include legacy KEX in its
-    per-connection security options. This is scoped and thread-protected.
+    Transport whose authentication is timed as the "auth" metrics stage, so
+    it is told apart from the TCP connect and KEX around it.
+    """
+
+    def auth_none(self, *args: Any, **kwargs: Any) -> Any:
+        with metrics.stage("auth"):
+            return super().auth_none(*args, **kwargs)
+
+    def auth_password(self, *args: Any, **kwargs: Any) -> Any:
+        with metrics.stage("auth"):
+            return super().auth_password(*args, **kwargs)
 
-    Security: This patch is applied only within the context manager and
-    reverted afterwards, minimizing global impact. While active, any Transport
-    created in this thread will include the legacy KEX list.
+    def auth_publickey(self, *args: Any, **kwargs: Any) -> Any:
+        with metrics.stage("auth"):
+            return super().auth_publickey(*args, **kwargs)
+
+    def auth_interactive(self, *args: Any, **kwargs: Any) -> Any:
+        with metrics.stage("auth"):
+            return super().auth_interactive(*args, **kwargs)
+
+
+def _legacy_kex_transport(sock: Any, **kwargs: Any) -> paramiko.Transport:
     """
-    with _patch_lock:
-        OriginalTransport = paramiko.Transport
+    ``transport_factory`` for ``SSHClient.connect`` (Paramiko >= 3.2).
 
-        class LegacyKexTransport(OriginalTransport):  # type: ignore[misc]
-            def __init__(self, *args: Any, **kwargs: Any) -> None:
-                super().__init__(*args, **kwargs)
-                try:
-                    opts = self.get_security_options()
-                    # Append legacy algorithms if missing (do not remove secure defaults).
-                    kex = list(opts.kex)
-                    for alg in legacy_kex:
-                        if alg not in kex:
-                            kex.append(alg)
-                    opts.kex = kex
-                except Exception:
-                    # If Paramiko internals change, fail safe by leaving defaults intact.
-                    pass
+    The legacy algorithms are set on this transport only, before the
+    handshake starts, so concurrent connections need no lock and never see
+    each other's options.
+    """
+    transport = _InstrumentedTransport(sock, **kwargs)
+    _extend_kex(transport, LEGACY_KEX)
+    return transport
 
-        paramiko.Transport = LegacyKexTransport  # type: ignore[assignment]
-        try:
-            yield
-        finally:
-            paramiko.Transport = OriginalTransport  # type: ignore[assignment]
+
+_netmiko_classes: Dict[tuple, type] = {}
+
+
+def _netmiko_class(device_type: str, legacy: bool) -> type:
+    """
+    Subclass of the Netmiko driver for ``device_type`` whose SSH client builds
+    its transport with ``_legacy_kex_transport`` (``legacy``) or the default
+    proposal, and whose session preparation is timed as "pager_disable".
+    """
+    cls = _netmiko_classes.get((device_type, legacy))
+    if cls is None:
+        from netmiko.ssh_dispatcher import ssh_dispatcher  # lazy import
+
+        base = ssh_dispatcher(device_type)
+        factory = _legacy_kex_transport if legacy else _InstrumentedTransport
+
+        class InstrumentedConnection(base):  # type: ignore[misc, valid-type]
+            def _build_ssh_client(self) -> paramiko.SSHClient:
+                client = super()._build_ssh_client()
+                client.connect = functools.partial(  # type: ignore[method-assign]
+                    client.connect, transport_factory=factory
+                )
+                return client
+
+            def session_preparation(self) -> None:
+                # Prompt discovery and paging/terminal setup.
+                with metrics.stage("pager_disable"):
+                    super().session_preparation()
+
+        InstrumentedConnection.__name__ = f"{'LegacyKex' if legacy else 'Instrumented'}{base.__name__}"
+        cls = _netmiko_classes.setdefault((device_type, legacy), InstrumentedConnection)
+    return cls
 
 
 def _paramiko_connect_default(
@@ -104,6 +264,7 @@ def _paramiko_connect_default(
         auth_timeout=auth_timeout,
         allow_agent=allow_agent,
         look_for_keys=look_for_keys,
+        transport_factory=_InstrumentedTransport,
     )
     transport = client.get_transport()
     assert transport is not None
@@ -124,18 +285,9 @@ def _paramiko_connect_with_legacy_kex(
     Security: Legacy SHA-1 based DH groups are enabled only for this connection.
     """
     sock = socket.create_connection((host, port), timeout=timeout)
-    transport = paramiko.Transport(sock)
+    transport = _InstrumentedTransport(sock)
     # Extend per-connection KEX proposals with legacy algorithms.
-    try:
-        opts = transport.get_security_options()
-        kex = list(opts.kex)
-        for alg in LEGACY_KEX:
-            if alg not in kex:
-                kex.append(alg)
-        opts.kex = kex
-    except Exception:
-        # If unable to set, proceed; Paramiko may already include legacy KEX.
-        pass
+    _extend_kex(transport, LEGACY_KEX)
 
     transport.start_client(timeout=timeout)
     if pkey is not None:
@@ -164,13 +316,17 @@ def connect_with_kex_fallback(
     mode: str = "paramiko",
     # Netmiko support: set device_type to use Netmiko. Example: "hp_comware", "cisco_ios"
     netmiko_device_type: Optional[str] = None,
+    cache: Optional[KexCapabilityCache] = None,
 ) -> Any:
     """
     Establish an SSH connection with KEX fallback.
 
     Behavior:
-    - First attempt uses default secure client behavior.
-    - On KEX mismatch, a second attempt is made enabling legacy KEX per-connection.
+    - First attempt uses default secure client behavior, unless the KEX
+      capability cache (``cache``, default ``kex_cache()``) records that this
+      host:port needed legacy KEX; then legacy KEX is tried first.
+    - On KEX mismatch, a second attempt is made with the other path, and the
+      path that worked is recorded.
 
     mode:
       - "paramiko": returns (SSHClient, Transport)
@@ -181,43 +337,31 @@ def connect_with_kex_fallback(
     if mode == "netmiko":
         if netmiko_device_type is None:
             raise ValueError("netmiko_device_type is required when mode='netmiko'")
-        try:
-            from netmiko import ConnectHandler  # lazy import
-        except Exception as e:
-            raise RuntimeError("Netmiko is not available") from e
+        params = dict(
+            device_type=netmiko_device_type,
+            host=host,
+            port=port,
+            username=username,
+            password=password,
+            # Netmiko uses conn_timeout/banner_timeout/auth_timeout for connection phases.
+            conn_timeout=timeout,
+            banner_timeout=banner_timeout,
+            auth_timeout=auth_timeout,
+        )
+        return netmiko_connect_with_kex_fallback(params, cache=cache)
 
-        # First attempt: default Netmiko (Paramiko under the hood) with secure defaults.
-        try:
-            return ConnectHandler(
-                device_type=netmiko_device_type,
+    # Paramiko mode
+    def paramiko_connect(legacy: bool) -> Any:
+        if legacy:
+            return _paramiko_connect_with_legacy_kex(
                 host=host,
                 port=port,
                 username=username,
                 password=password,
-                # Netmiko uses conn_timeout/banner_timeout/auth_timeout for connection phases.
-                conn_timeout=timeout,
-                banner_timeout=banner_timeout,
-                auth_timeout=auth_timeout,
+                pkey=pkey,
+                timeout=timeout,
             )
-        except Exception as e:
-            if not _is_kex_failure(e):
-                raise
-            # Second attempt: temporarily patch Transport to include legacy KEX.
-            with _temporary_transport_kex_patch(LEGACY_KEX):
-                return ConnectHandler(
-                    device_type=netmiko_device_type,
-                    host=host,
-                    port=port,
-                    username=username,
-                    password=password,
-                    conn_timeout=timeout,
-                    banner_timeout=banner_timeout,
-                    auth_timeout=auth_timeout,
-                )
-
-    # Paramiko mode
-    try:
-        client, transport = _paramiko_connect_default(
+        return _paramiko_connect_default(
             host=host,
             port=port,
             username=username,
@@ -229,16 +373,44 @@ def connect_with_kex_fallback(
             allow_agent=allow_agent,
             look_for_keys=look_for_keys,
         )
-        return client, transport
+
+    return _connect_known_path(host, port, cache, paramiko_connect)
+
+
+def netmiko_connect_with_kex_fallback(params: Dict[str, Any], cache: Optional[KexCapabilityCache] = None) -> Any:
+    """
+    ``ConnectHandler(**params)`` with the same KEX fallback and cache as
+    ``connect_with_kex_fallback``; ``params`` are passed to Netmiko unchanged.
+    """
+    try:
+        import netmiko  # noqa: F401  (lazy import)
+    except Exception as e:
+        raise RuntimeError("Netmiko is not available") from e
+
+    def netmiko_connect(legacy: bool) -> Any:
+        # What ConnectHandler would build, with the instrumented transport.
+        return _netmiko_class(params["device_type"], legacy)(**params)
+
+    return _connect_known_path(params["host"], int(params.get("port") or 22), cache, netmiko_connect)
+
+
+def _connect_known_path(host: str, port: int, cache: Optional[KexCapabilityCache], connect: Any) -> Any:
+    """
+    Try the KEX path remembered for host:port first, then the other one on a
+    KEX failure, and remember whichever succeeded.
+    """
+    cache = cache if cache is not None else kex_cache()
+    legacy_first = cache.get(host, port).get("kex") == "legacy"
+    try:
+        result = connect(legacy_first)
     except Exception as e:
         if not _is_kex_failure(e):
             raise
-        client, transport = _paramiko_connect_with_legacy_kex(
-            host=host,
-            port=port,
-            username=username,
-            password=password,
-            pkey=pkey,
-            timeout=timeout,
-        )
-        return client, transport
+        # A cached "legacy" may be stale after an upgrade that dropped SHA-1
+        # groups; retrying with defaults covers that as well. The legacy path
+        # still offers the secure algorithms first, so going there directly
+        # does not downgrade a device that supports them.
+        result = connect(not legacy_first)
+        legacy_first = not legacy_first
+    cache.update(host, port, kex="legacy" if legacy_first else "default")
+    return result
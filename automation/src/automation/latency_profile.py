@@ -0,0 +1,123 @@
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from automation.state_file import StateFile
+
+# Smoothing of TCP's retransmission timer (RFC 6298), with a faster gain:
+# a device is sampled once per backup, not once per round trip.
+_ALPHA = 0.25
+_BETA = 0.25
+
+# The stages (see automation.metrics) of the two phases a deadline covers.
+CONNECT_STAGES = ("connect", "auth", "pager_disable")
+READ_STAGES = ("config_read", "normalize", "hash", "write")
+
+
+def _smooth(entry: Dict[str, Any], field: str, sample: float) -> None:
+  mean = entry.get(field)
+  if mean is None:
+    entry[field] = sample
+    entry[field + "_dev"] = sample / 2
+    return
+  entry[field + "_dev"] = (1 - _BETA) * float(entry.get(field + "_dev", 0.0)) + _BETA * abs(sample - mean)
+  entry[field] = (1 - _ALPHA) * mean + _ALPHA * sample
+
+
+class LatencyProfiles:
+  """
+  Rolling latency profile per device: smoothed connect time, read time
+  (with their mean deviations) and config size.
+
+  Each phase's deadline is ``headroom * (mean + 4 * deviation)`` clamped
+  to [min_seconds, max_seconds], so a steady LAN switch gets a tight
+  deadline and a slow or erratic WAN device a long one. The read deadline
+  is never shorter than the smoothed config size at ``min_read_rate``
+  bytes/s, so a device whose read times have been fast does not fail
+  every backup while it is busy. A device without a profile has no
+  deadlines and keeps the static DEVICE_TIMEOUT_SECONDS.
+  Profiles are kept in a StateFile shared by the scheduler's processes.
+  """
+
+  def __init__(self, store: StateFile, min_seconds: float, max_seconds: float, headroom: float = 1.5, min_read_rate: float = 50_000.0):
+    self.store = store
+    self.min_seconds = min_seconds
+    self.max_seconds = max(min_seconds, max_seconds)
+    self.headroom = headroom
+    self.min_read_rate = min_read_rate
+
+  @property
+  def enabled(self) -> bool:
+    return self.store.enabled
+
+  def refresh(self) -> None:
+    self.store.refresh()
+
+  def flush(self) -> None:
+    self.store.flush()
+
+  def _deadline(self, entry: Dict[str, Any], field: str, floor: float = 0.0) -> float:
+    estimate = self.headroom * (float(entry[field]) + 4 * float(entry.get(field + "_dev", 0.0)))
+    return min(self.max_seconds, max(self.min_seconds, floor, estimate))
+
+  def deadlines(self, device_id: str, connect_ceiling: float) -> Optional[Tuple[float, float]]:
+    """(connect, read) deadlines in seconds, or None without a full profile.
+
+    The connect deadline only ever tightens ``connect_ceiling``, the static
+    timeout, so an unreachable device holds a worker no longer than before.
+    """
+    entry = self.store.get(device_id)
+    if entry.get("connect") is None or entry.get("read") is None:
+      return None
+    size_floor = float(entry.get("size") or 0) / self.min_read_rate if self.min_read_rate > 0 else 0.0
+    return min(connect_ceiling, self._deadline(entry, "connect")), self._deadline(entry, "read", size_floor)
+
+  def expected(self, device_id: str) -> Optional[Tuple[float, int]]:
+    """(smoothed connect + read seconds, smoothed config bytes), or None if unknown."""
+    entry = self.store.get(device_id)
+    if entry.get("connect") is None and entry.get("read") is None:
+      return None
+    return float(entry.get("connect") or 0.0) + float(entry.get("read") or 0.0), int(entry.get("size") or 0)
+
+  def observe(self, device_id: str, connect: Optional[float] = None, read: Optional[float] = None, size: Optional[int] = None) -> None:
+    if not self.enabled:
+      return
+    entry = self.store.get(device_id)
+    if connect is not None:
+      _smooth(entry, "connect", connect)
+    if read is not None:
+      _smooth(entry, "read", read)
+    if size:
+      entry["size"] = size if entry.get("size") is None else (1 - _ALPHA) * entry["size"] + _ALPHA * size
+    self.store.put(device_id, entry)
+
+
+_profiles_lock = threading.Lock()
+_profiles: Optional[LatencyProfiles] = None
+
+
+def latency_profiles() -> LatencyProfiles:
+  """
+  Process-wide profiles. LATENCY_PROFILE_PATH defaults to
+  $BACKUP_ROOT_DIR/.latency-profiles.json; LATENCY_PROFILE_TTL_SECONDS=0
+  disables adaptive deadlines and ordering. Deadlines are at least
+  DEVICE_TIMEOUT_MIN_SECONDS and read deadlines at most
+  DEVICE_TIMEOUT_MAX_SECONDS, and long enough to read the device's config
+  at DEVICE_READ_MIN_BYTES_PER_SECOND.
+  """
+  global _profiles
+  if _profiles is None:
+    with _profiles_lock:
+      if _profiles is None:
+        path = os.environ.get("LATENCY_PROFILE_PATH") or os.path.join(
+          os.environ.get("BACKUP_ROOT_DIR", "/data/backups"), ".latency-profiles.json"
+        )
+        _profiles = LatencyProfiles(
+          StateFile(Path(path), float(os.environ.get("LATENCY_PROFILE_TTL_SECONDS", str(30 * 24 * 3600)))),
+          float(os.environ.get("DEVICE_TIMEOUT_MIN_SECONDS", "5")),
+          float(os.environ.get("DEVICE_TIMEOUT_MAX_SECONDS", "600")),
+          float(os.environ.get("DEVICE_TIMEOUT_HEADROOM", "1.5")),
+          float(os.environ.get("DEVICE_READ_MIN_BYTES_PER_SECOND", "50000")),
+        )
+  return _profiles
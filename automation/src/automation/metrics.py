@@ -0,0 +1,205 @@
+import bisect
+import contextlib
+import contextvars
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Per-device timings. A device's work runs inside ``device(...)``; code on
+# the way marks what it is doing with ``stage(name)``. Stages nest like a
+# profiler's frames: entering one pauses the enclosing stage, so each
+# stage's time is its own and the stages of a device add up to its wall
+# time (time outside any stage counts as "other"). When the device is done
+# every stage's total is observed once into ``STAGE_SECONDS``.
+#
+# Backup stages: connect (TCP, KEX including the legacy fallback), auth,
+# pager_disable (session preparation and paging/console setup), config_read,
+# normalize, hash, write, index (search index) and report. SNMP stages:
+# config, snmp and report.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Histogram:
+  """Prometheus-style histogram with fixed buckets, one series per label set."""
+
+  def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self.buckets = tuple(sorted(buckets))
+    self._lock = threading.Lock()
+    # labels -> [per-bucket counts (the last one is +Inf), sum]
+    self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+  def observe(self, value: float, *labels: str) -> None:
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      series = self._series.get(labels)
+      if series is None:
+        series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+      series[0][i] += 1
+      series[1] += value
+
+  def render(self) -> List[str]:
+    out = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+    with self._lock:
+      series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+    for labels, counts, total in series:
+      pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, labels))
+      sep = "," if pairs else ""
+      cumulative = 0
+      for bound, count in zip(self.buckets + (float("inf"),), counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        out.append(f'{self.name}_bucket{{{pairs}{sep}le="{le}"}} {cumulative}')
+      out.append(f"{self.name}_sum{{{pairs}}} {total}")
+      out.append(f"{self.name}_count{{{pairs}}} {cumulative}")
+    return out
+
+
+STAGE_SECONDS = Histogram(
+  "netcfg_stage_seconds",
+  "Time a device spent in each stage of a backup or SNMP poll.",
+  ("service", "stage", "vendor", "tenant"),
+)
+DEVICE_SECONDS = Histogram(
+  "netcfg_device_seconds",
+  "Wall time of one device's backup or SNMP poll.",
+  ("service", "vendor", "tenant"),
+)
+REGISTRY: List[Histogram] = [STAGE_SECONDS, DEVICE_SECONDS]
+
+
+def render() -> str:
+  return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def record(service: str, vendor: str, tenant: str, stages: Dict[str, float], total: float) -> None:
+  for name, seconds in stages.items():
+    STAGE_SECONDS.observe(seconds, service, name, vendor, tenant)
+  DEVICE_SECONDS.observe(total, service, vendor, tenant)
+
+
+# Where finished devices go; the scheduler's worker processes forward them
+# to the supervisor, which serves the endpoint.
+_sink: Callable[[str, str, str, Dict[str, float], float], None] = record
+
+
+def set_sink(sink: Callable[[str, str, str, Dict[str, float], float], None]) -> None:
+  global _sink
+  _sink = sink
+
+
+class _Clock:
+  __slots__ = ("stages", "current", "since")
+
+  def __init__(self) -> None:
+    self.stages: Dict[str, float] = {}
+    self.current = "other"
+    self.since = time.perf_counter()
+
+  def spent(self, stages: Iterable[str]) -> float:
+    """Time so far in ``stages``, including the one in progress."""
+    names = set(stages)
+    total = sum(seconds for name, seconds in self.stages.items() if name in names)
+    if self.current in names:
+      total += time.perf_counter() - self.since
+    return total
+
+  def switch(self, stage: str) -> str:
+    now = time.perf_counter()
+    self.stages[self.current] = self.stages.get(self.current, 0.0) + (now - self.since)
+    previous, self.current, self.since = self.current, stage, now
+    return previous
+
+
+_clock: contextvars.ContextVar[Optional[_Clock]] = contextvars.ContextVar("netcfg_metrics_clock", default=None)
+
+
+@contextlib.contextmanager
+def device(service: str, vendor: str, tenant: str) -> Iterator[_Clock]:
+  """Time one device's work; yields its clock (stage totals and the current stage)."""
+  clock = _Clock()
+  started = clock.since
+  token = _clock.set(clock)
+  try:
+    yield clock
+  finally:
+    _clock.reset(token)
+    clock.switch(clock.current)
+    try:
+      _sink(service, vendor or "unknown", tenant or "unknown", dict(clock.stages), time.perf_counter() - started)
+    except Exception:
+      logger.debug("dropping device timings", exc_info=True)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+  clock = _clock.get()
+  if clock is None:
+    yield
+    return
+  previous = clock.switch(name)
+  try:
+    yield
+  finally:
+    clock.switch(previous)
+
+
+def timed(name: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+  """Pass ``chunks`` on, counting the time spent producing them as ``name``."""
+  it = iter(chunks)
+  while True:
+    with stage(name):
+      chunk = next(it, None)
+    if chunk is None:
+      return
+    yield chunk
+
+
+class _Handler(BaseHTTPRequestHandler):
+  def do_GET(self) -> None:
+    if self.path.split("?")[0] != "/metrics":
+      self.send_error(404)
+      return
+    body = render().encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format: str, *args: Any) -> None:
+    pass
+
+
+def serve(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+  """Serve ``/metrics`` on a daemon thread."""
+  server = ThreadingHTTPServer((host, port), _Handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+  return server
+
+
+def serve_from_env() -> Optional[ThreadingHTTPServer]:
+  """Start the endpoint on METRICS_PORT (unset or 0: disabled)."""
+  port = int(os.environ.get("METRICS_PORT", "0"))
+  if port <= 0:
+    return None
+  try:
+    server = serve(port, os.environ.get("METRICS_HOST", "0.0.0.0"))
+  except OSError:
+    logger.exception("cannot serve metrics on port %d", port)
+    return None
+  logger.info("serving metrics on :%d/metrics", port)
+  return server
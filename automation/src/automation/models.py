@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 
 @dataclass
@@ -15,6 +15,10 @@ class DeviceConnectionInfo:
   password: str
   secret: Optional[str] = None
   timeout: int = 30
+  # Deadline for reading the config; None leaves it to the vendor runner.
+  read_timeout: Optional[float] = None
+  # Hosts that answered the pre-flight sweep, in the order to try them.
+  candidates: Optional[List[str]] = None
 
 
 @dataclass
@@ -30,3 +34,23 @@ class BackupResult:
   error_message: Optional[str] = None
   job_id: Optional[str] = None
   execution_id: Optional[str] = None
+  # Set when the config matched the last stored version and was not written again.
+  unchanged: bool = False
+
+
+@dataclass
+class CycleStats:
+  jobs_total: int = 0
+  succeeded: int = 0
+  failed: int = 0
+  timed_out: int = 0
+  # Timed-out runners that did not exit and were left running (counted in timed_out too).
+  leaked: int = 0
+  skipped: int = 0
+  wall_seconds: float = 0.0
+
+  @property
+  def devices_per_second(self) -> float:
+    if self.wall_seconds <= 0:
+      return 0.0
+    return self.jobs_total / self.wall_seconds
@@ -0,0 +1,192 @@
+import re
+import sys
+import time
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+# "strip" rules are applied to the config before it is stored: terminal
+# artifacts and comment lines that say nothing about the configuration.
+# "mask" rules are applied on top of those only when configs are compared
+# (normalized hashing, diffs): they cover lines that change on every export
+# but must stay in the stored file for it to be restorable, such as the
+# FortiGate config header and ENC secrets.
+#
+# Line rules match top-level lines (column 0). Those of a set compile into
+# one deletion pattern led by the newline before the line, so the regex
+# engine can skip ahead on that literal;
+# inline rules only run when their trigger bytes occur.
+
+# Pager prompts left in the output, with the cursor moves and blanks the
+# device uses to erase them (Comware "  ---- More ----\x1b[16D ... \x1b[16D",
+# ProCurve "-- MORE --, next page: Space, ..."). They are found by their
+# literal text; the pattern is then matched from the blanks before them.
+_PAGER = re.compile(rb"[ \t-]*(?i:more) ?-+(?:, next page[^\n\x1b]*)?(?:[ \t]*(?:\x1b\[[0-9;?]*[A-Za-z]|\x08))*")
+_PAGER_WORD = re.compile(rb"[Mm](?:ore|ORE) -")
+_ESCAPES = re.compile(rb"\x1b\[[0-9;?]*[A-Za-z]|\x08+")
+_CR_BEFORE_LF = re.compile(rb"\r+(?=\n)")
+
+STRIP_LINES: Dict[str, Sequence[bytes]] = {
+  "cisco_ios": (
+    rb"Building configuration\.\.\.",
+    rb"Current configuration : \d+ bytes",
+    rb"! Last configuration change at ",
+    rb"! NVRAM config last updated at ",
+    rb"! No configuration change since last restart",
+  ),
+}
+
+MASK_LINES: Dict[str, Sequence[bytes]] = {
+  "cisco_ios": (
+    rb"ntp clock-period ",
+  ),
+  "fortigate": (
+    rb"#config-version=",
+    rb"#conf_file_ver=",
+  ),
+}
+
+# (trigger, pattern, replacement) applied within lines when comparing;
+# FortiGate re-encrypts ENC secrets with a fresh salt on every export.
+MASK_INLINE: Dict[str, Sequence[Tuple[bytes, bytes, bytes]]] = {
+  "fortigate": (
+    (b" ENC ", rb" ENC \S+", b" ENC "),
+  ),
+}
+
+
+def _line_rule(patterns: Sequence[bytes]) -> Optional["re.Pattern[bytes]"]:
+  if not patterns:
+    return None
+  return re.compile(rb"\n(?:" + b"|".join(patterns) + rb")[^\n]*")
+
+
+def _drop_lines(rule: Optional["re.Pattern[bytes]"], block: bytes) -> bytes:
+  if rule is None:
+    return block
+  # ``block`` starts at a line start; lead it with a newline so the first
+  # line matches like every other, and take that newline off again.
+  return rule.sub(b"", b"\n" + block)[1:]
+
+
+def _drop_pagers(block: bytes) -> bytes:
+  out = []
+  pos = 0
+  for word in _PAGER_WORD.finditer(block):
+    if word.start() < pos:
+      continue
+    start = word.start()
+    while start > pos and block[start - 1] in b" \t-":
+      start -= 1
+    if b"-" not in block[start:word.start()]:
+      continue
+    m = _PAGER.match(block, start)
+    out.append(block[pos:start])
+    pos = m.end()
+  if not out:
+    return block
+  out.append(block[pos:])
+  return b"".join(out)
+
+
+class ConfigNormalizer:
+  """Vendor-specific cleanup of captured configs; see the rule tables above."""
+
+  def __init__(self, vendor: str):
+    self.vendor = vendor
+    self._strip_lines = _line_rule(STRIP_LINES.get(vendor, ()))
+    self._mask_lines = _line_rule(MASK_LINES.get(vendor, ()))
+    self._mask_inline = [(trigger, re.compile(pattern), repl) for trigger, pattern, repl in MASK_INLINE.get(vendor, ())]
+
+  def strip(self, block: bytes) -> bytes:
+    """Clean ``block``, which must start at the start of a line."""
+    if b"ore -" in block or b"ORE -" in block:
+      block = _drop_pagers(block)
+    if b"\x1b" in block or b"\x08" in block:
+      block = _ESCAPES.sub(b"", block)
+    if b"\r" in block:
+      block = block.replace(b"\r\n", b"\n")
+      if b"\r\n" in block:
+        block = _CR_BEFORE_LF.sub(b"", block)
+    return _drop_lines(self._strip_lines, block)
+
+  def mask(self, block: bytes) -> bytes:
+    """``block`` (already stripped) as it is compared with other versions."""
+    block = _drop_lines(self._mask_lines, block)
+    for trigger, pattern, repl in self._mask_inline:
+      if trigger in block:
+        block = pattern.sub(repl, block)
+    return block
+
+  def stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Strip ``chunks`` on the fly, a block of complete lines at a time."""
+    tail = b""
+    for chunk in chunks:
+      data = tail + chunk
+      cut = data.rfind(b"\n") + 1
+      tail = data[cut:]
+      if cut:
+        out = self.strip(data[:cut])
+        if out:
+          yield out
+    if tail:
+      out = self.strip(tail)
+      if out:
+        yield out
+
+  def normalize(self, text: str) -> str:
+    return self.strip(text.encode("utf-8")).decode("utf-8", errors="replace")
+
+
+_normalizers: Dict[str, ConfigNormalizer] = {}
+
+
+def normalizer(vendor: str) -> ConfigNormalizer:
+  found = _normalizers.get(vendor)
+  if found is None:
+    found = _normalizers[vendor] = ConfigNormalizer(vendor)
+  return found
+
+
+def _sample(vendor: str, size: int) -> bytes:
+  if vendor == "cisco_ios":
+    head = b"Building configuration...\r\n\r\nCurrent configuration : 123456 bytes\r\n!\r\n! Last configuration change at 10:00:01 UTC Mon Oct 12 2026\r\n!\r\nntp clock-period 17179869\r\n"
+    block = b"interface GigabitEthernet0/%d\r\n description uplink %d\r\n switchport mode trunk\r\n no shutdown\r\n!\r\n"
+  elif vendor == "fortigate":
+    head = b"#config-version=FGT60E-6.4.5-FW-build1828-210217:opmode=0:vdom=0:user=admin\n#conf_file_ver=4242\n"
+    block = b"config user local\n    edit \"user%d\"\n        set passwd ENC SH2q8Gk%dAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=\n    next\nend\n"
+  else:
+    head = b"display current-configuration\r\n"
+    block = b"interface GigabitEthernet1/0/%d\r\n description port %d\r\n port link-type trunk\r\n#\r\n"
+  out = [head]
+  total = len(head)
+  i = 0
+  while total < size:
+    part = block % (i, i) if block.count(b"%d") == 2 else block
+    if vendor == "hp_comware" and i % 500 == 499:
+      part += b"  ---- More ----\x1b[16D                \x1b[16D"
+    out.append(part)
+    total += len(part)
+    i += 1
+  return b"".join(out)
+
+
+def benchmark(size_mb: float = 5.0, chunk_size: int = 65536) -> None:
+  """Print stream and mask throughput per vendor on a synthetic config."""
+  for vendor in ("cisco_ios", "fortigate", "hp_comware"):
+    data = _sample(vendor, int(size_mb * 1024 * 1024))
+    norm = normalizer(vendor)
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    started = time.perf_counter()
+    stripped = b"".join(norm.stream(chunks))
+    strip_s = time.perf_counter() - started
+    started = time.perf_counter()
+    norm.mask(stripped)
+    mask_s = time.perf_counter() - started
+    mb = len(data) / (1024 * 1024)
+    print(
+      f"{vendor:<11} {mb:6.1f} MB  strip {mb / strip_s:7.1f} MB/s  mask {mb / mask_s:7.1f} MB/s"
+      f"  ({len(data) - len(stripped)} bytes stripped)"
+    )
+
+
+if __name__ == "__main__":
+  benchmark(float(sys.argv[1]) if len(sys.argv) > 1 else 5.0)
@@ -0,0 +1,66 @@
+import asyncio
+import socket
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+  import resource
+except Exception:
+  resource = None
+
+Target = Tuple[str, int]
+
+# Descriptors left for everything else the process has open.
+_FD_RESERVE = 256
+
+
+def _fd_budget() -> int:
+  if resource is None:
+    return 1024
+  soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft == resource.RLIM_INFINITY:
+    return 1 << 16
+  return max(1, soft - _FD_RESERVE)
+
+
+async def _connect(host: str, port: int, timeout: float) -> Optional[str]:
+  try:
+    _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+  except asyncio.TimeoutError:
+    return f"timed out after {timeout:g}s"
+  except ConnectionRefusedError:
+    return "connection refused"
+  except socket.gaierror as exc:
+    return f"cannot resolve host ({exc.strerror or exc})"
+  except OSError as exc:
+    return (exc.strerror or str(exc)).lower()
+  writer.close()
+  try:
+    await writer.wait_closed()
+  except OSError:
+    pass
+  return None
+
+
+async def _sweep(targets: List[Target], timeout: float, concurrency: int) -> Dict[Target, Optional[str]]:
+  sem = asyncio.Semaphore(concurrency)
+
+  async def one(target: Target) -> Tuple[Target, Optional[str]]:
+    async with sem:
+      return target, await _connect(target[0], target[1], timeout)
+
+  return dict(await asyncio.gather(*(one(t) for t in targets)))
+
+
+def sweep(targets: Iterable[Target], timeout: float, concurrency: int) -> Dict[Target, Optional[str]]:
+  """
+  Open a TCP connection to every (host, port), up to ``concurrency`` at a
+  time on one event loop, and close it again straight away.
+
+  Returns None for each target that accepted, else why it did not
+  ("connection refused", "timed out after 3s", ...). Concurrency is
+  capped by the open-file limit.
+  """
+  unique = list(dict.fromkeys(targets))
+  if not unique:
+    return {}
+  return asyncio.run(_sweep(unique, timeout, max(1, min(concurrency, _fd_budget()))))
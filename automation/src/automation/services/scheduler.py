@@ -1,13 +1,21 @@
+import contextvars
+import logging
+import math
 import os
+import threading
 import time
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Tuple
 
-import requests
 from datetime import datetime, timezone
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 
+from automation import metrics
 from automation.clients.api_client import ApiClient
-from automation.models import DeviceConnectionInfo, BackupResult
+from automation.device_health import SKIP, device_health, probe_timeout, tcp_alive
+from automation.latency_profile import CONNECT_STAGES, READ_STAGES, latency_profiles
+from automation.models import DeviceConnectionInfo, BackupResult, CycleStats
+from automation.preflight import sweep
+from automation.ssh_pool import SessionScope, session_scope
 from automation.vendors.fortigate import run_fortigate_backup
 from automation.vendors.cisco_ios import run_cisco_ios_backup
 from automation.vendors.hp_comware import run_hp_comware_backup
@@ -16,34 +24,78 @@ from automation.vendors.hp_comware import run_hp_comware_backup
 API_BASE_URL = os.environ.get("API_BASE_URL", "http://127.0.0.1:3001")
 API_TOKEN = os.environ["AUTOMATION_SERVICE_TOKEN"]
 BACKUP_ROOT_DIR = os.environ.get("BACKUP_ROOT_DIR", "/data/backups")
+# 0 disables the per-tenant / per-vendor caps.
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "16"))
+SCHEDULER_TENANT_CONCURRENCY = int(os.environ.get("SCHEDULER_TENANT_CONCURRENCY", "0"))
+SCHEDULER_VENDOR_CONCURRENCY = int(os.environ.get("SCHEDULER_VENDOR_CONCURRENCY", "0"))
+# More than 1 runs jobs in that many worker processes (see scheduler_supervisor);
+# 0 means one per CPU.
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", "1"))
+# Parallel TCP connects in the pre-flight sweep of each cycle; 0 disables it.
+PREFLIGHT_CONCURRENCY = int(os.environ.get("PREFLIGHT_CONCURRENCY", "2000"))
+PREFLIGHT_TIMEOUT_SECONDS = float(os.environ.get("PREFLIGHT_TIMEOUT_SECONDS", "3"))
+# How long a timed-out runner may take to exit once its sessions are closed;
+# after that it is left behind (leaked) and its slot goes to the next job.
+RUNNER_EXIT_GRACE_SECONDS = float(os.environ.get("RUNNER_EXIT_GRACE_SECONDS", "30"))
 
+RUNNERS: Dict[str, Callable[..., BackupResult]] = {
+  "fortigate": run_fortigate_backup,
+  "cisco_ios": run_cisco_ios_backup,
+  "hp_comware": run_hp_comware_backup,
+}
 
-def fetch_pending_jobs() -> List[Dict[str, Any]]:
+logger = logging.getLogger(__name__)
+
+
+def fetch_pending_jobs(client: ApiClient) -> List[Dict[str, Any]]:
   try:
-    resp = requests.get(
-      f"{API_BASE_URL}/internal/jobs/pending",
-      headers={"Authorization": f"Bearer {API_TOKEN}"},
-      timeout=10,
-    )
-    resp.raise_for_status()
-    return resp.json().get("items", [])
+    return client.fetch_pending_jobs()
   except Exception:
     return []
 
 
-def mark_status(execution_id: str, status: str) -> None:
-  resp = requests.patch(
-    f"{API_BASE_URL}/internal/jobs/{execution_id}/status",
-    headers={"Authorization": f"Bearer {API_TOKEN}", "Content-Type": "application/json"},
-    json={"status": status},
-    timeout=10,
-  )
-  resp.raise_for_status()
+def mark_status(client: ApiClient, execution_id: str, status: str) -> None:
+  client.mark_job_status(execution_id, status)
 
 
-def run_once() -> None:
-  client = ApiClient(API_BASE_URL, API_TOKEN)
-  jobs = fetch_pending_jobs()
+class DispatchLimits:
+  """Global, per-tenant and per-vendor in-flight caps shared by one cycle."""
+
+  def __init__(self, global_limit: int, tenant_limit: int = 0, vendor_limit: int = 0):
+    self.global_limit = max(1, global_limit)
+    self.tenant_limit = tenant_limit
+    self.vendor_limit = vendor_limit
+    self._cond = threading.Condition()
+    self._in_flight = 0
+    self._tenants: Dict[str, int] = {}
+    self._vendors: Dict[str, int] = {}
+
+  def try_acquire(self, tenant_id: str, vendor: str) -> bool:
+    with self._cond:
+      if self._in_flight >= self.global_limit:
+        return False
+      if self.tenant_limit > 0 and self._tenants.get(tenant_id, 0) >= self.tenant_limit:
+        return False
+      if self.vendor_limit > 0 and self._vendors.get(vendor, 0) >= self.vendor_limit:
+        return False
+      self._in_flight += 1
+      self._tenants[tenant_id] = self._tenants.get(tenant_id, 0) + 1
+      self._vendors[vendor] = self._vendors.get(vendor, 0) + 1
+      return True
+
+  def release(self, tenant_id: str, vendor: str) -> None:
+    with self._cond:
+      self._in_flight -= 1
+      self._tenants[tenant_id] -= 1
+      self._vendors[vendor] -= 1
+      self._cond.notify_all()
+
+  def wait(self, timeout: float = 1.0) -> None:
+    with self._cond:
+      self._cond.wait(timeout)
+
+
+def _dedupe_jobs(jobs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
   seen_devices: dict[str, bool] = {}
   deduped: List[Dict[str, Any]] = []
   for j in jobs:
@@ -54,112 +106,338 @@ def run_once() -> None:
       continue
     seen_devices[did] = True
     deduped.append(j)
-  jobs = deduped
-  for j in jobs:
+  return deduped
+
+
+def _order_jobs(jobs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  """Longest expected backup first, so no long job starts at the end of a cycle.
+
+  Devices without a profile go first: they may well be the slowest.
+  """
+  profiles = latency_profiles()
+  if not profiles.enabled:
+    return jobs
+  # Worker processes write the profiles the supervisor orders by.
+  profiles.refresh()
+
+  def expected(j: Dict[str, Any]) -> tuple:
+    known = profiles.expected(str(j["deviceId"]))
+    return (float("inf"), 0) if known is None else known
+
+  return sorted(jobs, key=expected, reverse=True)
+
+
+def _job_tenant(j: Dict[str, Any]) -> str:
+  return str(j["TenantId"] if "TenantId" in j else j.get("tenantId", ""))
+
+
+def _build_device(j: Dict[str, Any]) -> DeviceConnectionInfo:
+  timeout = int(os.environ.get("DEVICE_TIMEOUT_SECONDS", "30"))
+  read_timeout = None
+  deadlines = latency_profiles().deadlines(str(j["deviceId"]), timeout)
+  if deadlines is not None:
+    connect_deadline, read_timeout = deadlines
+    timeout = math.ceil(connect_deadline)
+  return DeviceConnectionInfo(
+    device_id=j["deviceId"],
+    tenant_id=_job_tenant(j),
+    hostname=(j.get("hostname") or ""),
+    ip_address=((j.get("mgmtIp") or "").split("/")[0].strip()),
+    port=int(j.get("sshPort") or 22),
+    username=j.get("username") or "",
+    password=j.get("password") or "",
+    secret=j.get("secret") or None,
+    timeout=timeout,
+    read_timeout=read_timeout,
+  )
+
+
+def _record_latency(device_id: str, clock: Any, result: BackupResult | None) -> None:
+  """Update the device's profile from a backup that succeeded (``result``) or did not."""
+  connect = clock.spent(CONNECT_STAGES)
+  read: float | None = clock.spent(READ_STAGES)
+  if result is None:
+    # The phase it stopped in may have run into its deadline; counting it
+    # double backs that deadline off over the next cycles.
+    if read:
+      read = 2 * read
+    else:
+      connect, read = 2 * connect, None
+  latency_profiles().observe(device_id, connect=connect, read=read, size=result.config_size_bytes if result else None)
+
+
+class _JobClient:
+  """The ApiClient as a runner sees it: once the scheduler has given up on
+  the job, whatever the runner still reports is dropped, so a late success
+  cannot follow the scheduler's "timed out" report."""
+
+  def __init__(self, client: ApiClient):
+    self._client = client
+    self._lock = threading.Lock()
+    self._abandoned = False
+
+  def abandon(self) -> None:
+    # Waits for a report already in flight.
+    with self._lock:
+      self._abandoned = True
+
+  def __getattr__(self, name: str) -> Any:
+    attr = getattr(self._client, name)
+    if not name.startswith("report_") or not callable(attr):
+      return attr
+
+    def report(*args: Any, **kwargs: Any) -> Any:
+      with self._lock:
+        if self._abandoned:
+          return None
+        return attr(*args, **kwargs)
+
+    return report
+
+
+class RunnerLeaked(TimeoutError):
+  """A timed-out runner did not exit within RUNNER_EXIT_GRACE_SECONDS."""
+
+
+def _call_with_timeout(fn: Callable[..., BackupResult], timeout_seconds: float, on_timeout: Callable[[], None], *args: Any) -> BackupResult:
+  # A thread cannot be killed, so at the deadline the runner's SSH sessions
+  # are closed under it and its blocked reads fail. The caller waits up to
+  # RUNNER_EXIT_GRACE_SECONDS for it to exit, so its worker slot (and
+  # concurrency caps) are normally only free once its session is. A runner
+  # stuck where closing sessions cannot reach it (NFS, DNS, an API call) is
+  # abandoned with RunnerLeaked rather than stalling the cycle.
+  fut: Future = Future()
+  scope = SessionScope()
+
+  def target() -> None:
+    if not fut.set_running_or_notify_cancel():
+      return
     try:
-      mark_status(j["executionId"], "running")
-      try:
-        ApiClient(API_BASE_URL, API_TOKEN).report_step(j["deviceId"], j["executionId"], "automation_dispatch", "success", None, {"vendor": j.get("vendor")})
-      except Exception:
-        pass
-      device = DeviceConnectionInfo(
-        device_id=j["deviceId"],
-        tenant_id=j["TenantId"] if "TenantId" in j else j["tenantId"],
-        hostname=(j.get("hostname") or ""),
-        ip_address=((j.get("mgmtIp") or "").split("/")[0].strip()),
-        port=int(j.get("sshPort") or 22),
-        username=j.get("username") or "",
-        password=j.get("password") or "",
-        secret=j.get("secret") or None,
-        timeout=int(os.environ.get("DEVICE_TIMEOUT_SECONDS", "30")),
+      with session_scope(scope):
+        fut.set_result(fn(*args))
+    except BaseException as exc:
+      fut.set_exception(exc)
+
+  # The runner's stage timings belong to the device timed by the caller.
+  ctx = contextvars.copy_context()
+  thread = threading.Thread(target=ctx.run, args=(target,), name=f"backup-{getattr(fn, '__name__', 'runner')}", daemon=True)
+  thread.start()
+  try:
+    return fut.result(timeout=timeout_seconds)
+  except TimeoutError:
+    on_timeout()
+    scope.cancel()
+    thread.join(RUNNER_EXIT_GRACE_SECONDS)
+    if thread.is_alive():
+      logger.warning("%s still running %gs after its deadline; leaving it behind", thread.name, RUNNER_EXIT_GRACE_SECONDS)
+      raise RunnerLeaked() from None
+    raise
+
+
+def _candidate_hosts(vendor: str, device: DeviceConnectionInfo) -> List[str]:
+  """The hosts the vendor's runner connects to, in the order it tries them."""
+  if vendor == "hp_comware":
+    return [h for h in (device.ip_address, device.hostname) if h]
+  if vendor == "fortigate":
+    host = device.hostname or device.ip_address
+  else:
+    host = device.ip_address or device.hostname
+  return [host] if host else []
+
+
+def _preflight(jobs: List[Dict[str, Any]]) -> None:
+  """Probe every job's hosts in one parallel TCP sweep before any job starts.
+
+  Each swept job gets ``_preflight``: host -> None if it accepted a
+  connection, else the error. Devices whose circuit is open are left out;
+  they are not to be contacted.
+  """
+  if PREFLIGHT_CONCURRENCY <= 0 or not jobs:
+    return
+  health = device_health("backup")
+  health.refresh()
+  targets: Dict[str, List[Tuple[str, int]]] = {}
+  for j in jobs:
+    vendor = str(j.get("vendor") or "")
+    if vendor not in RUNNERS or health.gate(str(j["deviceId"]))[0] == SKIP:
+      continue
+    device = _build_device(j)
+    hosts = _candidate_hosts(vendor, device)
+    if hosts:
+      targets[j["executionId"]] = [(h, device.port) for h in hosts]
+  started = time.monotonic()
+  results = sweep((t for hosts in targets.values() for t in hosts), PREFLIGHT_TIMEOUT_SECONDS, PREFLIGHT_CONCURRENCY)
+  for j in jobs:
+    hosts = targets.get(j["executionId"])
+    if hosts is not None:
+      j["_preflight"] = {host: results[(host, port)] for host, port in hosts}
+  logger.info(
+    "pre-flight: %d of %d hosts reachable in %.1fs",
+    sum(1 for error in results.values() if error is None), len(results), time.monotonic() - started,
+  )
+
+
+def _report_circuit_open(client: ApiClient, j: Dict[str, Any], state: Dict[str, Any]) -> None:
+  retry_at = datetime.fromtimestamp(float(state.get("retry_at", 0)), timezone.utc)
+  try:
+    client.report_step(
+      j["deviceId"],
+      j["executionId"],
+      "circuit_open",
+      "skipped",
+      f"Device unreachable ({state.get('reason')}); not contacted until {retry_at.isoformat(timespec='seconds')}",
+      {"failures": state.get("failures"), "since": state.get("since"), "retryAt": state.get("retry_at")},
+    )
+  except Exception:
+    pass
+  mark_status(client, j["executionId"], "skipped")
+
+
+def _report_failure(client: ApiClient, j: Dict[str, Any], message: str) -> None:
+  ts = datetime.now(timezone.utc)
+  try:
+    client.report_step(device_id=j.get("deviceId", ""), execution_id=j.get("executionId", ""), step_key="error", status="failed", detail=message, meta={})
+  except Exception:
+    pass
+  try:
+    client.report_backup_result(
+      BackupResult(
+        device_id=j.get("deviceId", ""),
+        tenant_id=_job_tenant(j),
+        vendor=str(j.get("vendor") or ""),
+        backup_timestamp=ts,
+        config_path=None,
+        config_sha256="",
+        config_size_bytes=0,
+        success=False,
+        error_message=message,
+        job_id=None,
+        execution_id=j.get("executionId", ""),
       )
-      vendor = j.get("vendor")
-      timeout_seconds = device.timeout + 5
-      with ThreadPoolExecutor(max_workers=1) as ex:
-        if vendor == "fortigate":
-          fut = ex.submit(
-            run_fortigate_backup,
-            device,
-            client,
-            BACKUP_ROOT_DIR,
-            None,
-            j["executionId"],
-          )
-        elif vendor == "cisco_ios":
-          fut = ex.submit(
-            run_cisco_ios_backup,
-            device,
-            client,
-            BACKUP_ROOT_DIR,
-            None,
-            j["executionId"],
-          )
-        elif vendor == "hp_comware":
-          fut = ex.submit(
-            run_hp_comware_backup,
-            device,
-            client,
-            BACKUP_ROOT_DIR,
-            None,
-            j["executionId"],
-          )
-        else:
-          mark_status(j["executionId"], "skipped")
-          continue
-        try:
-          fut.result(timeout=timeout_seconds)
-        except TimeoutError:
-          ts = datetime.now(timezone.utc)
-          try:
-            client.report_step(device_id=device.device_id, execution_id=j["executionId"], step_key="error", status="failed", detail="Backup timed out", meta={})
-          except Exception:
-            pass
-          try:
-            client.report_backup_result(
-              BackupResult(
-                device_id=device.device_id,
-                tenant_id=device.tenant_id,
-                vendor=str(vendor or ""),
-                backup_timestamp=ts,
-                config_path=None,
-                config_sha256="",
-                config_size_bytes=0,
-                success=False,
-                error_message="Backup timed out",
-                job_id=None,
-                execution_id=j["executionId"],
-              )
-            )
-          except Exception:
-            pass
-    except Exception as e:
-      ts = datetime.now(timezone.utc)
+    )
+  except Exception:
+    pass
+
+
+def run_job(client: ApiClient, j: Dict[str, Any]) -> str:
+  """Run a single pending job; returns "success", "failed", "timeout", "leaked"
+  (timed out and its runner could not be stopped) or "skipped"."""
+  with metrics.device("backup", str(j.get("vendor") or ""), _job_tenant(j)) as clock:
+    try:
+      mark_status(client, j["executionId"], "running")
       try:
-        client.report_step(device_id=j.get("deviceId", ""), execution_id=j.get("executionId", ""), step_key="error", status="failed", detail=str(e), meta={})
+        client.report_step(j["deviceId"], j["executionId"], "automation_dispatch", "success", None, {"vendor": j.get("vendor")})
       except Exception:
         pass
+      device = _build_device(j)
+      runner = RUNNERS.get(str(j.get("vendor") or ""))
+      if runner is None:
+        mark_status(client, j["executionId"], "skipped")
+        return "skipped"
+      health = device_health("backup")
+      hosts = _candidate_hosts(str(j.get("vendor")), device)
+
+      def alive() -> bool:
+        return tcp_alive(hosts, device.port, probe_timeout())
+
+      # The sweep's answers are a hint: they may be minutes old, and one of
+      # thousands of SYNs can be dropped. A device it found dead is probed
+      # again before the job fails and the failure counts toward its circuit.
+      swept = j.get("_preflight")
+      live = None if swept is None else [h for h in hosts if h in swept and swept[h] is None]
+      if live == [] and alive():
+        live = None
+      blocked = health.admit(device.device_id, alive if live is None else lambda: bool(live))
+      if blocked is not None:
+        _report_circuit_open(client, j, blocked)
+        return "skipped"
+      if live is not None:
+        if not live:
+          errors = "; ".join(f"{h}:{device.port} {swept[h]}" for h in hosts if h in swept)
+          health.mark_down(device.device_id, errors)
+          _report_failure(client, j, f"Unreachable before connecting: {errors}")
+          return "failed"
+        device.candidates = live
+      # Connect and read deadlines come from the device's profile once it has one.
+      timeout_seconds = device.timeout + (device.read_timeout or 0) + 5
+      result: BackupResult | None
+      timed_out = "timeout"
+      job_client = _JobClient(client)
       try:
-        client.report_backup_result(
-          BackupResult(
-            device_id=j.get("deviceId", ""),
-            tenant_id=j.get("tenantId", ""),
-            vendor=str(j.get("vendor") or ""),
-            backup_timestamp=ts,
-            config_path=None,
-            config_sha256="",
-            config_size_bytes=0,
-            success=False,
-            error_message=str(e),
-            job_id=None,
-            execution_id=j.get("executionId", ""),
-          )
-        )
-      except Exception:
-        pass
+        result = _call_with_timeout(runner, timeout_seconds, job_client.abandon, device, job_client, BACKUP_ROOT_DIR, None, j["executionId"])
+      except TimeoutError as exc:
+        result = None
+        if isinstance(exc, RunnerLeaked):
+          timed_out = "leaked"
+        _report_failure(client, j, f"Backup timed out after {timeout_seconds:.0f}s")
+      succeeded = result is not None and result.success
+      _record_latency(device.device_id, clock, result if succeeded else None)
+      # A device that fails but still accepts TCP connections is not down.
+      if succeeded or alive():
+        health.mark_up(device.device_id)
+      else:
+        health.mark_down(device.device_id, "backup timed out" if result is None else result.error_message or "backup failed")
+      if result is None:
+        return timed_out
+      return "success" if succeeded else "failed"
+    except Exception as e:
+      _report_failure(client, j, str(e))
+      return "failed"
+
+
+def run_once() -> CycleStats:
+  client = ApiClient(API_BASE_URL, API_TOKEN)
+  started = time.monotonic()
+  jobs = _order_jobs(_dedupe_jobs(fetch_pending_jobs(client)))
+  stats = CycleStats(jobs_total=len(jobs))
+  if not jobs:
+    return stats
+  _preflight(jobs)
+  limits = DispatchLimits(SCHEDULER_CONCURRENCY, SCHEDULER_TENANT_CONCURRENCY, SCHEDULER_VENDOR_CONCURRENCY)
+  outcomes: List[str] = []
+  outcomes_lock = threading.Lock()
+
+  def work(j: Dict[str, Any]) -> None:
+    try:
+      outcome = run_job(client, j)
+    finally:
+      limits.release(_job_tenant(j), str(j.get("vendor") or ""))
+    with outcomes_lock:
+      outcomes.append(outcome)
+
+  pending = list(jobs)
+  with ThreadPoolExecutor(max_workers=limits.global_limit, thread_name_prefix="scheduler") as pool:
+    while pending:
+      # Jobs blocked by a tenant/vendor cap stay queued while others pass them.
+      remaining: List[Dict[str, Any]] = []
+      for j in pending:
+        if limits.try_acquire(_job_tenant(j), str(j.get("vendor") or "")):
+          pool.submit(work, j)
+        else:
+          remaining.append(j)
+      pending = remaining
+      if pending:
+        limits.wait()
+  latency_profiles().flush()
+  device_health("backup").flush()
+
+  stats.succeeded = outcomes.count("success")
+  stats.failed = outcomes.count("failed")
+  stats.leaked = outcomes.count("leaked")
+  stats.timed_out = outcomes.count("timeout") + stats.leaked
+  stats.skipped = outcomes.count("skipped")
+  stats.wall_seconds = time.monotonic() - started
+  logger.info(
+    "backup cycle: %d jobs in %.1fs (%.2f devices/s) success=%d failed=%d timeout=%d leaked=%d skipped=%d",
+    stats.jobs_total, stats.wall_seconds, stats.devices_per_second,
+    stats.succeeded, stats.failed, stats.timed_out, stats.leaked, stats.skipped,
+  )
+  return stats
 
 
 def main_loop() -> None:
   interval = int(os.environ.get("SCHEDULER_INTERVAL_SECONDS", "30"))
+  metrics.serve_from_env()
   while True:
     try:
       run_once()
@@ -169,8 +447,13 @@ def main_loop() -> None:
 
 
 if __name__ == "__main__":
+  logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
   mode = os.environ.get("SCHEDULER_MODE", "once")
-  if mode == "loop":
+  if SCHEDULER_WORKERS != 1:
+    from automation.services.scheduler_supervisor import main
+
+    main()
+  elif mode == "loop":
     main_loop()
   else:
     run_once()
@@ -0,0 +1,352 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection, wait
+from typing import Any, Deque, Dict, List, Optional, Set
+
+from automation import metrics
+from automation.clients.api_client import ApiClient
+from automation.models import CycleStats
+from automation.services import scheduler
+
+try:
+  import psutil  # type: ignore
+except Exception:
+  psutil = None
+
+# Worker processes are spawned, not forked: the supervisor holds HTTP
+# sessions and background threads that must not be copied into children.
+_mp = multiprocessing.get_context("spawn")
+
+logger = logging.getLogger(__name__)
+
+# Hard memory limit as a multiple of the soft cap: above the soft cap a
+# worker is asked to drain and is replaced; above this it is killed.
+_HARD_RSS_FACTOR = 1.5
+
+
+def shard_of(device_id: str, count: int) -> int:
+  # Stable per device, so its SSH session pool and caches stay in one worker.
+  return int(hashlib.sha1(device_id.encode("utf-8")).hexdigest(), 16) % count
+
+
+def _worker_main(index: int, conn: Connection, threads: int) -> None:
+  """Worker process: runs the jobs it is sent on its own thread pool.
+
+  The supervisor sends no more jobs than it has threads and applies the
+  tenant/vendor caps itself, so every job sent starts straight away.
+
+  Messages in: ("job", job) and ("stop",). Messages out: ("start", execution_id),
+  ("done", execution_id, outcome) and ("metrics", ...) with each device's stage
+  timings (see automation.metrics). On "stop" or SIGTERM it takes no new
+  jobs, finishes those already running and exits.
+  """
+  logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+  stopping = threading.Event()
+  signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+  # Ctrl-C reaches the whole process group; the supervisor decides.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  send_lock = threading.Lock()
+
+  def send(msg: tuple) -> None:
+    with send_lock:
+      try:
+        conn.send(msg)
+      except (OSError, EOFError):
+        stopping.set()
+
+  # The supervisor serves the metrics endpoint for the whole scheduler.
+  metrics.set_sink(lambda *timing: send(("metrics",) + timing))
+  client = ApiClient(scheduler.API_BASE_URL, scheduler.API_TOKEN)
+  limits = scheduler.DispatchLimits(threads)
+
+  def work(j: Dict[str, Any]) -> None:
+    outcome = "failed"
+    try:
+      outcome = scheduler.run_job(client, j)
+    finally:
+      limits.release(scheduler._job_tenant(j), str(j.get("vendor") or ""))
+      send(("done", j["executionId"], outcome))
+
+  backlog: List[Dict[str, Any]] = []
+  with ThreadPoolExecutor(max_workers=limits.global_limit, thread_name_prefix=f"worker{index}") as pool:
+    while not stopping.is_set():
+      remaining: List[Dict[str, Any]] = []
+      for j in backlog:
+        if limits.try_acquire(scheduler._job_tenant(j), str(j.get("vendor") or "")):
+          send(("start", j["executionId"]))
+          pool.submit(work, j)
+        else:
+          remaining.append(j)
+      backlog = remaining
+      try:
+        if not conn.poll(0.2 if backlog else 1.0):
+          continue
+        msg = conn.recv()
+      except (OSError, EOFError):
+        break  # supervisor is gone
+      if msg[0] == "stop":
+        break
+      if msg[0] == "job":
+        backlog.append(msg[1])
+  scheduler.latency_profiles().flush()
+  scheduler.device_health("backup").flush()
+  client.flush_steps(timeout=10)
+
+
+class _Worker:
+  def __init__(self, index: int):
+    self.index = index
+    self.process: Any = None
+    self.conn: Optional[Connection] = None
+    # Jobs routed to this shard that have not been sent to the process yet.
+    self.waiting: Deque[Dict[str, Any]] = deque()
+    self.assigned: Dict[str, Dict[str, Any]] = {}
+    self.started: Set[str] = set()
+    self.stop_sent_at: Optional[float] = None
+
+  @property
+  def alive(self) -> bool:
+    return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+  """Shards pending jobs across worker processes, each with its own thread pool.
+
+  - A worker that dies is replaced. Jobs it had started are reported as
+    failed; jobs it had been sent but not started go to its replacement.
+  - With psutil available and ``max_rss_mb`` > 0, a worker above the cap is
+    asked to drain and is replaced; at 1.5x the cap it is killed.
+  - ``request_drain`` (wired to SIGTERM) stops dispatching, lets running jobs
+    finish for up to ``drain_seconds`` and then stops the workers. Jobs not
+    yet started stay pending in the backend for the next run.
+  """
+
+  def __init__(
+    self,
+    workers: int,
+    threads: int,
+    tenant_limit: int = 0,
+    vendor_limit: int = 0,
+    max_rss_mb: int = 0,
+    drain_seconds: float = 60.0,
+  ):
+    self.threads = max(1, threads)
+    # Jobs are sharded by device, so one tenant's jobs run in every worker;
+    # the tenant/vendor caps are held here, from sending a job until it is done.
+    self.limits = scheduler.DispatchLimits(max(1, workers) * self.threads, tenant_limit, vendor_limit)
+    self.max_rss = max_rss_mb * 1024 * 1024 if psutil is not None else 0
+    self.drain_seconds = drain_seconds
+    self.workers = [_Worker(i) for i in range(max(1, workers))]
+    self.draining = threading.Event()
+    self._outcomes: List[str] = []
+    if max_rss_mb > 0 and psutil is None:
+      logger.warning("psutil is not available; worker memory caps are disabled")
+
+  def start(self) -> None:
+    for w in self.workers:
+      self._spawn(w)
+
+  def request_drain(self) -> None:
+    self.draining.set()
+
+  def _spawn(self, w: _Worker) -> None:
+    parent, child = _mp.Pipe(duplex=True)
+    w.process = _mp.Process(
+      target=_worker_main,
+      args=(w.index, child, self.threads),
+      name=f"scheduler-worker-{w.index}",
+      daemon=False,
+    )
+    w.process.start()
+    child.close()
+    w.conn = parent
+    w.stop_sent_at = None
+    logger.info("started scheduler worker %d (pid %s)", w.index, w.process.pid)
+
+  def _send(self, w: _Worker, msg: tuple) -> bool:
+    try:
+      assert w.conn is not None
+      w.conn.send(msg)
+      return True
+    except (OSError, EOFError, AssertionError):
+      return False
+
+  def _stop(self, w: _Worker) -> None:
+    if w.stop_sent_at is None:
+      w.stop_sent_at = time.monotonic()
+      self._send(w, ("stop",))
+
+  def _dispatch(self) -> None:
+    if self.draining.is_set():
+      return
+    for w in self.workers:
+      # One job per free thread, so a job sent starts at once and holds its
+      # tenant/vendor slot only while it runs.
+      capped: List[Dict[str, Any]] = []
+      while w.waiting and w.stop_sent_at is None and len(w.assigned) < self.threads:
+        j = w.waiting.popleft()
+        # Jobs blocked by a tenant/vendor cap stay queued while others pass them.
+        if not self.limits.try_acquire(scheduler._job_tenant(j), str(j.get("vendor") or "")):
+          capped.append(j)
+          continue
+        if not self._send(w, ("job", j)):
+          self._release(j)
+          w.waiting.appendleft(j)
+          break
+        w.assigned[j["executionId"]] = j
+      w.waiting.extendleft(reversed(capped))
+
+  def _release(self, j: Dict[str, Any]) -> None:
+    self.limits.release(scheduler._job_tenant(j), str(j.get("vendor") or ""))
+
+  def _pump(self, timeout: float) -> None:
+    conns = {w.conn: w for w in self.workers if w.conn is not None}
+    if not conns:
+      time.sleep(timeout)
+      return
+    for conn in wait(list(conns), timeout):
+      self._pump_one(conns[conn])
+
+  def _reap(self, client: ApiClient) -> None:
+    for w in self.workers:
+      if w.process is None or w.alive:
+        if w.alive and self.max_rss:
+          self._check_memory(w)
+        continue
+      exitcode = w.process.exitcode
+      w.process.join()
+      self._pump_one(w)
+      lost = [w.assigned.pop(eid) for eid in list(w.started) if eid in w.assigned]
+      if lost or (w.stop_sent_at is None and not self.draining.is_set()):
+        logger.error("scheduler worker %d exited with code %s; %d running jobs lost", w.index, exitcode, len(lost))
+      for j in lost + list(w.assigned.values()):
+        self._release(j)
+      for j in lost:
+        scheduler._report_failure(client, j, f"Backup worker process exited unexpectedly (code {exitcode})")
+        self._outcomes.append("failed")
+      # Sent but never started: hand them to the replacement first.
+      w.waiting.extendleft(reversed(list(w.assigned.values())))
+      w.assigned.clear()
+      w.started.clear()
+      w.process = None
+      w.conn = None
+      if not self.draining.is_set():
+        self._spawn(w)
+
+  def _pump_one(self, w: _Worker) -> None:
+    conn = w.conn
+    try:
+      while conn is not None and conn.poll():
+        msg = conn.recv()
+        if msg[0] == "start":
+          w.started.add(msg[1])
+        elif msg[0] == "done":
+          j = w.assigned.pop(msg[1], None)
+          if j is not None:
+            self._release(j)
+          w.started.discard(msg[1])
+          self._outcomes.append(msg[2])
+        elif msg[0] == "metrics":
+          metrics.record(*msg[1:])
+    except (OSError, EOFError):
+      # The process is gone; _reap handles what it left behind.
+      w.conn = None
+
+  def _check_memory(self, w: _Worker) -> None:
+    try:
+      rss = psutil.Process(w.process.pid).memory_info().rss
+    except Exception:
+      return
+    if rss > self.max_rss * _HARD_RSS_FACTOR:
+      logger.error("scheduler worker %d uses %d MB; killing it", w.index, rss // (1024 * 1024))
+      w.process.kill()
+    elif rss > self.max_rss and w.stop_sent_at is None:
+      logger.warning("scheduler worker %d uses %d MB; recycling it", w.index, rss // (1024 * 1024))
+      self._stop(w)
+
+  def _busy(self) -> bool:
+    return any(w.waiting or w.assigned for w in self.workers)
+
+  def run_cycle(self, client: ApiClient) -> CycleStats:
+    started = time.monotonic()
+    jobs = scheduler._order_jobs(scheduler._dedupe_jobs(scheduler.fetch_pending_jobs(client)))
+    stats = CycleStats(jobs_total=len(jobs))
+    # Swept here, once for all workers; the results travel with the jobs.
+    scheduler._preflight(jobs)
+    self._outcomes = []
+    for j in jobs:
+      self.workers[shard_of(str(j["deviceId"]), len(self.workers))].waiting.append(j)
+    while self._busy() and not self.draining.is_set():
+      self._dispatch()
+      self._pump(1.0)
+      self._reap(client)
+    stats.succeeded = self._outcomes.count("success")
+    stats.failed = self._outcomes.count("failed")
+    stats.leaked = self._outcomes.count("leaked")
+    stats.timed_out = self._outcomes.count("timeout") + stats.leaked
+    stats.skipped = self._outcomes.count("skipped")
+    stats.wall_seconds = time.monotonic() - started
+    logger.info(
+      "backup cycle (%d workers): %d jobs in %.1fs (%.2f devices/s) success=%d failed=%d timeout=%d leaked=%d skipped=%d",
+      len(self.workers), stats.jobs_total, stats.wall_seconds, stats.devices_per_second,
+      stats.succeeded, stats.failed, stats.timed_out, stats.leaked, stats.skipped,
+    )
+    return stats
+
+  def shutdown(self, client: ApiClient) -> None:
+    """Let running jobs finish (up to ``drain_seconds``), then stop every worker."""
+    self.draining.set()
+    deadline = time.monotonic() + self.drain_seconds
+    self._outcomes = []
+    for w in self.workers:
+      w.waiting.clear()
+      if w.alive:
+        self._stop(w)
+    while any(w.alive for w in self.workers) and time.monotonic() < deadline:
+      self._pump(0.5)
+    for w in self.workers:
+      if w.alive:
+        logger.warning("scheduler worker %d did not drain in time; terminating it", w.index)
+        w.process.kill()
+        w.process.join(5)
+    self._reap(client)
+    if self._outcomes:
+      logger.info("drained %d running jobs during shutdown", len(self._outcomes))
+
+
+def main() -> None:
+  supervisor = Supervisor(
+    workers=scheduler.SCHEDULER_WORKERS or (os.cpu_count() or 1),
+    threads=scheduler.SCHEDULER_CONCURRENCY,
+    tenant_limit=scheduler.SCHEDULER_TENANT_CONCURRENCY,
+    vendor_limit=scheduler.SCHEDULER_VENDOR_CONCURRENCY,
+    max_rss_mb=int(os.environ.get("SCHEDULER_WORKER_MAX_RSS_MB", "0")),
+    drain_seconds=float(os.environ.get("SCHEDULER_DRAIN_SECONDS", "60")),
+  )
+  signal.signal(signal.SIGTERM, lambda *_: supervisor.request_drain())
+  client = ApiClient(scheduler.API_BASE_URL, scheduler.API_TOKEN)
+  supervisor.start()
+  loop = os.environ.get("SCHEDULER_MODE", "once") == "loop"
+  interval = int(os.environ.get("SCHEDULER_INTERVAL_SECONDS", "30"))
+  if loop:
+    metrics.serve_from_env()
+  try:
+    while True:
+      try:
+        supervisor.run_cycle(client)
+      except Exception:
+        logger.exception("backup cycle failed")
+      if not loop or supervisor.draining.wait(interval):
+        break
+  except KeyboardInterrupt:
+    pass
+  finally:
+    supervisor.shutdown(client)
+    client.flush_steps(timeout=10)
@@ -1,5 +1,10 @@
+import hashlib
+import logging
 import os
-from typing import Any, Dict, List, Optional, Tuple
+import queue
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 try:
   from pysnmp.hlapi import (
@@ -12,6 +17,7 @@ try:
     ObjectIdentity,
     getCmd,
     nextCmd,
+    bulkCmd,
     usmHMACSHAAuthProtocol,
     usmHMACMD5AuthProtocol,
     usmDESPrivProtocol,
@@ -28,6 +34,7 @@ except Exception:
       ObjectIdentity,
       getCmd,
       nextCmd,
+      bulkCmd,
       usmHMACSHAAuthProtocol,
       usmHMACMD5AuthProtocol,
       usmDESPrivProtocol,
@@ -49,12 +56,16 @@ except Exception:
       return _Iter()
     def nextCmd(*args, **kwargs):
       yield (None, None, None, [])
+    def bulkCmd(*args, **kwargs):
+      yield (None, None, None, [])
     usmHMACSHAAuthProtocol = None
     usmHMACMD5AuthProtocol = None
     usmDESPrivProtocol = None
     usmAesCfb128Protocol = None
 
+from automation import metrics
 from automation.clients.api_client import ApiClient
+from automation.device_health import device_health, probe_timeout
 from automation.snmp.vendor_oids import (
   UPTIME_OID,
   CPU_TABLE_OID,
@@ -65,6 +76,11 @@ from automation.snmp.vendor_oids import (
   vendor_specific_inventory_oids,
 )
 
+# Agents listen on 161; another port is only useful against simulators.
+SNMP_PORT = int(os.environ.get("SNMP_PORT", "161"))
+
+logger = logging.getLogger(__name__)
+
 
 def _map_auth_protocol(name: Optional[str]):
   n = (name or "sha").lower()
@@ -80,141 +96,306 @@ def _map_priv_protocol(name: Optional[str]):
   return usmAesCfb128Protocol
 
 
-def _build_security(v3: Optional[Dict[str, Any]], community: Optional[str]) -> Tuple[Any, Any]:
+def _build_auth(v3: Optional[Dict[str, Any]], community: Optional[str]) -> Any:
   if v3 and v3.get("username"):
-    user = UsmUserData(
+    return UsmUserData(
       v3["username"],
       authKey=v3.get("authKey"),
       authProtocol=_map_auth_protocol(v3.get("authProtocol")),
       privKey=v3.get("privKey"),
       privProtocol=_map_priv_protocol(v3.get("privProtocol")),
     )
-    return (SnmpEngine(), user)
-  return (SnmpEngine(), CommunityData(community or "public", mpModel=1))
+  return CommunityData(community or "public", mpModel=1)
 
 
-def snmp_get(engine: Any, security: Any, host: str, oid: str, timeout: int, retries: int) -> Optional[Any]:
+def _build_security(v3: Optional[Dict[str, Any]], community: Optional[str]) -> Tuple[Any, Any]:
+  return (SnmpEngine(), _build_auth(v3, community))
+
+
+def _to_int(v: Any) -> Optional[int]:
+  if v is None:
+    return None
   try:
-    iterator = getCmd(
-      engine,
-      security,
-      UdpTransportTarget((host, 161), timeout=timeout, retries=retries),
-      ContextData(),
-      ObjectType(ObjectIdentity(oid)),
-    )
+    return int(v)
+  except Exception:
+    return None
+
+
+def _to_text(v: Any) -> Optional[str]:
+  if v is None:
+    return None
+  s = str(v).strip()
+  return s or None
+
+
+def _first_text(rows: List[Any]) -> Optional[str]:
+  for _, val in rows:
+    s = _to_text(val)
+    if s:
+      return s
+  return None
+
+
+def _derive_metrics(uptime: Any, cpu_rows: List[Any], mem_total: Any, mem_avail: Any) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+  uptime_ticks = _to_int(uptime)
+
+  cpu_percent: Optional[int] = None
+  cpu_vals = [c for c in (_to_int(val) for _, val in cpu_rows) if c is not None]
+  if cpu_vals:
+    cpu_percent = round(sum(cpu_vals) / len(cpu_vals))
+
+  mem_used_percent: Optional[int] = None
+  total = _to_int(mem_total)
+  avail = _to_int(mem_avail)
+  if total and avail and total > 0:
+    used = total - avail
+    mem_used_percent = max(0, min(100, round(used * 100 / total)))
+
+  if uptime_ticks is None and cpu_percent is None and mem_used_percent is None:
+    return (0, 0, 0)
+  return (uptime_ticks, cpu_percent, mem_used_percent)
+
+
+# errorStatus values from RFC 3416.
+_ERR_TOO_BIG = 1
+_ERR_NO_SUCH_NAME = 2
+_EXCEPTION_VALUES = ("NoSuchObject", "NoSuchInstance", "EndOfMibView")
+
+
+def _has_value(val: Any) -> bool:
+  return val is not None and val.__class__.__name__ not in _EXCEPTION_VALUES
+
+
+def _split_on_error(oids: List[str], error_status: Any, error_index: Any) -> List[List[str]]:
+  """Return the batches to retry after a failed multi-varbind GET."""
+  try:
+    status = int(error_status)
+    idx = int(error_index)
+  except Exception:
+    status, idx = 0, 0
+  if status != _ERR_TOO_BIG and 1 <= idx <= len(oids):
+    # noSuchName (v1) and most other PDU errors point at the offending varbind.
+    rest = oids[: idx - 1] + oids[idx:]
+    return [rest] if rest else []
+  if len(oids) > 1:
+    mid = len(oids) // 2
+    return [oids[:mid], oids[mid:]]
+  return []
+
+
+def snmp_get_many(engine: Any, security: Any, host: str, oids: List[str], timeout: int, retries: int) -> Dict[str, Any]:
+  """Fetch scalar OIDs in as few GET PDUs as the device allows."""
+  results: Dict[str, Any] = {}
+  batches = [list(oids)] if oids else []
+  while batches:
+    batch = batches.pop()
     try:
+      iterator = getCmd(
+        engine,
+        security,
+        UdpTransportTarget((host, SNMP_PORT), timeout=timeout, retries=retries),
+        ContextData(),
+        *[ObjectType(ObjectIdentity(oid)) for oid in batch],
+      )
       errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
     except Exception:
-      return None
-    if errorIndication or errorStatus:
-      return None
-    for name, val in varBinds:
-      return val
-    return None
-  except Exception:
-    return None
+      continue
+    if errorIndication:
+      # Timeouts are not retried per OID; that is what made dead devices slow.
+      continue
+    if errorStatus:
+      batches.extend(_split_on_error(batch, errorStatus, errorIndex))
+      continue
+    for oid, (name, val) in zip(batch, varBinds):
+      if _has_value(val):
+        results[oid] = val
+  return results
+
+
+def snmp_get(engine: Any, security: Any, host: str, oid: str, timeout: int, retries: int) -> Optional[Any]:
+  return snmp_get_many(engine, security, host, [oid], timeout, retries).get(oid)
+
+
+def _supports_bulk(security: Any) -> bool:
+  # GETBULK needs SNMPv2c or v3; CommunityData(mpModel=0) is v1.
+  return getattr(security, "mpModel", 1) != 0
 
 
-def snmp_walk(engine: Any, security: Any, host: str, oid: str, timeout: int, retries: int) -> List[Any]:
+def snmp_walk(
+  engine: Any,
+  security: Any,
+  host: str,
+  oid: str,
+  timeout: int,
+  retries: int,
+  max_repetitions: int = 0,
+  until: Optional[Callable[[Any], bool]] = None,
+) -> List[Any]:
+  """Walk a subtree with GETBULK when max_repetitions > 0, else GETNEXT.
+
+  If ``until`` is given the walk stops (and sends no further PDUs) after the
+  first row whose value satisfies it.
+  """
   rows: List[Any] = []
+  target = UdpTransportTarget((host, SNMP_PORT), timeout=timeout, retries=retries)
+  if max_repetitions > 0 and _supports_bulk(security):
+    iterator = bulkCmd(engine, security, target, ContextData(), 0, max_repetitions, ObjectType(ObjectIdentity(oid)), lexicographicMode=False)
+  else:
+    iterator = nextCmd(engine, security, target, ContextData(), ObjectType(ObjectIdentity(oid)), lexicographicMode=False)
   try:
-    for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-      engine,
-      security,
-      UdpTransportTarget((host, 161), timeout=timeout, retries=retries),
-      ContextData(),
-      ObjectType(ObjectIdentity(oid)),
-      lexicographicMode=False,
-    ):
+    for (errorIndication, errorStatus, errorIndex, varBinds) in iterator:
       if errorIndication or errorStatus:
         break
       for name, val in varBinds:
+        if not _has_value(val):
+          continue
         rows.append((str(name), val))
+        if until is not None and until(val):
+          return rows
   except Exception:
     return rows
   return rows
 
 
-def poll_device(client: ApiClient, device: Dict[str, Any], timeout: int, retries: int) -> None:
+def _scalar_oids(fw_oid: Optional[str], serial_vendor_oid: Optional[str]) -> List[str]:
+  oids = [UPTIME_OID, MEM_TOTAL_OID, MEM_AVAIL_OID]
+  return oids + [o for o in (fw_oid, serial_vendor_oid) if o]
+
+
+def _report_unreachable(client: ApiClient, tenant_id: str, device_id: str, state: Dict[str, Any], polled: bool = True) -> None:
+  """Report the empty sample of a device that did not answer (``polled``)
+  or was skipped because its circuit is open."""
+  if polled:
+    status, detail = "unreachable", state.get("reason")
+  else:
+    retry_at = datetime.fromtimestamp(float(state.get("retry_at", 0)), timezone.utc)
+    status, detail = "circuit_open", f"{state.get('reason')}; not polled until {retry_at.isoformat(timespec='seconds')}"
+    logger.info("snmp: %s skipped, circuit open (%s)", device_id, detail)
+  with metrics.stage("report"):
+    client.report_metrics(tenant_id, device_id, *_derive_metrics(None, [], None, None), status=status, detail=detail)
+
+
+def poll_device(client: ApiClient, device: Dict[str, Any], timeout: int, retries: int, max_repetitions: int = 0) -> bool:
+  """Poll one device; False if it was skipped or found unreachable."""
   device_id = device["id"]
   tenant_id = device["tenant_id"]
   host = str(device.get("mgmt_ip"))
   vendor = str(device.get("vendor"))
-  cfg = client.get_snmp_config(device_id)
-  community = cfg.get("community")
-  v3 = cfg.get("v3")
-  engine, security = _build_security(v3, community)
-
-  uptime_ticks: Optional[int] = None
-  v = snmp_get(engine, security, host, UPTIME_OID, timeout, retries)
-  if v is not None:
-    try:
-      uptime_ticks = int(v)
-    except Exception:
-      uptime_ticks = None
+  health = device_health("snmp")
+  with metrics.device("snmp", vendor, tenant_id):
+    with metrics.stage("config"):
+      cfg = client.get_snmp_config(device_id)
+    community = cfg.get("community")
+    v3 = cfg.get("v3")
+    engine, security = _build_security(v3, community)
 
-  cpu_percent: Optional[int] = None
-  cpu_rows = snmp_walk(engine, security, host, CPU_TABLE_OID, timeout, retries)
-  cpu_vals: List[int] = []
-  for _, val in cpu_rows:
-    try:
-      cpu_vals.append(int(val))
-    except Exception:
-      continue
-  if cpu_vals:
-    cpu_percent = round(sum(cpu_vals) / len(cpu_vals))
+    def alive() -> bool:
+      with metrics.stage("snmp"):
+        return snmp_get(engine, security, host, UPTIME_OID, probe_timeout(), 0) is not None
 
-  mem_used_percent: Optional[int] = None
-  tot = snmp_get(engine, security, host, MEM_TOTAL_OID, timeout, retries)
-  av = snmp_get(engine, security, host, MEM_AVAIL_OID, timeout, retries)
-  try:
-    total = int(tot) if tot is not None else None
-    avail = int(av) if av is not None else None
-    if total and avail and total > 0:
-      used = total - avail
-      mem_used_percent = max(0, min(100, round(used * 100 / total)))
-  except Exception:
-    mem_used_percent = None
+    blocked = health.admit(device_id, alive)
+    if blocked is not None:
+      _report_unreachable(client, tenant_id, device_id, blocked, polled=False)
+      return False
 
-  if uptime_ticks is None and cpu_percent is None and mem_used_percent is None:
-    uptime_ticks = 0
-    cpu_percent = 0
-    mem_used_percent = 0
-  client.report_metrics(tenant_id, device_id, uptime_ticks, cpu_percent, mem_used_percent)
-
-  model: Optional[str] = None
-  serial: Optional[str] = None
-  firmware: Optional[str] = None
-
-  model_rows = snmp_walk(engine, security, host, INVENTORY_MODEL_OID, timeout, retries)
-  for _, val in model_rows:
-    s = str(val).strip()
-    if s:
-      model = s
-      break
+    fw_oid, serial_vendor_oid = vendor_specific_inventory_oids(vendor)
+    with metrics.stage("snmp"):
+      scalars = snmp_get_many(engine, security, host, _scalar_oids(fw_oid, serial_vendor_oid), timeout, retries)
+    # Nothing back may just be missing OIDs; the walks below would only
+    # time out again if the agent does not answer sysUpTime either.
+    if not scalars and not alive():
+      _report_unreachable(client, tenant_id, device_id, health.mark_down(device_id, "no SNMP response"))
+      return False
+    health.mark_up(device_id)
+    with metrics.stage("snmp"):
+      cpu_rows = snmp_walk(engine, security, host, CPU_TABLE_OID, timeout, retries, max_repetitions)
+    uptime_ticks, cpu_percent, mem_used_percent = _derive_metrics(scalars.get(UPTIME_OID), cpu_rows, scalars.get(MEM_TOTAL_OID), scalars.get(MEM_AVAIL_OID))
+    with metrics.stage("report"):
+      client.report_metrics(tenant_id, device_id, uptime_ticks, cpu_percent, mem_used_percent)
+
+    # Only the first non-empty ENTITY-MIB entry is used, so stop walking there.
+    with metrics.stage("snmp"):
+      model = _first_text(snmp_walk(engine, security, host, INVENTORY_MODEL_OID, timeout, retries, max_repetitions, until=_to_text))
+      serial = _first_text(snmp_walk(engine, security, host, INVENTORY_SERIAL_OID, timeout, retries, max_repetitions, until=_to_text))
+    firmware = _to_text(scalars.get(fw_oid)) if fw_oid else None
+    if serial_vendor_oid and not serial:
+      serial = _to_text(scalars.get(serial_vendor_oid))
+
+    with metrics.stage("report"):
+      client.report_inventory(tenant_id, device_id, model, firmware, serial)
+  return True
+
+
+def in_shard(device_id: str, shard_index: int, shard_count: int) -> bool:
+  """Stable device-id hash partitioning, so replicas need no coordination."""
+  if shard_count <= 1:
+    return True
+  h = int.from_bytes(hashlib.sha1(device_id.encode("utf-8")).digest()[:8], "big")
+  return h % shard_count == shard_index
+
+
+_END = object()
 
-  serial_rows = snmp_walk(engine, security, host, INVENTORY_SERIAL_OID, timeout, retries)
-  for _, val in serial_rows:
-    s = str(val).strip()
-    if s:
-      serial = s
-      break
-
-  fw_oid, serial_vendor_oid = vendor_specific_inventory_oids(vendor)
-  if fw_oid:
-    v = snmp_get(engine, security, host, fw_oid, timeout, retries)
-    if v is not None:
-      s = str(v).strip()
-      if s:
-        firmware = s
-  if serial_vendor_oid and not serial:
-    v = snmp_get(engine, security, host, serial_vendor_oid, timeout, retries)
-    if v is not None:
-      s = str(v).strip()
-      if s:
-        serial = s
-
-  client.report_inventory(tenant_id, device_id, model, firmware, serial)
+
+def iter_active_devices(
+  client: ApiClient,
+  page_size: int = 50,
+  shard_index: int = 0,
+  shard_count: int = 1,
+  prefetch_pages: int = 2,
+) -> Iterator[Dict[str, Any]]:
+  """Yield every active device in this shard, paging through the whole fleet.
+
+  Pages are fetched on a background thread up to ``prefetch_pages`` ahead, so
+  polling starts with the first page while later pages are still loading.
+  A page fetch error is raised after the devices already fetched are yielded.
+  """
+  pages: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, prefetch_pages))
+  stop = threading.Event()
+
+  def put(item: Any) -> bool:
+    while not stop.is_set():
+      try:
+        pages.put(item, timeout=0.5)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def produce() -> None:
+    offset = 0
+    try:
+      while not stop.is_set():
+        page = client.list_active_devices(limit=page_size, offset=offset)
+        # The backend may cap the page size, so only an empty page ends the fleet.
+        if not page:
+          break
+        if not put(page):
+          return
+        offset += len(page)
+    except Exception as exc:
+      put(exc)
+    put(_END)
+
+  threading.Thread(target=produce, name="snmp-device-pager", daemon=True).start()
+  seen: set[str] = set()
+  try:
+    while True:
+      item = pages.get()
+      if item is _END:
+        return
+      if isinstance(item, Exception):
+        raise item
+      for d in item:
+        did = str(d.get("id") or "")
+        # Offset paging can repeat a row if the fleet changes mid-cycle.
+        if not did or did in seen:
+          continue
+        seen.add(did)
+        if in_shard(did, shard_index, shard_count):
+          yield d
+  finally:
+    stop.set()
 
 
 def run_once() -> None:
@@ -223,18 +404,38 @@ def run_once() -> None:
   timeout = int(os.environ.get("SNMP_TIMEOUT_SECONDS", "2"))
   retries = int(os.environ.get("SNMP_RETRIES", "1"))
   batch_limit = int(os.environ.get("SNMP_POLL_BATCH_LIMIT", "50"))
+  max_repetitions = int(os.environ.get("SNMP_BULK_MAX_REPETITIONS", "25"))
+  shard_index = int(os.environ.get("SNMP_POLL_SHARD_INDEX", "0"))
+  shard_count = int(os.environ.get("SNMP_POLL_SHARD_COUNT", "1"))
+  engine_mode = os.environ.get("SNMP_POLLER_ENGINE", "sync")
   client = ApiClient(api_base_url, api_token)
-  devices = client.list_active_devices(limit=batch_limit, offset=0)
-  for d in devices:
+  devices = iter_active_devices(client, page_size=batch_limit, shard_index=shard_index, shard_count=shard_count)
+  if engine_mode == "asyncio":
+    from automation.services.snmp_poller_async import poll_devices
+    concurrency = int(os.environ.get("SNMP_POLL_CONCURRENCY", "200"))
     try:
-      poll_device(client, d, timeout, retries)
-    except Exception:
-      continue
+      poll_devices(client, devices, timeout, retries, concurrency, max_repetitions)
+    finally:
+      device_health("snmp").flush()
+    return
+  unreachable = 0
+  try:
+    for d in devices:
+      try:
+        if not poll_device(client, d, timeout, retries, max_repetitions):
+          unreachable += 1
+      except Exception:
+        continue
+  finally:
+    device_health("snmp").flush()
+  if unreachable:
+    logger.info("snmp cycle: %d devices skipped or unreachable", unreachable)
 
 
 def main_loop() -> None:
   import time
   interval = int(os.environ.get("SNMP_POLL_INTERVAL_SECONDS", "300"))
+  metrics.serve_from_env()
   while True:
     run_once()
     time.sleep(interval)
@@ -0,0 +1,271 @@
+import asyncio
+import inspect
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+  from pysnmp.hlapi.asyncio import (
+    SnmpEngine,
+    CommunityData,
+    UsmUserData,
+    UdpTransportTarget,
+    ContextData,
+    ObjectType,
+    ObjectIdentity,
+    getCmd,
+    nextCmd,
+    bulkCmd,
+    usmHMACSHAAuthProtocol,
+    usmHMACMD5AuthProtocol,
+    usmDESPrivProtocol,
+    usmAesCfb128Protocol,
+  )
+except Exception:
+  SnmpEngine = None
+  CommunityData = None
+  UsmUserData = None
+  UdpTransportTarget = None
+  ContextData = None
+  ObjectType = None
+  ObjectIdentity = None
+  getCmd = None
+  nextCmd = None
+  bulkCmd = None
+  usmHMACSHAAuthProtocol = None
+  usmHMACMD5AuthProtocol = None
+  usmDESPrivProtocol = None
+  usmAesCfb128Protocol = None
+
+from automation import metrics
+from automation.clients.api_client import ApiClient
+from automation.device_health import OPEN, PROBE, SKIP, device_health, probe_timeout
+from automation.services.snmp_poller import SNMP_PORT, _derive_metrics, _first_text, _has_value, _report_unreachable, _scalar_oids, _split_on_error, _supports_bulk, _to_text
+from automation.snmp.vendor_oids import (
+  UPTIME_OID,
+  CPU_TABLE_OID,
+  MEM_TOTAL_OID,
+  MEM_AVAIL_OID,
+  INVENTORY_MODEL_OID,
+  INVENTORY_SERIAL_OID,
+  vendor_specific_inventory_oids,
+)
+
+
+async def _run_cmd(cmd: Any, *args: Any, **kwargs: Any) -> Tuple[Any, Any, Any, Any]:
+  # pysnmp-lextudio 5.x returns a future from the coroutine, 6.x the result itself.
+  res = await cmd(*args, **kwargs)
+  if inspect.isawaitable(res):
+    res = await res
+  return res
+
+
+def _build_auth(v3: Optional[Dict[str, Any]], community: Optional[str]) -> Any:
+  # Built from the asyncio hlapi: the sync hlapi classes may be unavailable
+  # (pysnmp 6.x) even when the asyncio ones are.
+  if v3 and v3.get("username"):
+    auth_name = (v3.get("authProtocol") or "sha").lower()
+    priv_name = (v3.get("privProtocol") or "aes").lower()
+    return UsmUserData(
+      v3["username"],
+      authKey=v3.get("authKey"),
+      authProtocol=usmHMACMD5AuthProtocol if auth_name == "md5" else usmHMACSHAAuthProtocol,
+      privKey=v3.get("privKey"),
+      privProtocol=usmDESPrivProtocol if priv_name == "des" else usmAesCfb128Protocol,
+    )
+  return CommunityData(community or "public", mpModel=1)
+
+
+def _auth_key(cfg: Dict[str, Any]) -> Tuple[Any, ...]:
+  v3 = cfg.get("v3")
+  if v3 and v3.get("username"):
+    return ("v3", v3.get("username"), v3.get("authKey"), v3.get("authProtocol"), v3.get("privKey"), v3.get("privProtocol"))
+  return ("v2c",)
+
+
+class AsyncSnmpSession:
+  """SNMP operations against one device, sharing the poller's SnmpEngine."""
+
+  def __init__(self, engine: Any, auth: Any, host: str, timeout: int, retries: int, max_repetitions: int = 0):
+    self.engine = engine
+    self.auth = auth
+    self.max_repetitions = max_repetitions if _supports_bulk(auth) else 0
+    self.target = UdpTransportTarget((host, SNMP_PORT), timeout=timeout, retries=retries)
+
+  async def get_many(self, oids: List[str]) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    batches = [list(oids)] if oids else []
+    while batches:
+      batch = batches.pop()
+      try:
+        errorIndication, errorStatus, errorIndex, varBinds = await _run_cmd(
+          getCmd, self.engine, self.auth, self.target, ContextData(), *[ObjectType(ObjectIdentity(oid)) for oid in batch],
+        )
+      except Exception:
+        continue
+      if errorIndication:
+        continue
+      if errorStatus:
+        batches.extend(_split_on_error(batch, errorStatus, errorIndex))
+        continue
+      for oid, (name, val) in zip(batch, varBinds):
+        if _has_value(val):
+          results[oid] = val
+    return results
+
+  async def get(self, oid: str) -> Optional[Any]:
+    return (await self.get_many([oid])).get(oid)
+
+  async def walk(self, oid: str, until: Optional[Callable[[Any], bool]] = None) -> List[Any]:
+    rows: List[Any] = []
+    prefix = oid + "."
+    current = oid
+    try:
+      while True:
+        if self.max_repetitions > 0:
+          errorIndication, errorStatus, errorIndex, varBindTable = await _run_cmd(
+            bulkCmd, self.engine, self.auth, self.target, ContextData(), 0, self.max_repetitions, ObjectType(ObjectIdentity(current)),
+          )
+        else:
+          errorIndication, errorStatus, errorIndex, varBindTable = await _run_cmd(
+            nextCmd, self.engine, self.auth, self.target, ContextData(), ObjectType(ObjectIdentity(current)),
+          )
+        if errorIndication or errorStatus or not varBindTable:
+          break
+        advanced = False
+        for varBinds in varBindTable:
+          for name, val in varBinds:
+            n = str(name)
+            if not n.startswith(prefix) or not _has_value(val):
+              return rows
+            rows.append((n, val))
+            if until is not None and until(val):
+              return rows
+            if n != current:
+              current = n
+              advanced = True
+        if not advanced:
+          break
+    except Exception:
+      return rows
+    return rows
+
+
+class AsyncSnmpPoller:
+  """Polls many devices concurrently on one event loop."""
+
+  def __init__(self, client: ApiClient, timeout: int, retries: int, concurrency: int, max_repetitions: int = 0):
+    if getCmd is None:
+      raise RuntimeError("pysnmp asyncio hlapi is not available")
+    self.client = client
+    self.timeout = timeout
+    self.retries = retries
+    self.concurrency = max(1, concurrency)
+    self.max_repetitions = max_repetitions
+    # USM user entries are keyed by user name inside an engine, so v3 devices
+    # with differing keys get their own engine; all v1/v2c devices share one.
+    self._engines: Dict[Tuple[Any, ...], Any] = {}
+
+  def _engine_for(self, cfg: Dict[str, Any]) -> Any:
+    key = _auth_key(cfg)
+    engine = self._engines.get(key)
+    if engine is None:
+      engine = SnmpEngine()
+      self._engines[key] = engine
+    return engine
+
+  async def poll_device(self, device: Dict[str, Any]) -> bool:
+    """Poll one device; False if it was skipped or found unreachable."""
+    device_id = device["id"]
+    tenant_id = device["tenant_id"]
+    host = str(device.get("mgmt_ip"))
+    vendor = str(device.get("vendor"))
+    health = device_health("snmp")
+    # Stages are only switched here, not in the gathered requests, which
+    # share this device's clock.
+    with metrics.device("snmp", vendor, tenant_id):
+      with metrics.stage("config"):
+        cfg = await asyncio.to_thread(self.client.get_snmp_config, device_id)
+      auth = _build_auth(cfg.get("v3"), cfg.get("community"))
+      engine = self._engine_for(cfg)
+      session = AsyncSnmpSession(engine, auth, host, self.timeout, self.retries, self.max_repetitions)
+
+      async def alive() -> bool:
+        with metrics.stage("snmp"):
+          return await AsyncSnmpSession(engine, auth, host, probe_timeout(), 0).get(UPTIME_OID) is not None
+
+      verdict, state = health.gate(device_id)
+      if verdict == PROBE:
+        state = health.probed(device_id, await alive())
+        verdict = SKIP if state["state"] == OPEN else verdict
+      if verdict == SKIP:
+        await asyncio.to_thread(_report_unreachable, self.client, tenant_id, device_id, state, False)
+        return False
+
+      fw_oid, serial_vendor_oid = vendor_specific_inventory_oids(vendor)
+      with metrics.stage("snmp"):
+        scalars, cpu_rows = await asyncio.gather(
+          session.get_many(_scalar_oids(fw_oid, serial_vendor_oid)),
+          session.walk(CPU_TABLE_OID),
+        )
+      if not scalars and not cpu_rows and not await alive():
+        await asyncio.to_thread(_report_unreachable, self.client, tenant_id, device_id, health.mark_down(device_id, "no SNMP response"))
+        return False
+      health.mark_up(device_id)
+      uptime_ticks, cpu_percent, mem_used_percent = _derive_metrics(scalars.get(UPTIME_OID), cpu_rows, scalars.get(MEM_TOTAL_OID), scalars.get(MEM_AVAIL_OID))
+      with metrics.stage("report"):
+        await asyncio.to_thread(self.client.report_metrics, tenant_id, device_id, uptime_ticks, cpu_percent, mem_used_percent)
+
+      with metrics.stage("snmp"):
+        model_rows, serial_rows = await asyncio.gather(
+          session.walk(INVENTORY_MODEL_OID, until=_to_text),
+          session.walk(INVENTORY_SERIAL_OID, until=_to_text),
+        )
+      model = _first_text(model_rows)
+      serial = _first_text(serial_rows)
+      if serial_vendor_oid and not serial:
+        serial = _to_text(scalars.get(serial_vendor_oid))
+      firmware = _to_text(scalars.get(fw_oid)) if fw_oid else None
+      with metrics.stage("report"):
+        await asyncio.to_thread(self.client.report_inventory, tenant_id, device_id, model, firmware, serial)
+    return True
+
+  async def run(self, devices: Iterable[Dict[str, Any]]) -> None:
+    sem = asyncio.Semaphore(self.concurrency)
+    tasks: set = set()
+    end = object()
+
+    async def one(d: Dict[str, Any]) -> None:
+      try:
+        await self.poll_device(d)
+      except Exception:
+        pass
+      finally:
+        sem.release()
+
+    it = iter(devices)
+    try:
+      while True:
+        # Pulled off-loop: the iterator may block waiting for the next page.
+        d = await asyncio.to_thread(next, it, end)
+        if d is end:
+          break
+        await sem.acquire()
+        task = asyncio.create_task(one(d))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    finally:
+      if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+      self.close()
+
+  def close(self) -> None:
+    for engine in self._engines.values():
+      try:
+        engine.transportDispatcher.closeDispatcher()
+      except Exception:
+        pass
+    self._engines.clear()
+
+
+def poll_devices(client: ApiClient, devices: Iterable[Dict[str, Any]], timeout: int, retries: int, concurrency: int, max_repetitions: int = 0) -> None:
+  poller = AsyncSnmpPoller(client, timeout, retries, concurrency, max_repetitions)
+  asyncio.run(poller.run(devices))
@@ -0,0 +1,269 @@
+import atexit
+import contextlib
+import contextvars
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from automation import metrics
+
+
+class PooledSession:
+  def __init__(self, key: Tuple, conn: Any, is_alive: Callable[[Any], bool], close: Callable[[Any], None]):
+    self.key = key
+    self.conn = conn
+    self.is_alive = is_alive
+    self.close = close
+    self.created = time.monotonic()
+    self.last_used = self.created
+    self.uses = 0
+
+
+class SessionScope:
+  """The sessions one job has checked out, so whoever gives up on the job
+  can close them. Closing a session makes a read blocked on it fail, which
+  is the only way to stop a runner stuck on a silent device."""
+
+  def __init__(self):
+    self.cancelled = False
+    self._lock = threading.Lock()
+    self._leases: List[PooledSession] = []
+
+  def track(self, lease: PooledSession) -> None:
+    with self._lock:
+      if not self.cancelled:
+        self._leases.append(lease)
+        return
+    _close_quietly(lease)
+
+  def untrack(self, lease: PooledSession) -> None:
+    with self._lock:
+      if lease in self._leases:
+        self._leases.remove(lease)
+
+  def cancel(self) -> None:
+    with self._lock:
+      self.cancelled = True
+      leases, self._leases = self._leases, []
+    for lease in leases:
+      _close_quietly(lease)
+
+
+def _close_quietly(lease: PooledSession) -> None:
+  try:
+    lease.close(lease.conn)
+  except Exception:
+    pass
+
+
+_scope: contextvars.ContextVar[Optional[SessionScope]] = contextvars.ContextVar("ssh_session_scope", default=None)
+
+
+@contextlib.contextmanager
+def session_scope(scope: SessionScope) -> Iterator[SessionScope]:
+  """Track the sessions checked out inside the block in ``scope``."""
+  token = _scope.set(scope)
+  try:
+    yield scope
+  finally:
+    _scope.reset(token)
+
+
+class SshSessionPool:
+  """Keeps authenticated SSH sessions per device for reuse by later jobs.
+
+  A session is checked out exclusively, so one netmiko connection or shell is
+  never driven by two jobs at once. Idle sessions are closed after
+  ``idle_ttl`` seconds, and every reuse is preceded by a health check; a
+  session that fails it is closed and replaced by a fresh connection. With
+  ``idle_ttl`` <= 0 nothing is kept and every checkout connects.
+  """
+
+  def __init__(self, idle_ttl: float = 60.0, max_idle_per_key: int = 1):
+    self.idle_ttl = idle_ttl
+    self.max_idle_per_key = max(1, max_idle_per_key)
+    self.hits = 0
+    self.misses = 0
+    self._idle: Dict[Tuple, List[PooledSession]] = {}
+    self._lock = threading.Lock()
+    self._reaper: Optional[threading.Thread] = None
+    self._closed = threading.Event()
+
+  def acquire(self, key: Tuple, connect: Callable[[], Any], is_alive: Callable[[Any], bool], close: Callable[[Any], None]) -> PooledSession:
+    # A reused session's health check counts as connecting too.
+    with metrics.stage("connect"):
+      lease = self._checkout(key, connect, is_alive, close)
+    scope = _scope.get()
+    if scope is not None:
+      scope.track(lease)
+    return lease
+
+  def _checkout(self, key: Tuple, connect: Callable[[], Any], is_alive: Callable[[Any], bool], close: Callable[[Any], None]) -> PooledSession:
+    while True:
+      with self._lock:
+        idle = self._idle.get(key)
+        lease = idle.pop() if idle else None
+        if idle is not None and not idle:
+          del self._idle[key]
+      if lease is None:
+        break
+      if time.monotonic() - lease.last_used <= self.idle_ttl and self._healthy(lease):
+        self.hits += 1
+        lease.uses += 1
+        return lease
+      self._discard(lease)
+    self.misses += 1
+    lease = PooledSession(key, connect(), is_alive, close)
+    lease.uses = 1
+    return lease
+
+  def release(self, lease: PooledSession, reusable: bool = True) -> None:
+    scope = _scope.get()
+    if scope is not None:
+      scope.untrack(lease)
+      # A cancelled job's sessions were closed under it.
+      reusable = reusable and not scope.cancelled
+    if not reusable or self.idle_ttl <= 0 or self._closed.is_set():
+      self._discard(lease)
+      return
+    lease.last_used = time.monotonic()
+    evicted: List[PooledSession] = []
+    with self._lock:
+      idle = self._idle.setdefault(lease.key, [])
+      idle.append(lease)
+      while len(idle) > self.max_idle_per_key:
+        evicted.append(idle.pop(0))
+      self._start_reaper()
+    for old in evicted:
+      self._discard(old)
+
+  @contextlib.contextmanager
+  def session(self, key: Tuple, connect: Callable[[], Any], is_alive: Callable[[Any], bool], close: Callable[[Any], None]) -> Iterator[Any]:
+    lease = self.acquire(key, connect, is_alive, close)
+    try:
+      yield lease.conn
+    except BaseException:
+      # The session may be mid-command or broken; never hand it out again.
+      self.release(lease, reusable=False)
+      raise
+    self.release(lease)
+
+  def close_all(self) -> None:
+    self._closed.set()
+    with self._lock:
+      leases = [lease for idle in self._idle.values() for lease in idle]
+      self._idle.clear()
+    for lease in leases:
+      self._discard(lease)
+
+  def _healthy(self, lease: PooledSession) -> bool:
+    try:
+      return bool(lease.is_alive(lease.conn))
+    except Exception:
+      return False
+
+  def _discard(self, lease: PooledSession) -> None:
+    _close_quietly(lease)
+
+  def _start_reaper(self) -> None:
+    if self._reaper is None:
+      self._reaper = threading.Thread(target=self._reap, name="ssh-pool-reaper", daemon=True)
+      self._reaper.start()
+
+  def _reap(self) -> None:
+    interval = max(1.0, min(self.idle_ttl, 30.0) / 2)
+    while not self._closed.wait(interval):
+      now = time.monotonic()
+      expired: List[PooledSession] = []
+      with self._lock:
+        for key in list(self._idle):
+          keep = [lease for lease in self._idle[key] if now - lease.last_used <= self.idle_ttl]
+          expired.extend(lease for lease in self._idle[key] if now - lease.last_used > self.idle_ttl)
+          if keep:
+            self._idle[key] = keep
+          else:
+            del self._idle[key]
+      for lease in expired:
+        self._discard(lease)
+
+
+_shared_lock = threading.Lock()
+_shared: Optional[SshSessionPool] = None
+
+
+def shared_pool() -> SshSessionPool:
+  global _shared
+  if _shared is None:
+    with _shared_lock:
+      if _shared is None:
+        _shared = SshSessionPool(
+          idle_ttl=float(os.environ.get("SSH_POOL_IDLE_TTL_SECONDS", "60")),
+          max_idle_per_key=int(os.environ.get("SSH_POOL_MAX_IDLE_PER_DEVICE", "1")),
+        )
+        atexit.register(_shared.close_all)
+  return _shared
+
+
+def _credential_key(username: str, password: Optional[str]) -> Tuple[str, str]:
+  # Sessions are only reused for the same credentials; the password itself is
+  # not kept in the key.
+  return username, hashlib.sha256((password or "").encode("utf-8")).hexdigest()
+
+
+def _netmiko_alive(conn: Any) -> bool:
+  return conn.is_alive()
+
+
+def _netmiko_close(conn: Any) -> None:
+  conn.disconnect()
+
+
+@contextlib.contextmanager
+def netmiko_session(params: Dict[str, Any]) -> Iterator[Any]:
+  """Pooled replacement for ``with ConnectHandler(**params) as conn``, with
+  the legacy-KEX fallback from ``kex_compat``."""
+  from automation.kex_compat import netmiko_connect_with_kex_fallback
+  key = ("netmiko", params.get("device_type"), params.get("host"), params.get("port")) + _credential_key(params.get("username", ""), params.get("password"))
+  with shared_pool().session(key, lambda: netmiko_connect_with_kex_fallback(params), _netmiko_alive, _netmiko_close) as conn:
+    yield conn
+
+
+def _transport_alive(conn: Tuple[Any, Any]) -> bool:
+  _, transport = conn
+  if not (transport.is_active() and transport.is_authenticated()):
+    return False
+  # An SSH_MSG_IGNORE makes a dead TCP peer surface as an error here rather
+  # than halfway through the next command.
+  transport.send_ignore()
+  return transport.is_active()
+
+
+def _transport_close(conn: Tuple[Any, Any]) -> None:
+  client, _ = conn
+  client.close()
+
+
+def acquire_paramiko(host: str, port: int, username: str, password: Optional[str], timeout: float) -> PooledSession:
+  """Check out a pooled ``(SSHClient, Transport)`` from ``connect_with_kex_fallback``.
+
+  Callers open their own channel per use and close it, then hand the lease
+  back with ``shared_pool().release``; only the transport is kept between jobs.
+  """
+  from automation.kex_compat import connect_with_kex_fallback
+
+  def connect() -> Tuple[Any, Any]:
+    return connect_with_kex_fallback(
+      host=host,
+      port=port,
+      username=username,
+      password=password,
+      timeout=timeout,
+      banner_timeout=timeout,
+      auth_timeout=timeout,
+      mode="paramiko",
+    )
+
+  key = ("paramiko", host, port) + _credential_key(username, password)
+  return shared_pool().acquire(key, connect, _transport_alive, _transport_close)
@@ -0,0 +1,137 @@
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Set
+
+try:
+  import fcntl
+except Exception:
+  fcntl = None
+
+
+class StateFile:
+  """
+  Per-device JSON records kept in memory and shared through one file.
+
+  Changes are merged into the file at most every ``flush_seconds`` and on
+  ``flush()``. Every record carries ``updated_at`` and the newer copy wins
+  a merge, so processes that own different devices (scheduler workers,
+  the SNMP poller) can share a file. The read-merge-write of a flush holds
+  an flock on "<path>.lock", so two processes flushing at once cannot
+  drop each other's records. Records not updated for ``ttl_seconds`` are
+  dropped; a ttl of 0 disables the store.
+  """
+
+  def __init__(self, path: Optional[Path], ttl_seconds: float, flush_seconds: float = 60.0):
+    self.path = path
+    self.ttl_seconds = ttl_seconds
+    self.flush_seconds = flush_seconds
+    self._lock = threading.Lock()
+    self._records: Dict[str, Dict[str, Any]] = {}
+    self._dirty: Set[str] = set()
+    self._loaded = False
+    self._flushed_at = time.monotonic()
+
+  @property
+  def enabled(self) -> bool:
+    return self.ttl_seconds > 0
+
+  def _read_file(self) -> Dict[str, Dict[str, Any]]:
+    if self.path is None:
+      return {}
+    try:
+      with self.path.open("r", encoding="utf-8") as fh:
+        data = json.load(fh)
+      return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+      return {}
+
+  def _fresh(self, record: Dict[str, Any]) -> bool:
+    return time.time() - float(record.get("updated_at", 0)) <= self.ttl_seconds
+
+  def _merge_from_disk(self) -> None:
+    for key, record in self._read_file().items():
+      if not isinstance(record, dict) or not self._fresh(record):
+        continue
+      mine = self._records.get(key)
+      if mine is None or float(record.get("updated_at", 0)) > float(mine.get("updated_at", 0)):
+        self._records[key] = record
+    self._loaded = True
+
+  def refresh(self) -> None:
+    """Pick up what other processes have written since."""
+    if not self.enabled:
+      return
+    with self._lock:
+      self._merge_from_disk()
+
+  def get(self, key: str) -> Dict[str, Any]:
+    if not self.enabled:
+      return {}
+    with self._lock:
+      if not self._loaded:
+        self._merge_from_disk()
+      record = self._records.get(key)
+    if not record or not self._fresh(record):
+      return {}
+    return dict(record)
+
+  def put(self, key: str, record: Dict[str, Any]) -> None:
+    if not self.enabled:
+      return
+    with self._lock:
+      if not self._loaded:
+        self._merge_from_disk()
+      self._records[key] = dict(record, updated_at=time.time())
+      self._dirty.add(key)
+      due = time.monotonic() - self._flushed_at >= self.flush_seconds
+    if due:
+      self.flush()
+
+  def flush(self) -> None:
+    with self._lock:
+      self._flushed_at = time.monotonic()
+      if not self._dirty:
+        return
+      mine = {key: self._records[key] for key in self._dirty}
+      self._dirty.clear()
+      with self._file_lock():
+        self._merge_from_disk()
+        self._records.update(mine)
+        self._records = {k: v for k, v in self._records.items() if self._fresh(v)}
+        self._write(self._records)
+
+  @contextlib.contextmanager
+  def _file_lock(self) -> Iterator[None]:
+    if self.path is None or fcntl is None:
+      yield
+      return
+    try:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      fd = os.open(str(self.path) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+      # Unwritable directory: _write fails quietly as well.
+      yield
+      return
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      yield
+    finally:
+      os.close(fd)
+
+  def _write(self, data: Dict[str, Dict[str, Any]]) -> None:
+    if self.path is None:
+      return
+    try:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=".tmp-state-")
+      with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        json.dump(data, fh)
+      os.replace(tmp, self.path)
+    except OSError:
+      # The state only tunes scheduling; an unwritable path loses it on restart.
+      pass
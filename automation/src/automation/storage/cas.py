@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# Manifests are written where a plain .cfg used to be. The first line marks
+# them so readers (including the backend) can tell them from a real config.
+MANIFEST_MAGIC = b"#netcfg-manifest/1\n"
+
+
+def objects_dir(base_dir: Path, tenant_id: str) -> Path:
+  return base_dir / tenant_id / "objects"
+
+
+def object_path(base_dir: Path, tenant_id: str, digest: str) -> Path:
+  return objects_dir(base_dir, tenant_id) / digest[:2] / digest
+
+
+def atomic_write(path: Path, data: bytes) -> None:
+  path.parent.mkdir(parents=True, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+  try:
+    with os.fdopen(fd, "wb") as fh:
+      fh.write(data)
+    os.replace(tmp, path)
+  except BaseException:
+    try:
+      os.unlink(tmp)
+    except OSError:
+      pass
+    raise
+
+
+def commit_object(base_dir: Path, tenant_id: str, digest: str, tmp_path: Path) -> Path:
+  """Move a finished temp file into the object store, or drop it if the blob exists."""
+  path = object_path(base_dir, tenant_id, digest)
+  if path.exists():
+    os.unlink(tmp_path)
+  else:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp_path, path)
+  return path
+
+
+def write_manifest(manifest_path: Path, blob_path: Path, digest: str, size: int, extra: Optional[Dict[str, Any]] = None) -> None:
+  doc: Dict[str, Any] = {
+    "sha256": digest,
+    "size": size,
+    # Relative to the manifest, so the tree can be mounted anywhere.
+    "object": os.path.relpath(blob_path, manifest_path.parent),
+  }
+  if extra:
+    doc.update(extra)
+  atomic_write(manifest_path, MANIFEST_MAGIC + json.dumps(doc).encode("utf-8") + b"\n")
+
+
+def read_manifest(path: Path) -> Optional[Dict[str, Any]]:
+  """Return the manifest document, or None if ``path`` is a plain config."""
+  with path.open("rb") as fh:
+    head = fh.read(len(MANIFEST_MAGIC))
+    if head != MANIFEST_MAGIC:
+      return None
+    doc = json.loads(fh.read().decode("utf-8"))
+  # Delta manifests (storage/delta.py) reference a base version and a delta
+  # object instead of a full object.
+  for key in ("object", "base", "delta"):
+    if key in doc:
+      doc[f"{key}_path"] = (path.parent / doc[key]).resolve()
+  return doc
@@ -0,0 +1,101 @@
+import contextlib
+import gzip
+import os
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, Tuple
+
+from automation import metrics
+
+try:
+  import zstandard  # type: ignore
+except Exception:
+  zstandard = None
+
+# Stored files are recognised by their leading bytes, so a .cfg (or object)
+# may be plain text, gzip or zstd without any change to its name.
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+CHUNK_CHARS = 1 << 16
+
+
+def compression_setting() -> str:
+  c = os.environ.get("BACKUP_COMPRESSION", "none").strip().lower()
+  if c == "zstd" and zstandard is None:
+    return "gzip"
+  return c if c in COMPRESSIONS else "none"
+
+
+def iter_text_chunks(text: str, size: int = CHUNK_CHARS) -> Iterator[bytes]:
+  """Encode ``text`` piecewise instead of materialising one full bytes copy."""
+  for start in range(0, len(text), size):
+    yield text[start:start + size].encode("utf-8")
+
+
+@contextlib.contextmanager
+def _compressing(raw: BinaryIO, compression: str) -> Iterator[BinaryIO]:
+  if compression == "gzip":
+    # mtime=0 keeps the output byte-identical for identical input.
+    with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as out:
+      yield out  # type: ignore[misc]
+  elif compression == "zstd":
+    if zstandard is None:
+      raise RuntimeError("zstandard is not available")
+    with zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=False) as out:
+      yield out
+  else:
+    yield raw
+
+
+def write_stream(chunks: Iterable[bytes], dest_dir: Path, compression: str = "none") -> Tuple[Path, str, int]:
+  """Hash and (optionally) compress ``chunks`` into a temp file in one pass.
+
+  Returns (temp_path, sha256 of the uncompressed content, uncompressed size).
+  The caller moves the temp file into place with os.replace.
+  """
+  dest_dir.mkdir(parents=True, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=dest_dir, prefix=".tmp-")
+  digest = sha256()
+  size = 0
+  try:
+    with os.fdopen(fd, "wb") as raw:
+      with _compressing(raw, compression) as out:
+        for chunk in chunks:
+          with metrics.stage("hash"):
+            digest.update(chunk)
+          size += len(chunk)
+          out.write(chunk)
+  except BaseException:
+    try:
+      os.unlink(tmp)
+    except OSError:
+      pass
+    raise
+  return Path(tmp), digest.hexdigest(), size
+
+
+def stored_compression(path: Path) -> str:
+  """The compression a stored file actually uses, from its leading bytes."""
+  with path.open("rb") as fh:
+    head = fh.read(len(ZSTD_MAGIC))
+  if head.startswith(GZIP_MAGIC):
+    return "gzip"
+  if head == ZSTD_MAGIC:
+    return "zstd"
+  return "none"
+
+
+def open_stored(path: Path) -> BinaryIO:
+  """Open a stored file for reading, transparently decompressing it."""
+  with path.open("rb") as fh:
+    head = fh.read(len(ZSTD_MAGIC))
+  if head.startswith(GZIP_MAGIC):
+    return gzip.open(path, "rb")  # type: ignore[return-value]
+  if head == ZSTD_MAGIC:
+    if zstandard is None:
+      raise RuntimeError(f"{path} is zstd-compressed but zstandard is not available")
+    return zstandard.ZstdDecompressor().stream_reader(path.open("rb"), closefd=True)
+  return path.open("rb")
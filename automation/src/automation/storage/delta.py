@@ -0,0 +1,376 @@
+import bisect
+import difflib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from automation.storage.cas import MANIFEST_MAGIC, atomic_write, commit_object, objects_dir, read_manifest, write_manifest
+from automation.storage.codec import iter_text_chunks, open_stored, stored_compression, write_stream
+
+# Gaps between anchors smaller than this (a_len * b_len) are refined with
+# difflib; larger anchor-free gaps are emitted as a plain replacement.
+_DIFFLIB_CELLS = 250_000
+
+Block = Tuple[int, int, int]
+
+
+def split_lines(text: str) -> List[str]:
+  # Only "\n" separates lines, so join("\n") restores the text exactly and the
+  # backend reader can use the same rule.
+  return text.split("\n")
+
+
+def _unique_anchors(a: Sequence[str], a_lo: int, a_hi: int, b: Sequence[str], b_lo: int, b_hi: int) -> List[Tuple[int, int]]:
+  counts: Dict[str, List[int]] = {}
+  for i in range(a_lo, a_hi):
+    entry = counts.get(a[i])
+    if entry is None:
+      counts[a[i]] = [1, 0, i, -1]
+    else:
+      entry[0] += 1
+  for j in range(b_lo, b_hi):
+    entry = counts.get(b[j])
+    if entry is not None:
+      entry[1] += 1
+      entry[3] = j
+  pairs = [(e[2], e[3]) for e in counts.values() if e[0] == 1 and e[1] == 1]
+  pairs.sort()
+  return pairs
+
+
+def _longest_increasing(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+  # Patience sorting on the b index of anchors already ordered by a index.
+  tails: List[int] = []
+  tail_idx: List[int] = []
+  prev: List[int] = [-1] * len(pairs)
+  for k, (_, j) in enumerate(pairs):
+    pos = bisect.bisect_left(tails, j)
+    if pos == len(tails):
+      tails.append(j)
+      tail_idx.append(k)
+    else:
+      tails[pos] = j
+      tail_idx[pos] = k
+    prev[k] = tail_idx[pos - 1] if pos > 0 else -1
+  out: List[Tuple[int, int]] = []
+  k = tail_idx[-1] if tail_idx else -1
+  while k >= 0:
+    out.append(pairs[k])
+    k = prev[k]
+  out.reverse()
+  return out
+
+
+def match_lines(a: Sequence[str], b: Sequence[str]) -> List[Block]:
+  """Return matching blocks (a_start, b_start, length) in order, patience-diff style.
+
+  Runs in roughly O(n log n) for configs, where most lines are unchanged and
+  many are unique; difflib alone is quadratic on repetitive config text.
+  """
+  blocks: List[Block] = []
+  stack = [(0, len(a), 0, len(b))]
+  while stack:
+    a_lo, a_hi, b_lo, b_hi = stack.pop()
+    n = 0
+    while a_lo + n < a_hi and b_lo + n < b_hi and a[a_lo + n] == b[b_lo + n]:
+      n += 1
+    if n:
+      blocks.append((a_lo, b_lo, n))
+      a_lo += n
+      b_lo += n
+    n = 0
+    while a_lo < a_hi - n and b_lo < b_hi - n and a[a_hi - n - 1] == b[b_hi - n - 1]:
+      n += 1
+    if n:
+      a_hi -= n
+      b_hi -= n
+      blocks.append((a_hi, b_hi, n))
+    if a_lo >= a_hi or b_lo >= b_hi:
+      continue
+    anchors = _longest_increasing(_unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi))
+    if not anchors:
+      if (a_hi - a_lo) * (b_hi - b_lo) <= _DIFFLIB_CELLS:
+        sm = difflib.SequenceMatcher(None, a[a_lo:a_hi], b[b_lo:b_hi], autojunk=False)
+        for i, j, n in sm.get_matching_blocks():
+          if n:
+            blocks.append((a_lo + i, b_lo + j, n))
+      continue
+    prev_a, prev_b = a_lo, b_lo
+    for i, j in anchors:
+      stack.append((prev_a, i, prev_b, j))
+      blocks.append((i, j, 1))
+      prev_a, prev_b = i + 1, j + 1
+    stack.append((prev_a, a_hi, prev_b, b_hi))
+  blocks.sort()
+  merged: List[Block] = []
+  for i, j, n in blocks:
+    if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+      li, lj, ln = merged[-1]
+      merged[-1] = (li, lj, ln + n)
+    else:
+      merged.append((i, j, n))
+  return merged
+
+
+def make_delta(base: Sequence[str], target: Sequence[str]) -> List[object]:
+  """Encode ``target`` as ops over ``base``: [start, end] copies base lines,
+  a list of strings inserts those lines."""
+  ops: List[object] = []
+  j = 0
+  for i, bj, n in match_lines(base, target):
+    if bj > j:
+      ops.append(list(target[j:bj]))
+    ops.append([i, i + n])
+    j = bj + n
+  if j < len(target):
+    ops.append(list(target[j:]))
+  return ops
+
+
+def apply_delta(base: Sequence[str], ops: List[object]) -> List[str]:
+  out: List[str] = []
+  for op in ops:
+    if op and isinstance(op[0], int):  # type: ignore[index]
+      out.extend(base[op[0]:op[1]])  # type: ignore[index]
+    else:
+      out.extend(op)  # type: ignore[arg-type]
+  return out
+
+
+def encode_delta(ops: List[object]) -> bytes:
+  return json.dumps({"v": 1, "ops": ops}, separators=(",", ":")).encode("utf-8")
+
+
+def decode_delta(data: bytes) -> List[object]:
+  return json.loads(data.decode("utf-8"))["ops"]
+
+
+# --- delta-chain storage ----------------------------------------------------
+#
+# Each version is a manifest at its usual timestamped path. A keyframe manifest
+# points at a full object like in "cas" mode; a delta manifest points at the
+# previous version's manifest ("base") and an object holding the ops that turn
+# it into this version ("delta"). A keyframe is written every
+# BACKUP_DELTA_KEYFRAME_INTERVAL versions, which bounds how many deltas a read
+# has to apply. Retention must delete whole groups (a keyframe and the deltas
+# after it, up to the next keyframe); deleting a single version breaks every
+# later version of its group.
+#
+# <tenant>/<device>/history.idx lists the versions in order, one JSON object
+# per line, so the newest version (the next base) and the keyframes are found
+# without walking the date directories.
+
+HISTORY_INDEX = "history.idx"
+
+# A delta bigger than this fraction of the full text is not worth the chain
+# depth; a keyframe is written instead.
+_MAX_DELTA_RATIO = 0.5
+
+
+def keyframe_interval() -> int:
+  return max(1, int(os.environ.get("BACKUP_DELTA_KEYFRAME_INTERVAL", "30")))
+
+
+# Rough memory per cached line on top of its characters (str header, list slot).
+_LINE_OVERHEAD = 57
+
+
+def _cached_size(lines: List[str]) -> int:
+  return sum(len(line) + _LINE_OVERHEAD for line in lines)
+
+
+class _LineCache:
+  """Small LRU of reconstructed versions, keyed by resolved manifest path.
+
+  Bounded by the (estimated) memory it holds, not by entries: a few
+  multi-megabyte configs must not pin a worker's memory. A version bigger than the whole budget
+  is not cached.
+  """
+
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self._items: "OrderedDict[str, Tuple[List[str], int]]" = OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+
+  def get(self, key: str) -> Optional[List[str]]:
+    with self._lock:
+      item = self._items.get(key)
+      if item is None:
+        return None
+      self._items.move_to_end(key)
+      return item[0]
+
+  def put(self, key: str, lines: List[str]) -> None:
+    size = _cached_size(lines)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      old = self._items.pop(key, None)
+      if old is not None:
+        self._bytes -= old[1]
+      self._items[key] = (lines, size)
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        _, (_, evicted) = self._items.popitem(last=False)
+        self._bytes -= evicted
+
+
+_cache = _LineCache(int(os.environ.get("BACKUP_DELTA_CACHE_BYTES", str(8 * 1024 * 1024))))
+
+
+def history_index_path(base_dir: Path, tenant_id: str, device_id: str) -> Path:
+  return base_dir / tenant_id / device_id / HISTORY_INDEX
+
+
+def read_history(base_dir: Path, tenant_id: str, device_id: str) -> List[Dict[str, Any]]:
+  """Return the device's versions, oldest first, with ``manifest_path`` resolved."""
+  index = history_index_path(base_dir, tenant_id, device_id)
+  try:
+    raw = index.read_text(encoding="utf-8")
+  except FileNotFoundError:
+    return []
+  entries = []
+  for line in raw.splitlines():
+    if not line.strip():
+      continue
+    try:
+      entry = json.loads(line)
+    except ValueError:
+      continue  # torn final line after a crash
+    entry["manifest_path"] = index.parent / entry["path"]
+    entries.append(entry)
+  return entries
+
+
+def keyframes(base_dir: Path, tenant_id: str, device_id: str) -> List[Dict[str, Any]]:
+  return [e for e in read_history(base_dir, tenant_id, device_id) if e.get("depth") == 0]
+
+
+def _latest_entry(base_dir: Path, tenant_id: str, device_id: str) -> Optional[Dict[str, Any]]:
+  entries = read_history(base_dir, tenant_id, device_id)
+  return entries[-1] if entries else None
+
+
+def _append_history(base_dir: Path, tenant_id: str, device_id: str, manifest_path: Path, ts: str, digest: str, depth: int) -> None:
+  index = history_index_path(base_dir, tenant_id, device_id)
+  index.parent.mkdir(parents=True, exist_ok=True)
+  entry = {"ts": ts, "path": os.path.relpath(manifest_path, index.parent), "sha256": digest, "depth": depth}
+  with index.open("a", encoding="utf-8") as fh:
+    fh.write(json.dumps(entry) + "\n")
+
+
+def _lines_sha256(lines: List[str]) -> str:
+  digest = sha256()
+  for i, line in enumerate(lines):
+    if i:
+      digest.update(b"\n")
+    digest.update(line.encode("utf-8"))
+  return digest.hexdigest()
+
+
+def reconstruct_lines(manifest_path: Path) -> List[str]:
+  """Rebuild the lines of a stored version, following its chain back to a keyframe.
+
+  Raises ValueError if the result does not match the sha256 in the
+  version's manifest, i.e. some link of the chain is corrupt.
+  """
+  chain: List[Dict[str, Any]] = []
+  path = Path(manifest_path).resolve()
+  requested = str(path)
+  expected: Optional[str] = None
+  lines: Optional[List[str]] = None
+  while True:
+    key = str(path)
+    lines = _cache.get(key)
+    if lines is not None:
+      break
+    manifest = read_manifest(path)
+    if manifest is None:
+      # A plain .cfg from before delta mode was enabled.
+      with open_stored(path) as fh:
+        lines = split_lines(fh.read().decode("utf-8", errors="replace"))
+      break
+    if key == requested:
+      expected = manifest.get("sha256")
+    if "object_path" in manifest:
+      with open_stored(manifest["object_path"]) as fh:
+        lines = split_lines(fh.read().decode("utf-8", errors="replace"))
+      break
+    chain.append(manifest)
+    path = manifest["base_path"]
+  for manifest in reversed(chain):
+    with open_stored(manifest["delta_path"]) as fh:
+      lines = apply_delta(lines, decode_delta(fh.read()))
+  if expected is not None and _lines_sha256(lines) != expected:
+    raise ValueError(f"{manifest_path} does not rebuild to its recorded sha256; its delta chain is corrupt")
+  # Only the requested version is cached, not every intermediate one.
+  _cache.put(requested, lines)
+  return lines
+
+
+def open_delta_config(manifest_path: Path):
+  return io.BytesIO("\n".join(reconstruct_lines(manifest_path)).encode("utf-8"))
+
+
+def save_delta_version(
+  base_dir: Path,
+  tenant_id: str,
+  device_id: str,
+  manifest_path: Path,
+  ts: str,
+  config_text: str,
+  compression: str,
+  interval: Optional[int] = None,
+) -> Tuple[str, int]:
+  """Store ``config_text`` as a keyframe or as a delta over the device's latest
+  version; returns (sha256, size) of the full text.
+
+  Callers must not save two versions of one device concurrently; the scheduler
+  already runs at most one job per device.
+  """
+  interval = interval or keyframe_interval()
+  lines = split_lines(config_text)
+  latest = _latest_entry(base_dir, tenant_id, device_id)
+  ops = None
+  if latest is not None and latest["depth"] + 1 < interval and latest["manifest_path"].exists():
+    try:
+      base_lines = reconstruct_lines(latest["manifest_path"])
+    except (OSError, ValueError, KeyError):
+      base_lines = None
+    if base_lines is not None:
+      ops = make_delta(base_lines, lines)
+  payload = encode_delta(ops) if ops is not None else b""
+  if ops is not None and len(payload) <= _MAX_DELTA_RATIO * len(config_text):
+    digest = sha256()
+    size = 0
+    for chunk in iter_text_chunks(config_text):
+      digest.update(chunk)
+      size += len(chunk)
+    tmp, delta_digest, _ = write_stream([payload], objects_dir(base_dir, tenant_id), compression)
+    blob = commit_object(base_dir, tenant_id, delta_digest, tmp)
+    depth = latest["depth"] + 1
+    doc = {
+      "sha256": digest.hexdigest(),
+      "size": size,
+      "base": os.path.relpath(latest["manifest_path"], manifest_path.parent),
+      "delta": os.path.relpath(blob, manifest_path.parent),
+      "depth": depth,
+      "compression": stored_compression(blob),
+    }
+    atomic_write(manifest_path, MANIFEST_MAGIC + json.dumps(doc).encode("utf-8") + b"\n")
+    hexdigest = doc["sha256"]
+  else:
+    tmp, hexdigest, size = write_stream(iter_text_chunks(config_text), objects_dir(base_dir, tenant_id), compression)
+    blob = commit_object(base_dir, tenant_id, hexdigest, tmp)
+    depth = 0
+    write_manifest(manifest_path, blob, hexdigest, size, {"depth": 0, "compression": stored_compression(blob)})
+  _append_history(base_dir, tenant_id, device_id, manifest_path, ts, hexdigest, depth)
+  # The new version is the next run's base; keep it so it is not rebuilt.
+  _cache.put(str(manifest_path.resolve()), lines)
+  return hexdigest, size
@@ -1,8 +1,30 @@
+import itertools
+import logging
+import os
 from datetime import datetime, timezone
-from hashlib import sha256
 from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
 
+from automation import metrics
 from automation.models import BackupResult
+from automation.storage.cas import commit_object, objects_dir, read_manifest, write_manifest
+from automation.storage.codec import compression_setting, iter_text_chunks, open_stored, stored_compression, write_stream
+from automation.storage.delta import open_delta_config, save_delta_version
+from automation.storage.hash_index import NormalizedHasher, hash_index, hashing, skip_unchanged, unchanged_spool_bytes
+from automation.storage.search_index import search_enabled, search_index
+
+logger = logging.getLogger(__name__)
+
+# "plain" writes the full config at the timestamped path; "cas" stores it once
+# per tenant under objects/<sha256> and writes a small manifest there instead.
+# "delta" stores most versions as a line delta over the previous one (see
+# storage/delta.py). Every layout may be compressed (BACKUP_COMPRESSION=gzip|zstd).
+STORAGE_MODES = ("plain", "cas", "delta")
+
+
+def storage_mode() -> str:
+  mode = os.environ.get("BACKUP_STORAGE_MODE", "plain").strip().lower()
+  return mode if mode in STORAGE_MODES else "plain"
 
 
 def build_backup_path(base_dir: Path, tenant_id: str, device_id: str, ts: datetime) -> Path:
@@ -11,13 +33,107 @@ def build_backup_path(base_dir: Path, tenant_id: str, device_id: str, ts: dateti
   return base_dir / tenant_id / device_id / date_part / filename
 
 
-def save_config_to_file(base_dir: Path, result: BackupResult, config_text: str) -> BackupResult:
+def save_config_to_file(
+  base_dir: Path,
+  result: BackupResult,
+  config_text: str,
+  mode: str | None = None,
+  compression: str | None = None,
+) -> BackupResult:
+  if (mode or storage_mode()) == "delta":
+    return _save(base_dir, result, None, config_text, "delta", compression)
+  return save_config_stream(base_dir, result, iter_text_chunks(config_text), mode, compression)
+
+
+def save_config_stream(
+  base_dir: Path,
+  result: BackupResult,
+  chunks: Iterable[bytes],
+  mode: str | None = None,
+  compression: str | None = None,
+) -> BackupResult:
+  """Store a config arriving as encoded chunks without holding it in memory.
+
+  The chunks are hashed and written to a temp file as they come; an
+  exception from ``chunks`` removes the temp file and propagates. Delta mode
+  needs the whole text to diff against the previous version, so there the
+  chunks are joined first.
+
+  When the config matches the device's last stored version once volatile
+  lines are ignored (see storage/hash_index.py), nothing is kept and the
+  result points at that version with ``unchanged`` set. To tell before
+  anything is compressed or written, a device with a stored version has
+  its config held in memory up to BACKUP_UNCHANGED_SPOOL_BYTES; a larger
+  one is written as it comes and only discarded afterwards.
+  """
+  mode = mode or storage_mode()
+  if mode == "delta":
+    return _save(base_dir, result, None, b"".join(chunks).decode("utf-8", errors="replace"), mode, compression)
+  return _save(base_dir, result, chunks, None, mode, compression)
+
+
+def _save(
+  base_dir: Path,
+  result: BackupResult,
+  chunks: Iterable[bytes] | None,
+  config_text: str | None,
+  mode: str,
+  compression: str | None,
+) -> BackupResult:
   ts = result.backup_timestamp.astimezone(timezone.utc)
   path = build_backup_path(base_dir, result.tenant_id, result.device_id, ts)
-  path.parent.mkdir(parents=True, exist_ok=True)
-  encoded = config_text.encode("utf-8")
-  path.write_bytes(encoded)
-  digest = sha256(encoded).hexdigest()
+  compression = compression or compression_setting()
+  index = hash_index(base_dir) if skip_unchanged() else None
+  hasher = NormalizedHasher(result.vendor)
+  if mode == "delta":
+    assert config_text is not None
+    with metrics.stage("hash"):
+      hasher.update(config_text.encode("utf-8"))
+      normalized = hasher.hexdigest()
+    last = index.unchanged(result.tenant_id, result.device_id, normalized) if index else None
+    if last is not None:
+      return _unchanged_result(result, last)
+    with metrics.stage("write"):
+      digest, size = save_delta_version(
+        base_dir, result.tenant_id, result.device_id, path, ts.isoformat(), config_text, compression,
+      )
+  else:
+    assert chunks is not None
+    # The temp file goes next to the device's versions rather than into the
+    # dated directory, which is only created if this version is kept.
+    dest = objects_dir(base_dir, result.tenant_id) if mode == "cas" else base_dir / result.tenant_id / result.device_id
+    hashed: Iterator[bytes] = hashing(chunks, hasher)
+    if index is not None and index.get(result.tenant_id, result.device_id) is not None:
+      held, complete = _spool(hashed, unchanged_spool_bytes())
+      if complete:
+        with metrics.stage("hash"):
+          normalized = hasher.hexdigest()
+        last = index.unchanged(result.tenant_id, result.device_id, normalized)
+        if last is not None:
+          return _unchanged_result(result, last)
+      hashed = itertools.chain(held, hashed)
+    # Reading, normalizing and hashing the chunks count as their own stages.
+    with metrics.stage("write"):
+      tmp, digest, size = write_stream(hashed, dest, compression)
+    with metrics.stage("hash"):
+      normalized = hasher.hexdigest()
+    last = index.unchanged(result.tenant_id, result.device_id, normalized) if index else None
+    if last is not None:
+      os.unlink(tmp)
+      return _unchanged_result(result, last)
+    with metrics.stage("write"):
+      if mode == "cas":
+        blob = commit_object(base_dir, result.tenant_id, digest, tmp)
+        # An existing blob keeps the codec it was first stored with.
+        write_manifest(path, blob, digest, size, {"compression": stored_compression(blob)})
+      else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, path)
+  if index is not None:
+    index.put(result.tenant_id, result.device_id, normalized, digest, path, size, ts.isoformat())
+  if search_enabled():
+    with metrics.stage("index"):
+      _index_for_search(base_dir, result, path, digest, ts.isoformat())
   return BackupResult(
     device_id=result.device_id,
     tenant_id=result.tenant_id,
@@ -25,9 +141,66 @@ def save_config_to_file(base_dir: Path, result: BackupResult, config_text: str)
     backup_timestamp=result.backup_timestamp,
     config_path=path,
     config_sha256=digest,
-    config_size_bytes=len(encoded),
+    config_size_bytes=size,
+    success=result.success,
+    error_message=result.error_message,
+    job_id=result.job_id,
+    execution_id=result.execution_id,
+  )
+
+
+def _spool(chunks: Iterator[bytes], limit: int) -> Tuple[List[bytes], bool]:
+  """Read ``chunks`` into memory up to ``limit`` bytes; True if that was all of them."""
+  held: List[bytes] = []
+  size = 0
+  for chunk in chunks:
+    held.append(chunk)
+    size += len(chunk)
+    if size > limit:
+      return held, False
+  return held, True
+
+
+def _index_for_search(base_dir: Path, result: BackupResult, path: Path, digest: str, ts: str) -> None:
+  # The backup is already stored; a failure here must not fail it.
+  try:
+    search_index(base_dir).add(result.tenant_id, result.device_id, ts, digest, path, result.vendor, lambda: read_config_text(path))
+  except Exception:
+    logger.warning("search indexing failed for %s", path, exc_info=True)
+
+
+def _unchanged_result(result: BackupResult, last: dict) -> BackupResult:
+  # Points at the version already stored; nothing new was written.
+  return BackupResult(
+    device_id=result.device_id,
+    tenant_id=result.tenant_id,
+    vendor=result.vendor,
+    backup_timestamp=result.backup_timestamp,
+    config_path=Path(last["config_path"]),
+    config_sha256=last["sha256"],
+    config_size_bytes=last["size"],
     success=result.success,
     error_message=result.error_message,
     job_id=result.job_id,
     execution_id=result.execution_id,
+    unchanged=True,
   )
+
+
+def open_config(path: Path):
+  """Open a stored config for binary reading, whatever layout and compression it uses."""
+  manifest = read_manifest(path)
+  if manifest is None:
+    return open_stored(path)
+  if "object_path" not in manifest:
+    return open_delta_config(path)
+  return open_stored(Path(manifest["object_path"]))
+
+
+def read_config_bytes(path: Path) -> bytes:
+  with open_config(path) as fh:
+    return fh.read()
+
+
+def read_config_text(path: Path) -> str:
+  return read_config_bytes(path).decode("utf-8", errors="replace")
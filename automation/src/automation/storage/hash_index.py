@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import threading
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from automation import metrics
+from automation.normalize import normalizer
+
+
+class NormalizedHasher:
+  """sha256 of a config as it is compared (``ConfigNormalizer.mask``), fed
+  chunk by chunk.
+
+  Lines are only normalized once complete, so chunk boundaries do not matter.
+  """
+
+  def __init__(self, vendor: str):
+    self._normalizer = normalizer(vendor)
+    self._digest = sha256()
+    self._tail = b""
+
+  def update(self, chunk: bytes) -> None:
+    data = self._tail + chunk
+    cut = data.rfind(b"\n") + 1
+    self._tail = data[cut:]
+    self._feed(data[:cut])
+
+  def _feed(self, block: bytes) -> None:
+    self._digest.update(self._normalizer.mask(self._normalizer.strip(block)))
+
+  def hexdigest(self) -> str:
+    if self._tail:
+      self._feed(self._tail)
+      self._tail = b""
+    return self._digest.hexdigest()
+
+
+def normalized_sha256(vendor: str, data: bytes) -> str:
+  hasher = NormalizedHasher(vendor)
+  hasher.update(data)
+  return hasher.hexdigest()
+
+
+def hashing(chunks: Iterable[bytes], hasher: NormalizedHasher) -> Iterator[bytes]:
+  for chunk in chunks:
+    with metrics.stage("hash"):
+      hasher.update(chunk)
+    yield chunk
+
+
+class HashIndex:
+  """Last stored version of each device, keyed by (tenant, device).
+
+  SQLite in WAL mode, so the scheduler's worker processes can share one
+  file; each thread keeps its own connection.
+  """
+
+  def __init__(self, path: Path):
+    self.path = path
+    self._local = threading.local()
+
+  def _conn(self) -> sqlite3.Connection:
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("PRAGMA synchronous=NORMAL")
+      conn.execute(
+        """CREATE TABLE IF NOT EXISTS last_backup (
+          tenant_id TEXT NOT NULL,
+          device_id TEXT NOT NULL,
+          normalized_sha256 TEXT NOT NULL,
+          sha256 TEXT NOT NULL,
+          config_path TEXT NOT NULL,
+          size INTEGER NOT NULL,
+          ts TEXT NOT NULL,
+          PRIMARY KEY (tenant_id, device_id)
+        )"""
+      )
+      self._local.conn = conn
+    return conn
+
+  def get(self, tenant_id: str, device_id: str) -> Optional[Dict[str, Any]]:
+    row = self._conn().execute(
+      "SELECT normalized_sha256, sha256, config_path, size, ts FROM last_backup WHERE tenant_id = ? AND device_id = ?",
+      (tenant_id, device_id),
+    ).fetchone()
+    if row is None:
+      return None
+    return {"normalized_sha256": row[0], "sha256": row[1], "config_path": row[2], "size": row[3], "ts": row[4]}
+
+  def put(self, tenant_id: str, device_id: str, normalized: str, digest: str, config_path: Path, size: int, ts: str) -> None:
+    self._conn().execute(
+      "INSERT OR REPLACE INTO last_backup VALUES (?, ?, ?, ?, ?, ?, ?)",
+      (tenant_id, device_id, normalized, digest, str(config_path), size, ts),
+    )
+
+  def unchanged(self, tenant_id: str, device_id: str, normalized: str) -> Optional[Dict[str, Any]]:
+    """The last stored version if it has this normalized hash and its file still exists."""
+    last = self.get(tenant_id, device_id)
+    if last is None or last["normalized_sha256"] != normalized:
+      return None
+    if not Path(last["config_path"]).exists():
+      return None  # removed by retention; store this one again
+    return last
+
+
+def skip_unchanged() -> bool:
+  return os.environ.get("BACKUP_SKIP_UNCHANGED", "1") != "0"
+
+
+def unchanged_spool_bytes() -> int:
+  """How much of a config is held in memory waiting for its hash before writing starts anyway."""
+  return int(os.environ.get("BACKUP_UNCHANGED_SPOOL_BYTES", str(8 * 1024 * 1024)))
+
+
+_indexes_lock = threading.Lock()
+_indexes: Dict[Path, HashIndex] = {}
+
+
+def hash_index(base_dir: Path) -> HashIndex:
+  """Shared index for ``base_dir``; BACKUP_HASH_INDEX_PATH overrides its location."""
+  path = Path(os.environ.get("BACKUP_HASH_INDEX_PATH") or base_dir / ".hash-index.sqlite")
+  with _indexes_lock:
+    index = _indexes.get(path)
+    if index is None:
+      index = _indexes[path] = HashIndex(path)
+    return index
@@ -0,0 +1,219 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from automation.diff import Node, parse
+
+# Highlight markers around matched tokens; they never occur in configs.
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+_FTS_SYNTAX = re.compile(r'"|\b(?:AND|OR|NOT|NEAR)\b|\*')
+
+
+def _sections(root: Node, path: Tuple[str, ...] = ()) -> Iterator[Tuple[Tuple[str, ...], List[str]]]:
+  """Each section's own lines (header first) with the path of headers above it."""
+  lines = ([path[-1]] if path else []) + root.settings()
+  if lines:
+    yield path, lines
+  for child in root.children:
+    yield from _sections(child, path + (child.text,))
+
+
+def guess_vendor(text: str) -> str:
+  """Parser dialect for a config whose vendor is not known (backfill)."""
+  if text.startswith("#config-version=") or "\nconfig system global" in text:
+    return "fortigate"
+  return "cisco_ios"
+
+
+def fts_query(query: str) -> str:
+  """Plain text is searched as a phrase; FTS5 syntax (quotes, AND/OR/NOT,
+  NEAR, prefix *) is passed through, e.g. '"set srcaddr all" AND "set dstaddr all"'."""
+  if _FTS_SYNTAX.search(query):
+    return query
+  return '"' + query.replace('"', '""') + '"'
+
+
+class SearchIndex:
+  """Full-text index of stored configs for fleet-wide searches.
+
+  Every distinct config (by sha256) is indexed once, one FTS5 row per
+  section with the section's own lines, so a query can require several
+  lines of the same section (a policy, an interface). ``backups`` maps each
+  stored device version to its sha256; identical configs share rows and an
+  unchanged re-save costs one insert. SQLite in WAL mode, shared by worker
+  processes, one connection per thread.
+  """
+
+  def __init__(self, path: Path):
+    self.path = path
+    self._local = threading.local()
+
+  def _conn(self) -> sqlite3.Connection:
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("PRAGMA synchronous=NORMAL")
+      conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS configs (sha256 TEXT PRIMARY KEY, vendor TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS backups (
+          tenant_id TEXT NOT NULL,
+          device_id TEXT NOT NULL,
+          ts TEXT NOT NULL,
+          sha256 TEXT NOT NULL,
+          config_path TEXT NOT NULL,
+          PRIMARY KEY (tenant_id, device_id, ts)
+        );
+        CREATE INDEX IF NOT EXISTS backups_sha256 ON backups (sha256);
+        CREATE VIRTUAL TABLE IF NOT EXISTS sections USING fts5(body, path UNINDEXED, sha256 UNINDEXED);
+        """
+      )
+      self._local.conn = conn
+    return conn
+
+  def has(self, digest: str) -> bool:
+    return self._conn().execute("SELECT 1 FROM configs WHERE sha256 = ?", (digest,)).fetchone() is not None
+
+  def add(self, tenant_id: str, device_id: str, ts: str, digest: str, config_path: Path, vendor: str, read_text) -> bool:
+    """Record a stored version; ``read_text()`` is only called for a sha256
+    not indexed yet. Returns whether the config was (re)indexed."""
+    conn = self._conn()
+    indexed = False
+    if not self.has(digest):
+      rows = [
+        ("\n".join(lines), json.dumps(path), digest)
+        for path, lines in _sections(parse(read_text(), vendor))
+      ]
+      conn.execute("BEGIN IMMEDIATE")
+      try:
+        # Another worker may have indexed the same config meanwhile.
+        if conn.execute("INSERT OR IGNORE INTO configs VALUES (?, ?)", (digest, vendor)).rowcount:
+          conn.executemany("INSERT INTO sections (body, path, sha256) VALUES (?, ?, ?)", rows)
+          indexed = True
+        conn.execute("COMMIT")
+      except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute(
+      "INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?)",
+      (tenant_id, device_id, ts, digest, str(config_path)),
+    )
+    return indexed
+
+  def search(
+    self,
+    query: str,
+    tenant_id: Optional[str] = None,
+    vendor: Optional[str] = None,
+    history: bool = False,
+    limit: int = 100,
+  ) -> List[Dict[str, Any]]:
+    """Sections matching ``query`` (see ``fts_query``), one entry per device
+    version holding them, with the matching lines.
+
+    Only each device's latest version is searched unless ``history``.
+    """
+    sql = [
+      "SELECT b.tenant_id, b.device_id, b.ts, b.config_path, b.sha256, c.vendor, s.path,",
+      f" highlight(sections, 0, '{_MARK_START}', '{_MARK_END}')",
+      " FROM sections s JOIN backups b ON b.sha256 = s.sha256 JOIN configs c ON c.sha256 = s.sha256",
+      " WHERE sections MATCH ?",
+    ]
+    params: List[Any] = [fts_query(query)]
+    if tenant_id is not None:
+      sql.append(" AND b.tenant_id = ?")
+      params.append(tenant_id)
+    if vendor is not None:
+      sql.append(" AND c.vendor = ?")
+      params.append(vendor)
+    if not history:
+      sql.append(
+        " AND b.ts = (SELECT MAX(l.ts) FROM backups l WHERE l.tenant_id = b.tenant_id AND l.device_id = b.device_id)"
+      )
+    sql.append(" ORDER BY b.tenant_id, b.device_id, b.ts DESC LIMIT ?")
+    params.append(limit)
+    out = []
+    for tenant, device, ts, config_path, digest, found_vendor, path, marked in self._conn().execute("".join(sql), params):
+      out.append({
+        "tenantId": tenant,
+        "deviceId": device,
+        "backupTimestamp": ts,
+        "configPath": config_path,
+        "sha256": digest,
+        "vendor": found_vendor,
+        "section": json.loads(path),
+        "lines": [
+          line.replace(_MARK_START, "").replace(_MARK_END, "")
+          for line in marked.split("\n")
+          if _MARK_START in line
+        ],
+      })
+    return out
+
+
+def search_enabled() -> bool:
+  return os.environ.get("BACKUP_SEARCH_INDEX", "1") != "0"
+
+
+_indexes_lock = threading.Lock()
+_indexes: Dict[Path, SearchIndex] = {}
+
+
+def search_index(base_dir: Path) -> SearchIndex:
+  """Shared index for ``base_dir``; BACKUP_SEARCH_INDEX_PATH overrides its location."""
+  path = Path(os.environ.get("BACKUP_SEARCH_INDEX_PATH") or base_dir / ".search-index.sqlite")
+  with _indexes_lock:
+    index = _indexes.get(path)
+    if index is None:
+      index = _indexes[path] = SearchIndex(path)
+    return index
+
+
+def reindex(base_dir: Path) -> Tuple[int, int]:
+  """Backfill from the backup tree: (versions recorded, configs indexed).
+
+  Versions are found by their <tenant>/<device>/YYYY/MM/DD/<ts>.cfg path;
+  the vendor is guessed from the content.
+  """
+  from datetime import datetime, timezone
+
+  from automation.storage.filesystem import read_config_bytes
+
+  index = search_index(base_dir)
+  versions = indexed = 0
+  for path in sorted(base_dir.glob("*/*/[0-9][0-9][0-9][0-9]/[0-9][0-9]/[0-9][0-9]/*.cfg")):
+    device_dir = path.parents[3]
+    try:
+      ts = datetime.strptime(path.stem, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc).isoformat()
+      data = read_config_bytes(path)
+    except (ValueError, OSError):
+      continue
+    text = data.decode("utf-8", errors="replace")
+    if index.add(device_dir.parent.name, device_dir.name, ts, sha256(data).hexdigest(), path, guess_vendor(text), lambda: text):
+      indexed += 1
+    versions += 1
+  return versions, indexed
+
+
+if __name__ == "__main__":
+  usage = "usage: python -m automation.storage.search_index (search QUERY [--history] | reindex)"
+  root = Path(os.environ.get("BACKUP_ROOT_DIR", "/data/backups"))
+  if len(sys.argv) >= 3 and sys.argv[1] == "search":
+    hits = search_index(root).search(sys.argv[2], history="--history" in sys.argv[3:])
+    json.dump(hits, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+  elif len(sys.argv) == 2 and sys.argv[1] == "reindex":
+    versions, indexed = reindex(root)
+    print(f"recorded {versions} versions, indexed {indexed} configs")
+  else:
+    print(usage, file=sys.stderr)
+    sys.exit(2)
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
+from typing import Iterable, Iterator
 
+from automation.exceptions import BackupExecutionError
 from automation.models import DeviceConnectionInfo
+from automation.storage.codec import iter_text_chunks
 
 
 class BaseVendorBackup(ABC):
@@ -13,3 +16,21 @@ class BaseVendorBackup(ABC):
   def fetch_running_config(self, device: DeviceConnectionInfo) -> str:
     raise NotImplementedError
 
+  def stream_running_config(self, device: DeviceConnectionInfo) -> Iterator[bytes]:
+    """Yield the running config as UTF-8 chunks while it is read from the device.
+
+    Pass the result to ``save_config_stream``. The default wraps
+    ``fetch_running_config``; vendors that can read their session
+    incrementally override it so the config is never held whole in memory.
+    """
+    yield from iter_text_chunks(self.fetch_running_config(device))
+
+  @staticmethod
+  def _require_content(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    # Raised after the last chunk, so the partial temp file is discarded.
+    seen = False
+    for chunk in chunks:
+      seen = seen or bool(chunk.strip())
+      yield chunk
+    if not seen:
+      raise BackupExecutionError("Empty configuration received from device")
@@ -1,13 +1,17 @@
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Iterator
 
 import os
 
+from automation import metrics
 from automation.exceptions import BackupConnectionError, BackupExecutionError
 from automation.models import BackupResult, DeviceConnectionInfo
-from automation.storage.filesystem import save_config_to_file
+from automation.normalize import normalizer
+from automation.storage.filesystem import save_config_stream
 from automation.clients.api_client import ApiClient
 from automation.vendors.base import BaseVendorBackup
+from automation.vendors.shell_reader import ShellReader, normalize_linefeeds
 try:
   import psutil  # type: ignore
 except Exception:
@@ -20,9 +24,14 @@ class CiscoIOSBackup(BaseVendorBackup):
     return "cisco_ios"
 
   def fetch_running_config(self, device: DeviceConnectionInfo) -> str:
+    return b"".join(self.stream_running_config(device)).decode("utf-8", errors="replace")
+
+  def stream_running_config(self, device: DeviceConnectionInfo) -> Iterator[bytes]:
     if os.environ.get("SIMULATE_BACKUP") == "1":
-      return "version 15.2\nhostname CiscoSim\n!\nend\n"
-    from netmiko import ConnectHandler, NetmikoTimeoutException, NetmikoAuthenticationException
+      yield b"version 15.2\nhostname CiscoSim\n!\nend\n"
+      return
+    from netmiko import NetmikoTimeoutException, NetmikoAuthenticationException
+    from automation.ssh_pool import netmiko_session
     host = device.ip_address or device.hostname
     params = {
       "device_type": "cisco_ios",
@@ -35,15 +44,17 @@ class CiscoIOSBackup(BaseVendorBackup):
       "auth_timeout": device.timeout,
     }
     try:
-      with ConnectHandler(**params) as conn:
-        try:
-          conn.send_command("terminal length 0")
-        except Exception:
-          pass
-        config = conn.send_command("show running-config", read_timeout=device.timeout)
-        if not config.strip():
-          raise BackupExecutionError("Empty configuration received from device")
-        return config
+      with netmiko_session(params) as conn:
+        with metrics.stage("pager_disable"):
+          try:
+            conn.send_command("terminal length 0")
+          except Exception:
+            pass
+        # Read the pooled session's channel directly so the output is passed
+        # on as it arrives instead of being buffered by send_command.
+        prompt = conn.find_prompt().strip().encode()
+        output = ShellReader(conn.remote_conn).iter_output("show running-config", device.read_timeout or float(device.timeout), terminator=None, prompt=prompt, strip_echo=True, strip_prompt=True)
+        yield from self._require_content(normalize_linefeeds(output))
     except NetmikoTimeoutException as exc:
       raise BackupConnectionError(f"Timeout connecting to {host}") from exc
     except NetmikoAuthenticationException as exc:
@@ -81,14 +92,16 @@ def run_cisco_ios_backup(
       p = psutil.Process()
       api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="resource_usage", status="success", detail=None, meta={"cpu_percent": psutil.cpu_percent(interval=None), "mem_rss": p.memory_info().rss})
     provider = CiscoIOSBackup()
-    config_text = provider.fetch_running_config(device)
-    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="config_read", status="success", detail=None, meta={"length": len(config_text)})
-    result_with_file = save_config_to_file(
+    # The config goes from the SSH channel through the vendor's normalizer
+    # to a temp file chunk by chunk.
+    raw = metrics.timed("config_read", provider.stream_running_config(device))
+    result_with_file = save_config_stream(
       base_dir=Path(backup_root_dir),
       result=base_result,
-      config_text=config_text,
+      chunks=metrics.timed("normalize", normalizer(provider.vendor).stream(raw)),
     )
-    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="file_write", status="success", detail=None, meta={"path": str(result_with_file.config_path), "size": result_with_file.config_size_bytes, "sha256": result_with_file.config_sha256})
+    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="config_read", status="success", detail=None, meta={"length": result_with_file.config_size_bytes})
+    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="file_write", status="success", detail=None, meta={"path": str(result_with_file.config_path), "size": result_with_file.config_size_bytes, "sha256": result_with_file.config_sha256, "unchanged": result_with_file.unchanged})
     final_result = BackupResult(
       device_id=result_with_file.device_id,
       tenant_id=result_with_file.tenant_id,
@@ -101,9 +114,11 @@ def run_cisco_ios_backup(
       error_message=None,
       job_id=result_with_file.job_id,
       execution_id=result_with_file.execution_id,
+      unchanged=result_with_file.unchanged,
     )
     api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="report_ready", status="success", detail=None, meta={"sha256": final_result.config_sha256})
-    api_client.report_backup_result(final_result)
+    with metrics.stage("report"):
+      api_client.report_backup_result(final_result)
     return final_result
   except (BackupConnectionError, BackupExecutionError) as exc:
     api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="error", status="failed", detail=str(exc), meta={})
@@ -120,7 +135,8 @@ def run_cisco_ios_backup(
       job_id=base_result.job_id,
       execution_id=base_result.execution_id,
     )
-    api_client.report_backup_result(error_result)
+    with metrics.stage("report"):
+      api_client.report_backup_result(error_result)
     return error_result
   except Exception as exc:
     api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="error", status="failed", detail=str(exc), meta={})
@@ -137,5 +153,6 @@ def run_cisco_ios_backup(
       job_id=base_result.job_id,
       execution_id=base_result.execution_id,
     )
-    api_client.report_backup_result(error_result)
+    with metrics.stage("report"):
+      api_client.report_backup_result(error_result)
     return error_result
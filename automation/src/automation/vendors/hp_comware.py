@@ -1,13 +1,17 @@
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Iterator
 
 import os
 
+from automation import metrics
 from automation.exceptions import BackupConnectionError, BackupExecutionError
 from automation.models import BackupResult, DeviceConnectionInfo
-from automation.storage.filesystem import save_config_to_file
+from automation.normalize import normalizer
+from automation.storage.filesystem import save_config_stream
 from automation.clients.api_client import ApiClient
 from automation.vendors.base import BaseVendorBackup
+from automation.vendors.shell_reader import ShellReader
 try:
   import psutil  # type: ignore
 except Exception:
@@ -19,135 +23,135 @@ class HPComwareBackup(BaseVendorBackup):
   def vendor(self) -> str:
     return "hp_comware"
 
+  def _stream_shell(self, chan, device: DeviceConnectionInfo, known_style: str | None, styles: list[str]) -> Iterator[bytes]:
+    try:
+      chan.get_pty()
+    except Exception:
+      pass
+    chan.invoke_shell()
+    chan.settimeout(float(device.timeout))
+    reader = ShellReader(chan)
+    # Drain the banner, answering "Press any key" prompts, until the CLI prompt shows.
+    with metrics.stage("connect"):
+      reader.send("\n")
+      try:
+        reader.read_until_prompt(float(device.timeout))
+      except Exception:
+        pass
+    initial = reader.clear().decode(errors="ignore")
+    if ("Comware" in initial) or ("H3C" in initial):
+      style = "comware"
+    elif known_style and "press any key" not in initial.lower():
+      # Comware prints its copyright banner only at login, not on a second
+      # shell over a reused connection; fall back to what was seen before.
+      style = known_style
+    else:
+      style = "procurve"
+    styles.append(style)
+    is_comware = style == "comware"
+    setup = "screen-length disable" if is_comware else "no page"
+    with metrics.stage("pager_disable"):
+      reader.send(setup + "\n")
+      try:
+        prompt = reader.read_until_prompt(float(device.timeout), echo=setup.encode())
+      except Exception:
+        prompt = None
+    if prompt is None and not is_comware:
+      # ProCurve prints no end marker after its config; only the prompt
+      # returning ends it.
+      raise BackupExecutionError("No CLI prompt after disabling the pager; cannot tell where the config ends")
+    # Without a read deadline from the device's profile, give large configs at least 45s.
+    collect_timeout = device.read_timeout or max(float(device.timeout), 45.0)
+    if is_comware:
+      yield from reader.iter_output("display current-configuration", collect_timeout, prompt=prompt)
+      return
+    output = reader.iter_output("show run", collect_timeout, terminator=None, prompt=prompt)
+    # An unsupported "show run" fails within its first few lines; look at
+    # those before deciding which command's output to pass on.
+    head = b""
+    for chunk in output:
+      head += chunk
+      if len(head) >= 4096:
+        break
+    if not head.strip() or b"Invalid input" in head or b"Unknown command" in head:
+      for _ in output:
+        pass
+      yield from reader.iter_output("show running-config", collect_timeout, terminator=None, prompt=prompt)
+      return
+    yield head
+    yield from output
+
   def fetch_running_config(self, device: DeviceConnectionInfo) -> str:
+    return b"".join(self.stream_running_config(device)).decode(errors="ignore")
+
+  def stream_running_config(self, device: DeviceConnectionInfo) -> Iterator[bytes]:
     if os.environ.get("SIMULATE_BACKUP") == "1":
-      return "sysname HP-Comware-Sim\n#\nsysname HP-Comware\n#\nreturn\n"
-    from automation.kex_compat import connect_with_kex_fallback
+      yield b"sysname HP-Comware-Sim\n#\nsysname HP-Comware\n#\nreturn\n"
+      return
+    from automation.kex_compat import kex_cache
+    from automation.ssh_pool import acquire_paramiko, shared_pool
     import paramiko
     ip = (device.ip_address or "").split("/")[0].strip()
     candidates = [ip or "", device.hostname or ""]
     candidates = [h for h in candidates if h]
+    # The cache key stays the first configured host even if only the
+    # hostname answered the pre-flight sweep.
+    cache_host = candidates[0] if candidates else ""
+    if device.candidates is not None:
+      candidates = list(device.candidates)
     if not candidates:
       raise BackupConnectionError("No valid host provided")
+    # Remembered per device endpoint: which candidate answered and whether it
+    # is a Comware or ProCurve CLI.
+    cache = kex_cache()
+    known = cache.get(cache_host, device.port)
+    if known.get("candidate") in candidates:
+      candidates.remove(known["candidate"])
+      candidates.insert(0, known["candidate"])
     last_exc: Exception | None = None
-    client = None
-    transport = None
+    lease = None
     host = ""
     try:
       for h in candidates:
         try:
-          client, transport = connect_with_kex_fallback(
-            host=h,
-            port=device.port,
-            username=device.username,
-            password=device.password,
-            timeout=float(device.timeout),
-            banner_timeout=float(device.timeout),
-            auth_timeout=float(device.timeout),
-            mode="paramiko",
-          )
+          lease = acquire_paramiko(h, device.port, device.username, device.password, float(device.timeout))
           host = h
           break
         except Exception as exc:
           last_exc = exc
-          client = None
-          transport = None
+          lease = None
           continue
-      if transport is None:
+      if lease is None:
         raise BackupConnectionError(f"Unable to connect to any host: {', '.join(candidates)}")
-      import time
-      chan = transport.open_session()
+      reusable = False
+      styles: list[str] = []
       try:
-        chan.get_pty()
-      except Exception:
-        pass
-      chan.invoke_shell()
-      chan.settimeout(float(device.timeout))
-      # Drain initial banner and handle "Press any key" prompts
-      initial = ""
-      try:
-        chan.sendall("\n")
-        time.sleep(0.3)
         try:
-          initial = chan.recv(65535).decode(errors="ignore")
-        except Exception:
-          initial = ""
-        if "Press any key" in initial or "press any key" in initial:
-          try:
-            chan.sendall(" ")
-          except Exception:
-            pass
-          time.sleep(0.3)
-      except Exception:
-        pass
-      is_comware = ("Comware" in initial) or ("H3C" in initial)
-      if is_comware:
-        try:
-          chan.sendall("screen-length disable\n")
-        except Exception:
-          pass
-      else:
+          chan = lease.conn[1].open_session()
+        except paramiko.ssh_exception.SSHException:
+          if lease.uses == 1:
+            raise
+          # Some older switches allow one session per connection; reconnect.
+          shared_pool().release(lease, reusable=False)
+          lease = acquire_paramiko(host, device.port, device.username, device.password, float(device.timeout))
+          chan = lease.conn[1].open_session()
         try:
-          chan.sendall("no page\n")
-        except Exception:
-          pass
-      def collect(cmd: str) -> str:
-        try:
-          chan.sendall(cmd + "\n")
-        except Exception:
-          pass
-        out = ""
-        deadline = time.time() + max(float(device.timeout), 45.0)
-        while time.time() < deadline:
+          yield from self._require_content(self._stream_shell(chan, device, known.get("prompt_style"), styles))
+        finally:
           try:
-            data = chan.recv(65535)
-            if not data:
-              time.sleep(0.2)
-              continue
-            chunk = data.decode(errors="ignore")
+            chan.close()
           except Exception:
-            chunk = ""
-          if chunk:
-            out += chunk
-            if "Press any key" in chunk or "press any key" in chunk:
-              try:
-                chan.sendall(" ")
-              except Exception:
-                pass
-              time.sleep(0.2)
-            if "\nreturn" in out or out.strip().endswith("return"):
-              break
-            if "More" in chunk or "more" in chunk:
-              try:
-                chan.sendall(" ")
-              except Exception:
-                pass
-          time.sleep(0.2)
-        return out
-      if is_comware:
-        buf = collect("display current-configuration")
-      else:
-        buf = collect("show run")
-        if not buf.strip() or "Invalid input" in buf or "Unknown command" in buf:
-          time.sleep(0.3)
-          buf = collect("show running-config")
-      # Cleanup
-      try:
-        chan.close()
-      except Exception:
-        pass
-      try:
-        client.close()
-      except Exception:
-        pass
-      config = buf
-      if not config.strip():
-        raise BackupExecutionError("Empty configuration received from device")
-      return config
+            pass
+        reusable = True
+      finally:
+        shared_pool().release(lease, reusable)
+      cache.update(cache_host, device.port, candidate=host, prompt_style=styles[0])
     except paramiko.ssh_exception.AuthenticationException as exc:
       raise BackupConnectionError(f"Authentication failed for {host}") from exc
     except paramiko.ssh_exception.SSHException as exc:
       raise BackupConnectionError(f"SSH error connecting to {host}: {exc}") from exc
+    except BackupConnectionError:
+      raise
     except BackupExecutionError:
       raise
     except Exception as exc:
@@ -181,14 +185,16 @@ def run_hp_comware_backup(
       p = psutil.Process()
       api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="resource_usage", status="success", detail=None, meta={"cpu_percent": psutil.cpu_percent(interval=None), "mem_rss": p.memory_info().rss})
     provider = HPComwareBackup()
-    config_text = provider.fetch_running_config(device)
-    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="config_read", status="success", detail=None, meta={"length": len(config_text)})
-    result_with_file = save_config_to_file(
+    # The config goes from the SSH channel through the vendor's normalizer
+    # to a temp file chunk by chunk.
+    raw = metrics.timed("config_read", provider.stream_running_config(device))
+    result_with_file = save_config_stream(
       base_dir=Path(backup_root_dir),
       result=base_result,
-      config_text=config_text,
+      chunks=metrics.timed("normalize", normalizer(provider.vendor).stream(raw)),
     )
-    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="file_write", status="success", detail=None, meta={"path": str(result_with_file.config_path), "size": result_with_file.config_size_bytes, "sha256": result_with_file.config_sha256})
+    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="config_read", status="success", detail=None, meta={"length": result_with_file.config_size_bytes})
+    api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="file_write", status="success", detail=None, meta={"path": str(result_with_file.config_path), "size": result_with_file.config_size_bytes, "sha256": result_with_file.config_sha256, "unchanged": result_with_file.unchanged})
     final_result = BackupResult(
       device_id=result_with_file.device_id,
       tenant_id=result_with_file.tenant_id,
@@ -201,9 +207,11 @@ def run_hp_comware_backup(
       error_message=None,
       job_id=result_with_file.job_id,
       execution_id=result_with_file.execution_id,
+      unchanged=result_with_file.unchanged,
     )
     api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="report_ready", status="success", detail=None, meta={"sha256": final_result.config_sha256})
-    api_client.report_backup_result(final_result)
+    with metrics.stage("report"):
+      api_client.report_backup_result(final_result)
     return final_result
   except (BackupConnectionError, BackupExecutionError) as exc:
     api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="error", status="failed", detail=str(exc), meta={})
@@ -220,7 +228,8 @@ def run_hp_comware_backup(
       job_id=base_result.job_id,
       execution_id=base_result.execution_id,
     )
-    api_client.report_backup_result(error_result)
+    with metrics.stage("report"):
+      api_client.report_backup_result(error_result)
     return error_result
   except Exception as exc:
     api_client.report_step(device_id=device.device_id, execution_id=execution_id, step_key="error", status="failed", detail=str(exc), meta={})
@@ -237,5 +246,6 @@ def run_hp_comware_backup(
       job_id=base_result.job_id,
       execution_id=base_result.execution_id,
     )
-    api_client.report_backup_result(error_result)
+    with metrics.stage("report"):
+      api_client.report_backup_result(error_result)
     return error_result
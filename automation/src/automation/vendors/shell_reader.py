@@ -0,0 +1,252 @@
+import re
+import select
+import socket
+import time
+from typing import Iterator, Optional
+
+from automation.exceptions import BackupExecutionError
+
+CHUNK_SIZE = 65536
+
+# Pagers and "Press any key" banners sit on the last, unterminated line while
+# the device waits for input.
+_PAGER_RE = re.compile(rb"-+\s*more\s*-*|press any key", re.IGNORECASE)
+_ANSI_RE = re.compile(rb"\x1b\[[0-9;?]*[A-Za-z]")
+_PROMPT_ENDINGS = (b">", b"#", b"]")
+# A prompt or pager line longer than this is config text, not a prompt.
+_MAX_PROMPT_LINE = 256
+
+
+def _clean_line(line: bytes) -> bytes:
+  return _ANSI_RE.sub(b"", line).replace(b"\r", b"").strip()
+
+
+class ShellReader:
+  """Reads an interactive shell channel as data arrives.
+
+  The channel is waited on with select() (paramiko channels expose a
+  fileno), so there are no fixed sleeps between reads. Output accumulates in
+  one bytearray, and prompt/pager/terminator checks only look at the tail
+  added since the previous check. ``iter_output`` hands output on as it
+  arrives and keeps only a short tail, so memory does not grow with the
+  size of the output.
+
+  Scan positions are absolute offsets into the whole output; ``_dropped``
+  counts the bytes already handed on and removed from ``buf``.
+  """
+
+  def __init__(self, chan, chunk_size: int = CHUNK_SIZE):
+    self.chan = chan
+    self.chunk_size = chunk_size
+    self.buf = bytearray()
+    self.eof = False
+    self._scanned = 0
+    self._dropped = 0
+    try:
+      chan.fileno()
+      self._selectable = True
+    except Exception:
+      self._selectable = False
+
+  def clear(self) -> bytes:
+    data = bytes(self.buf)
+    self.buf = bytearray()
+    self._scanned = 0
+    self._dropped = 0
+    return data
+
+  def send(self, data: str) -> None:
+    try:
+      self.chan.sendall(data)
+    except Exception:
+      pass
+
+  def _wait_readable(self, timeout: float) -> bool:
+    if self.chan.recv_ready():
+      return True
+    if not self._selectable:
+      return True  # recv() below waits on the channel timeout instead
+    try:
+      ready, _, _ = select.select([self.chan], [], [], max(0.0, timeout))
+    except (OSError, ValueError):
+      return True
+    return bool(ready)
+
+  def read_chunk(self, timeout: float) -> int:
+    """Append whatever arrives within ``timeout``; returns the byte count."""
+    if self.eof or not self._wait_readable(timeout):
+      return 0
+    if not self._selectable:
+      self.chan.settimeout(max(0.01, timeout))
+    try:
+      data = self.chan.recv(self.chunk_size)
+    except socket.timeout:
+      return 0
+    if not data:
+      self.eof = True
+      return 0
+    self.buf += data
+    return len(data)
+
+  def last_line(self) -> bytes:
+    start = self.buf.rfind(b"\n", max(0, len(self.buf) - _MAX_PROMPT_LINE)) + 1
+    if start == 0 and len(self.buf) > _MAX_PROMPT_LINE:
+      return b""
+    return bytes(self.buf[start:])
+
+  def at_pager(self) -> bool:
+    line = self.last_line()
+    return bool(line) and _PAGER_RE.search(line) is not None
+
+  def prompt(self) -> Optional[bytes]:
+    """The trailing line if it looks like a CLI prompt, e.g. ``<HP>`` or ``switch#``."""
+    line = _clean_line(self.last_line())
+    if line and line.endswith(_PROMPT_ENDINGS):
+      return line
+    return None
+
+  def found_new(self, token: bytes) -> bool:
+    """Whether ``token`` occurs in the output added since the last call."""
+    start = max(self._dropped, self._scanned - len(token) + 1)
+    self._scanned = self._dropped + len(self.buf)
+    return self.buf.find(token, start - self._dropped) != -1
+
+  def _echo_end(self, echo: bytes, searched: int) -> int:
+    start = max(self._dropped, searched - len(echo) + 1)
+    at = self.buf.find(echo, start - self._dropped)
+    return -1 if at == -1 else self._dropped + at + len(echo)
+
+  def _last_newline(self) -> int:
+    at = self.buf.rfind(b"\n")
+    return -1 if at == -1 else self._dropped + at
+
+  def read_until_prompt(self, timeout: float, quiet: float = 0.5, echo: Optional[bytes] = None) -> Optional[bytes]:
+    """Read until the device shows a prompt (answering pagers on the way).
+
+    With ``echo``, only a prompt after the echoed command counts, so prompts
+    left over from earlier input do not end the read. Gives up after ``quiet``
+    seconds without output (four times that while waiting for the echo),
+    which covers banners that do not end in a recognisable prompt.
+    """
+    deadline = time.monotonic() + timeout
+    echo_end = -1 if echo else 0
+    searched = 0
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0 or self.eof:
+        return self.prompt()
+      if not self.read_chunk(min(remaining, quiet * 4 if echo_end == -1 else quiet)):
+        if self.eof or self.buf:
+          return self.prompt()
+        continue
+      if echo_end == -1:
+        echo_end = self._echo_end(echo, searched)
+        searched = len(self.buf)
+        if echo_end == -1:
+          continue
+      if self.at_pager():
+        self.send(" ")
+        continue
+      prompt = self.prompt()
+      if prompt is not None and self.buf.rfind(b"\n") >= echo_end:
+        return prompt
+
+  def iter_output(
+    self,
+    cmd: str,
+    timeout: float,
+    terminator: Optional[bytes] = b"\nreturn",
+    prompt: Optional[bytes] = None,
+    strip_echo: bool = False,
+    strip_prompt: bool = False,
+  ) -> Iterator[bytes]:
+    """Send ``cmd`` and yield its output as it arrives.
+
+    Stops at ``terminator`` (Comware ends its configuration with ``return``),
+    when ``prompt`` reappears after the command's echo, at EOF, or at the
+    deadline. Output cut off at the deadline or by EOF before the ``prompt``
+    or ``terminator`` showed is truncated, so TimeoutError or
+    BackupExecutionError is raised instead; only a read with neither ends
+    at the deadline without error. ``strip_echo`` drops everything up to
+    the end of the echoed command line and ``strip_prompt`` the final prompt
+    line, like Netmiko's send_command does.
+    """
+    self.clear()
+    self.send(cmd + "\n")
+    echo = cmd.encode()
+    echo_end = -1
+    searched = 0
+    # Output before this absolute offset is not passed on.
+    skip_to = 0
+    deadline = time.monotonic() + timeout
+    complete = False
+    while not self.eof:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        if prompt is not None or terminator is not None:
+          raise TimeoutError(f"{cmd!r} did not finish within {timeout:g}s")
+        break
+      if not self.read_chunk(remaining):
+        continue
+      if terminator is not None and (self.found_new(terminator) or self.buf[-32:].rstrip().endswith(terminator.strip())):
+        complete = True
+        break
+      if echo_end == -1 and (prompt is not None or strip_echo):
+        echo_end = self._echo_end(echo, searched)
+        searched = self._dropped + len(self.buf)
+      if strip_echo and skip_to == 0:
+        if echo_end == -1:
+          continue
+        line_end = self.buf.find(b"\n", echo_end - self._dropped)
+        if line_end == -1:
+          continue
+        skip_to = self._dropped + line_end + 1
+      if self.at_pager():
+        self.send(" ")
+      elif prompt is not None and echo_end != -1 and self._last_newline() >= echo_end and _clean_line(self.last_line()) == prompt:
+        complete = True
+        break
+      # Keep enough of the tail for the prompt, pager and terminator checks.
+      flush = len(self.buf) - _MAX_PROMPT_LINE
+      if flush > 0:
+        out = self._drop(flush, skip_to)
+        if out:
+          yield out
+    if self.eof and not complete and (prompt is not None or terminator is not None):
+      # The session dropped mid-output; what arrived is a truncated config.
+      raise BackupExecutionError(f"Connection closed before {cmd!r} finished")
+    if strip_prompt and prompt is not None and _clean_line(self.last_line()) == prompt:
+      cut = self.buf.rfind(b"\n") + 1
+      del self.buf[cut:]
+    out = self._drop(len(self.buf), skip_to)
+    if out:
+      yield out
+
+  def _drop(self, count: int, skip_to: int) -> bytes:
+    start = max(0, min(count, skip_to - self._dropped))
+    out = bytes(self.buf[start:count])
+    del self.buf[:count]
+    self._dropped += count
+    return out
+
+  def collect(self, cmd: str, timeout: float, terminator: Optional[bytes] = b"\nreturn", prompt: Optional[bytes] = None) -> str:
+    """Send ``cmd`` and return its whole output; see ``iter_output``."""
+    return b"".join(self.iter_output(cmd, timeout, terminator=terminator, prompt=prompt)).decode(errors="ignore")
+
+
+_LINEFEEDS_RE = re.compile(rb"\r\r\n|\r\n|\n\r")
+
+
+def normalize_linefeeds(chunks: Iterator[bytes]) -> Iterator[bytes]:
+  """Streaming equivalent of Netmiko's normalize_linefeeds (CRLF and friends to LF)."""
+  held = b""
+  for chunk in chunks:
+    data = held + chunk
+    # Hold back a trailing run of CR/LF: it may continue in the next chunk.
+    # Splitting just before such a run never cuts a match in two.
+    body = data.rstrip(b"\r\n")
+    held = data[len(body):]
+    if body:
+      yield _LINEFEEDS_RE.sub(b"\n", body)
+  if held:
+    yield _LINEFEEDS_RE.sub(b"\n", held)
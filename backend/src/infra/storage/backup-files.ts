@@ -0,0 +1,132 @@
+import fs from "node:fs";
+import path from "node:path";
+import zlib from "node:zlib";
+import { Readable } from "node:stream";
+
+// Written by automation/storage/cas.py in place of a plain .cfg when
+// BACKUP_STORAGE_MODE=cas; the config itself lives in a shared object file.
+const MANIFEST_MAGIC = Buffer.from("#netcfg-manifest/1\n", "utf8");
+// automation/storage/codec.py may gzip or zstd-compress stored files
+// (BACKUP_COMPRESSION); the format is recognised from the leading bytes.
+const GZIP_MAGIC = Buffer.from([0x1f, 0x8b]);
+const ZSTD_MAGIC = Buffer.from([0x28, 0xb5, 0x2f, 0xfd]);
+
+// BACKUP_STORAGE_MODE=delta (automation/storage/delta.py) writes manifests
+// with a "base" manifest and a "delta" object instead of a full "object"; the
+// text is rebuilt by applying the deltas forward from the chain's keyframe.
+type Manifest = { sha256: string; size: number; object?: string; base?: string; delta?: string };
+// [start, end] copies base lines, a string array inserts lines.
+type DeltaOp = [number, number] | string[];
+
+function readHead(filePath: string, length: number): Buffer {
+  const fd = fs.openSync(filePath, "r");
+  try {
+    const head = Buffer.alloc(length);
+    const n = fs.readSync(fd, head, 0, length, 0);
+    return head.subarray(0, n);
+  } finally {
+    fs.closeSync(fd);
+  }
+}
+
+function readManifest(filePath: string): Manifest | null {
+  if (!readHead(filePath, MANIFEST_MAGIC.length).equals(MANIFEST_MAGIC)) return null;
+  const raw = fs.readFileSync(filePath).subarray(MANIFEST_MAGIC.length).toString("utf8");
+  return JSON.parse(raw) as Manifest;
+}
+
+function resolveContentPath(filePath: string): string {
+  const manifest = readManifest(filePath);
+  if (!manifest || !manifest.object) return filePath;
+  return path.resolve(path.dirname(filePath), manifest.object);
+}
+
+function zstdUnavailable(): Error {
+  return new Error("zstd-compressed backup requires Node.js with zlib zstd support (>= 22.15)");
+}
+
+function decodeStored(data: Buffer): Buffer {
+  if (data.subarray(0, GZIP_MAGIC.length).equals(GZIP_MAGIC)) {
+    return zlib.gunzipSync(data);
+  }
+  if (data.subarray(0, ZSTD_MAGIC.length).equals(ZSTD_MAGIC)) {
+    const zstdDecompressSync = (zlib as any).zstdDecompressSync;
+    if (typeof zstdDecompressSync !== "function") throw zstdUnavailable();
+    return zstdDecompressSync(data);
+  }
+  return data;
+}
+
+function readDeltaLines(filePath: string): string[] {
+  const chain: Manifest[] = [];
+  const dirs: string[] = [];
+  let current = filePath;
+  let lines: string[];
+  for (;;) {
+    const manifest = readManifest(current);
+    if (!manifest || !manifest.base || !manifest.delta) {
+      lines = decodeStored(fs.readFileSync(resolveContentPath(current))).toString("utf8").split("\n");
+      break;
+    }
+    chain.push(manifest);
+    dirs.push(path.dirname(current));
+    current = path.resolve(path.dirname(current), manifest.base);
+  }
+  for (let i = chain.length - 1; i >= 0; i--) {
+    const deltaPath = path.resolve(dirs[i], chain[i].delta as string);
+    const ops = JSON.parse(decodeStored(fs.readFileSync(deltaPath)).toString("utf8")).ops as DeltaOp[];
+    const next: string[] = [];
+    for (const op of ops) {
+      if (op.length > 0 && typeof op[0] === "number") {
+        for (let k = op[0]; k < (op[1] as number); k++) next.push(lines[k]);
+      } else {
+        for (const line of op as string[]) next.push(line);
+      }
+    }
+    lines = next;
+  }
+  return lines;
+}
+
+function isDeltaManifest(filePath: string): boolean {
+  const manifest = readManifest(filePath);
+  return Boolean(manifest && manifest.delta);
+}
+
+export function backupFileExists(filePath: string): boolean {
+  try {
+    let current = filePath;
+    for (;;) {
+      const manifest = readManifest(current);
+      if (!manifest || !manifest.base || !manifest.delta) return fs.existsSync(resolveContentPath(current));
+      if (!fs.existsSync(path.resolve(path.dirname(current), manifest.delta))) return false;
+      current = path.resolve(path.dirname(current), manifest.base);
+    }
+  } catch {
+    return false;
+  }
+}
+
+export function readBackupText(filePath: string): string {
+  if (isDeltaManifest(filePath)) return readDeltaLines(filePath).join("\n");
+  return decodeStored(fs.readFileSync(resolveContentPath(filePath))).toString("utf8");
+}
+
+export function openBackupStream(filePath: string): Readable {
+  if (isDeltaManifest(filePath)) return Readable.from([Buffer.from(readBackupText(filePath), "utf8")]);
+  const contentPath = resolveContentPath(filePath);
+  const head = readHead(contentPath, ZSTD_MAGIC.length);
+  const raw = fs.createReadStream(contentPath);
+  if (head.subarray(0, GZIP_MAGIC.length).equals(GZIP_MAGIC)) {
+    return raw.pipe(zlib.createGunzip());
+  }
+  if (head.equals(ZSTD_MAGIC)) {
+    const createZstdDecompress = (zlib as any).createZstdDecompress;
+    if (typeof createZstdDecompress !== "function") {
+      raw.destroy();
+      throw zstdUnavailable();
+    }
+    return raw.pipe(createZstdDecompress());
+  }
+  return raw;
+}
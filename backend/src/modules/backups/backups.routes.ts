@@ -8,6 +8,7 @@ import { createTwoFilesPatch } from "diff";
 import child_process from "node:child_process";
 import net from "node:net";
 import { decryptSecret } from "../../infra/security/aes.js";
+import { backupFileExists, openBackupStream, readBackupText } from "../../infra/storage/backup-files.js";
 
 function requireAutomationAuth() {
   return async (request: FastifyRequest, reply: FastifyReply) => {
@@ -67,12 +68,12 @@ export function registerBackupRoutes(app: FastifyInstance): void {
     } catch {}
   }
 
-  async function insertStepLog(data: { executionId: string; deviceId: string; stepKey: string; status: string; detail?: string | null; meta?: any }) {
+  async function insertStepLog(data: { executionId: string; deviceId: string; stepKey: string; status: string; detail?: string | null; meta?: any; ts?: string | null }) {
     try {
       await db.query(
-        `INSERT INTO backup_step_logs (execution_id, device_id, step_key, status, detail, meta)
-         VALUES ($1, $2, $3, $4, $5, $6)`,
-        [data.executionId, data.deviceId, data.stepKey, data.status, data.detail ?? null, data.meta ? JSON.stringify(data.meta) : null]
+        `INSERT INTO backup_step_logs (execution_id, device_id, step_key, status, detail, meta, created_at)
+         VALUES ($1, $2, $3, $4, $5, $6, COALESCE($7::timestamptz, now()))`,
+        [data.executionId, data.deviceId, data.stepKey, data.status, data.detail ?? null, data.meta ? JSON.stringify(data.meta) : null, data.ts ?? null]
       );
     } catch {}
   }
@@ -182,7 +183,7 @@ export function registerBackupRoutes(app: FastifyInstance): void {
           if (dupRes.rowCount && dupRes.rows[0]?.id) {
             const existingId = String(dupRes.rows[0].id);
             await client.query("COMMIT");
-            const existsDup = fs.existsSync(configPath);
+            const existsDup = backupFileExists(configPath);
             await insertStepLog({ executionId: "00000000-0000-0000-0000-000000000000", deviceId: body.deviceId, stepKey: "report_received", status, detail: body.errorMessage ?? null, meta: { configPath, sizeBytes: body.configSizeBytes, sha256: body.configSha256, dedupSha256: true } });
             await insertStepLog({ executionId: "00000000-0000-0000-0000-000000000000", deviceId: body.deviceId, stepKey: "postcheck_file", status: existsDup ? "success" : "failed", detail: existsDup ? null : "config file missing", meta: { path: configPath } });
             return reply.status(200).send({ id: existingId });
@@ -197,7 +198,7 @@ export function registerBackupRoutes(app: FastifyInstance): void {
             const row: any = lockRes.rows[0];
             if (row.backup_id) {
               await client.query("COMMIT");
-              const existsDup = fs.existsSync(configPath);
+              const existsDup = backupFileExists(configPath);
               await insertStepLog({ executionId: body.executionId, deviceId: body.deviceId, stepKey: "report_received", status: row.status || status, detail: body.errorMessage ?? null, meta: { configPath, sizeBytes: body.configSizeBytes, sha256: body.configSha256, dedup: true } });
               await insertStepLog({ executionId: body.executionId, deviceId: body.deviceId, stepKey: "postcheck_file", status: existsDup ? "success" : "failed", detail: existsDup ? null : "config file missing", meta: { path: configPath } });
               return reply.status(200).send({ id: String(row.backup_id) });
@@ -253,7 +254,7 @@ export function registerBackupRoutes(app: FastifyInstance): void {
           await insertStepLog({ executionId: body.executionId, deviceId: body.deviceId, stepKey: "report_received", status, detail: body.errorMessage ?? null, meta: { configPath, sizeBytes: body.configSizeBytes, sha256: body.configSha256 } });
         }
 
-        const exists = fs.existsSync(configPath);
+        const exists = backupFileExists(configPath);
         await insertStepLog({ executionId: body.executionId ?? "00000000-0000-0000-0000-000000000000", deviceId: body.deviceId, stepKey: "postcheck_file", status: exists ? "success" : "failed", detail: exists ? null : "config file missing", meta: { path: configPath } });
         if (!body.success) {
           await insertErrorLog(request, { tenantId, statusCode: 200, errorCode: "backup_failed", message: body.errorMessage ?? "Backup failed", deviceId: body.deviceId, executionId: body.executionId ?? null, requestBody: body, severity: "critical" });
@@ -268,24 +269,119 @@ export function registerBackupRoutes(app: FastifyInstance): void {
     }
   );
 
+  // Sent instead of /internal/backups/report when the automation found the
+  // config identical to the last version it stored: no file was written, so
+  // the execution is linked to the device's latest backup and nothing is
+  // inserted. 409 tells the automation to fall back to a full report.
+  const unchangedSchema = z.object({
+    deviceId: z.string().uuid(),
+    tenantId: z.string().uuid().optional(),
+    vendor: z.enum(["fortigate", "cisco_ios", "mikrotik", "hp_comware"]),
+    backupTimestamp: z.string(),
+    configSha256: z.string().length(64),
+    jobId: z.string().uuid().nullable().optional(),
+    executionId: z.string().uuid().nullable().optional(),
+  });
+
+  app.post(
+    "/internal/backups/unchanged",
+    { preValidation: requireAutomationAuth() },
+    async (request, reply) => {
+      const body = unchangedSchema.parse(request.body);
+      const userTenant = (request.user as any)?.tenantId as string | undefined;
+      const tenantId = body.tenantId ?? userTenant;
+      if (!tenantId) {
+        return reply.status(400).send({ message: "tenantId is required" });
+      }
+      const client = await db.connect();
+      try {
+        await client.query("BEGIN");
+        const lastRes = await client.query(
+          `SELECT id, config_sha256 FROM device_backups
+           WHERE tenant_id = $1 AND device_id = $2 AND is_success = true
+           ORDER BY backup_timestamp DESC
+           LIMIT 1`,
+          [tenantId, body.deviceId]
+        );
+        if (!lastRes.rowCount || String(lastRes.rows[0].config_sha256) !== body.configSha256) {
+          await client.query("ROLLBACK");
+          return reply.status(409).send({ message: "Latest backup does not match configSha256" });
+        }
+        const backupId = String(lastRes.rows[0].id);
+        if (body.executionId) {
+          await client.query(
+            `UPDATE backup_executions SET completed_at = $1, status = 'success', error_message = NULL, backup_id = $2
+             WHERE id = $3 AND backup_id IS NULL`,
+            [body.backupTimestamp, backupId, body.executionId]
+          );
+        } else if (body.jobId) {
+          await client.query(
+            `INSERT INTO backup_executions (
+              job_id, device_id, completed_at, status, error_message, backup_id
+            ) VALUES ($1, $2, $3, 'success', NULL, $4)`,
+            [body.jobId, body.deviceId, body.backupTimestamp, backupId]
+          );
+        }
+        await client.query("COMMIT");
+        return reply.status(200).send({ id: backupId, unchanged: true });
+      } catch (err) {
+        try { await client.query("ROLLBACK"); } catch {}
+        throw err;
+      } finally {
+        client.release();
+      }
+    }
+  );
+
   const stepSchema = z.object({
     deviceId: z.string().uuid(),
-    executionId: z.string().uuid().optional(),
+    executionId: z.string().uuid().nullable().optional(),
     stepKey: z.string().min(1),
     status: z.string().min(1),
     detail: z.string().nullable().optional(),
     meta: z.any().optional(),
+    ts: z.string().datetime({ offset: true }).optional(),
   });
   app.post(
     "/internal/backups/step",
     { preValidation: requireAutomationAuth() },
     async (request, reply) => {
       const b = stepSchema.parse(request.body);
-      await insertStepLog({ executionId: b.executionId ?? "00000000-0000-0000-0000-000000000000", deviceId: b.deviceId, stepKey: b.stepKey, status: b.status, detail: b.detail ?? null, meta: b.meta });
+      await insertStepLog({ executionId: b.executionId ?? "00000000-0000-0000-0000-000000000000", deviceId: b.deviceId, stepKey: b.stepKey, status: b.status, detail: b.detail ?? null, meta: b.meta, ts: b.ts ?? null });
       return reply.status(201).send({ ok: true });
     }
   );
 
+  // Batched form of /internal/backups/step used by the automation step reporter.
+  // Rows whose execution or device no longer exists are skipped, matching the
+  // single-step endpoint where such inserts fail silently.
+  const stepBatchSchema = z.object({ items: z.array(stepSchema).min(1).max(1000) });
+  app.post(
+    "/internal/backups/steps",
+    { preValidation: requireAutomationAuth() },
+    async (request, reply) => {
+      const { items } = stepBatchSchema.parse(request.body);
+      const rows = items.map((b) => ({
+        execution_id: b.executionId ?? "00000000-0000-0000-0000-000000000000",
+        device_id: b.deviceId,
+        step_key: b.stepKey,
+        status: b.status,
+        detail: b.detail ?? null,
+        meta: b.meta ?? null,
+        created_at: b.ts ?? null,
+      }));
+      const res = await db.query(
+        `INSERT INTO backup_step_logs (execution_id, device_id, step_key, status, detail, meta, created_at)
+         SELECT x.execution_id, x.device_id, x.step_key, x.status, x.detail, x.meta, COALESCE(x.created_at, now())
+         FROM jsonb_to_recordset($1::jsonb) AS x(execution_id uuid, device_id uuid, step_key text, status text, detail text, meta jsonb, created_at timestamptz)
+         WHERE EXISTS (SELECT 1 FROM backup_executions be WHERE be.id = x.execution_id)
+           AND EXISTS (SELECT 1 FROM devices d WHERE d.id = x.device_id)`,
+        [JSON.stringify(rows)]
+      );
+      return reply.status(201).send({ inserted: res.rowCount ?? 0 });
+    }
+  );
+
   app.get(
     "/backups/:deviceId/diff",
     { preValidation: async (req, rep) => req.jwtVerify() },
@@ -310,8 +406,8 @@ export function registerBackupRoutes(app: FastifyInstance): void {
         }
         const a = res.rows[1];
         const b = res.rows[0];
-        const aText = fs.readFileSync(a.config_path, "utf8");
-        const bText = fs.readFileSync(b.config_path, "utf8");
+        const aText = readBackupText(a.config_path);
+        const bText = readBackupText(b.config_path);
         const patch = createTwoFilesPatch(
           String(a.config_path),
           String(b.config_path),
@@ -601,10 +697,10 @@ export function registerBackupRoutes(app: FastifyInstance): void {
         if (String(row.tenant_id) !== String(userTenant)) return reply.status(403).send({ message: "Forbidden" });
         if (!row.is_success) return reply.status(400).send({ message: "Backup failed" });
         const filePath = String(row.config_path);
-        if (!filePath || !fs.existsSync(filePath)) return reply.status(404).send({ message: "File not found" });
+        if (!filePath || !backupFileExists(filePath)) return reply.status(404).send({ message: "File not found" });
         reply.header("Content-Type", "text/plain; charset=utf-8");
         reply.header("Content-Disposition", `attachment; filename=\"config_${row.device_id}.txt\"`);
-        return reply.send(fs.createReadStream(filePath));
+        return reply.send(openBackupStream(filePath));
       } finally {
         client.release();
       }
@@ -169,11 +169,32 @@ export function registerMonitoringRoutes(app: FastifyInstance): void {
          ts timestamptz NOT NULL DEFAULT now(),
          uptime_ticks integer,
          cpu_percent integer,
-         mem_used_percent integer
+         mem_used_percent integer,
+         status text,
+         status_detail text
        );
        CREATE INDEX IF NOT EXISTS idx_device_metrics_device_ts ON device_metrics (device_id, ts DESC);`
     );
   }
+  // Samples without values say why: the device did not answer, or the
+  // poller skipped it while its circuit is open. ALTER TABLE locks the
+  // table even when the columns exist, so it runs once per process.
+  let metricsStatusColumns: Promise<void> | null = null;
+  function ensureMetricsStatusColumns(): Promise<void> {
+    if (!metricsStatusColumns) {
+      metricsStatusColumns = db
+        .query(
+          `ALTER TABLE device_metrics ADD COLUMN IF NOT EXISTS status text;
+           ALTER TABLE device_metrics ADD COLUMN IF NOT EXISTS status_detail text;`
+        )
+        .then(() => undefined)
+        .catch((err: unknown) => {
+          metricsStatusColumns = null;
+          throw err;
+        });
+    }
+    return metricsStatusColumns;
+  }
   async function ensureInventoryTable() {
     await db.query(
       `CREATE TABLE IF NOT EXISTS device_inventory (
@@ -290,7 +311,7 @@ export function registerMonitoringRoutes(app: FastifyInstance): void {
         `SELECT id, tenant_id, hostname, mgmt_ip, vendor
          FROM devices
          WHERE is_active = true
-         ORDER BY name
+         ORDER BY name, id
          LIMIT $1 OFFSET $2`,
         [q.limit, q.offset]
       );
@@ -323,22 +344,26 @@ export function registerMonitoringRoutes(app: FastifyInstance): void {
         uptimeTicks: z.number().int().optional().nullable(),
         cpuPercent: z.number().int().min(0).max(100).optional().nullable(),
         memUsedPercent: z.number().int().min(0).max(100).optional().nullable(),
+        status: z.enum(["unreachable", "circuit_open"]).optional(),
+        detail: z.string().optional().nullable(),
       });
       const body = bodySchema.parse(request.body);
       await ensureMetricsTable();
       const schema = await getMetricsSchema();
       if (schema.kind === "legacy") {
         const uptimeSecs = typeof body.uptimeTicks === "number" ? Math.floor(body.uptimeTicks / 100) : null;
+        const meta = body.status ? JSON.stringify({ status: body.status, detail: body.detail ?? null }) : null;
         await db.query(
           `INSERT INTO device_metrics (tenant_id, device_id, ts, cpu_usage, mem_usage, uptime_seconds, meta)
-           VALUES ($1, $2, now(), $3, $4, $5, NULL)`,
-          [body.tenantId, body.deviceId, body.cpuPercent ?? null, body.memUsedPercent ?? null, uptimeSecs]
+           VALUES ($1, $2, now(), $3, $4, $5, $6)`,
+          [body.tenantId, body.deviceId, body.cpuPercent ?? null, body.memUsedPercent ?? null, uptimeSecs, meta]
         );
       } else {
+        await ensureMetricsStatusColumns();
         await db.query(
-          `INSERT INTO device_metrics (tenant_id, device_id, uptime_ticks, cpu_percent, mem_used_percent)
-           VALUES ($1, $2, $3, $4, $5)`,
-          [body.tenantId, body.deviceId, body.uptimeTicks ?? null, body.cpuPercent ?? null, body.memUsedPercent ?? null]
+          `INSERT INTO device_metrics (tenant_id, device_id, uptime_ticks, cpu_percent, mem_used_percent, status, status_detail)
+           VALUES ($1, $2, $3, $4, $5, $6, $7)`,
+          [body.tenantId, body.deviceId, body.uptimeTicks ?? null, body.cpuPercent ?? null, body.memUsedPercent ?? null, body.status ?? null, body.detail ?? null]
         );
       }
       return reply.status(201).send();
@@ -758,7 +783,9 @@ export async function collectMetricsJob(): Promise<void> {
          ts timestamptz NOT NULL DEFAULT now(),
          uptime_ticks integer,
          cpu_percent integer,
-         mem_used_percent integer
+         mem_used_percent integer,
+         status text,
+         status_detail text
        );
        CREATE INDEX IF NOT EXISTS idx_device_metrics_device_ts ON device_metrics (device_id, ts DESC);
        CREATE TABLE IF NOT EXISTS device_live_status (